@@ -0,0 +1,409 @@
+#!/usr/bin/env python3
+
+"""Benchmarks of indexing and queries on a synthetic corpus, see :mod:`corpus`
+
+Measures startup time, tokenizer throughput, serial and parallel ingest, rescans of an unchanged tree, index size,
+query latency percentiles, term dictionary lookups and scoring of large postings with and without numpy, and writes
+them as JSON. Results of different commits are compared with ``--compare``::
+
+    PYTHONPATH=src python benchmarks/bench.py --docs 2000 --output before.json
+    PYTHONPATH=src python benchmarks/bench.py --docs 2000 --output after.json
+    python benchmarks/bench.py --compare before.json after.json
+"""
+
+import argparse
+import datetime
+import importlib.machinery
+import importlib.util
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import typing
+import types
+
+from corpus import Corpus, vocabulary
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FORMAT = 1
+
+
+def load_fusearchd() -> types.ModuleType:
+    """:returns: bin/fusearchd.py as a module"""
+    loader = importlib.machinery.SourceFileLoader("fusearchd", os.path.join(ROOT, "bin", "fusearchd.py"))
+    module = importlib.util.module_from_spec(importlib.util.spec_from_loader(loader.name, loader))
+    loader.exec_module(module)
+    return module
+
+
+def git_commit() -> typing.Optional[str]:
+    try:
+        out = subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+    except OSError:
+        return None
+    return out.stdout.strip() or None
+
+
+def percentiles(seconds: typing.List[float], prefix: str) -> dict:
+    """:returns: dictionary of prefix_p50_ms, p95, p99 and mean of the durations"""
+    ms = sorted(x * 1000 for x in seconds)
+    result = {}
+    for p in (50, 95, 99):
+        result["{}_p{}_ms".format(prefix, p)] = ms[min(len(ms) - 1, int(len(ms) * p / 100))]
+    result["{}_mean_ms".format(prefix)] = statistics.mean(ms)
+    return result
+
+
+def index_size(path: str, index_db: str) -> int:
+    """:returns: bytes used by the index files, the database and everything next to it named after it"""
+    size = 0
+    for entry in os.listdir(path):
+        if not entry.startswith(index_db):
+            continue
+        entry = os.path.join(path, entry)
+        if os.path.isdir(entry):
+            for dirpath, _, files in os.walk(entry):
+                size += sum(os.path.getsize(os.path.join(dirpath, x)) for x in files)
+        else:
+            size += os.path.getsize(entry)
+    return size
+
+
+def remove_index(path: str, index_db: str) -> None:
+    for entry in os.listdir(path):
+        if entry.startswith(index_db):
+            entry = os.path.join(path, entry)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry)
+            else:
+                os.remove(entry)
+
+
+def bench_startup(repeat: int) -> dict:
+    """Time to import fusearchd and to build the tokenizer in a new interpreter, the best of repeat runs"""
+    snippets = {
+        "startup_import_fusearchd_ms": "import bench; bench.load_fusearchd()",
+        "startup_tokenizer_ms": "from fusearch.tokenizer import get_tokenizer; get_tokenizer(None)",
+    }
+    result = {}
+    # The interpreters run in the benchmarks directory
+    paths = os.environ.get("PYTHONPATH", "").split(os.pathsep)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(os.path.abspath(x) for x in paths if x))
+    for name, snippet in snippets.items():
+        code = "import time; start = time.perf_counter(); {}; print(time.perf_counter() - start)".format(snippet)
+        times = []
+        for _ in range(repeat):
+            out = subprocess.run(
+                [sys.executable, "-c", code],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                env=env,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+            )
+            out.check_returncode()
+            times.append(float(out.stdout.split()[-1]))
+        result[name] = min(times) * 1000
+    return result
+
+
+def bench_tokenize(fusearchd: types.ModuleType, config, corpus: Corpus) -> dict:
+    texts = list(corpus.texts())
+    # A new tokenizer, ingest starts with an empty stem cache too
+    tokenizer = type(fusearchd.get_tokenizer(config))()
+    start = time.perf_counter()
+    tokens = sum(len(tokenizer.tokenize(text)) for text in texts)
+    elapsed = time.perf_counter() - start
+    return {
+        "tokenize_mb_per_s": sum(len(x) for x in texts) / elapsed / 1e6,
+        "tokenize_tokens_per_s": tokens / elapsed,
+    }
+
+
+def bench_ingest(fusearchd: types.ModuleType, config, path: str, docs: int, mode: str, repeat: int) -> dict:
+    """Index path from scratch, the best of repeat runs"""
+    config.parallel_extraction = mode == "parallel"
+    times = []
+    for _ in range(repeat):
+        remove_index(path, fusearchd.INDEX_DB)
+        start = time.perf_counter()
+        fusearchd.index_do(path, config)
+        times.append(time.perf_counter() - start)
+    index = fusearchd.get_index(path, config)
+    assert index.doc_count == docs, "indexed {} documents of {}".format(index.doc_count, docs)
+    return {"ingest_{}_s".format(mode): min(times), "ingest_{}_docs_per_s".format(mode): docs / min(times)}
+
+
+def bench_rescan(fusearchd: types.ModuleType, config, path: str, repeat: int) -> dict:
+    """Index an unchanged tree, and only gather the files to index"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fusearchd.index_do(path, config)
+        times.append(time.perf_counter() - start)
+    gather_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with tempfile.TemporaryFile() as inventory:
+            count = fusearchd.gather_files(fusearchd.NeedsIndexFileGenerator(path, config), config, inventory)
+        gather_times.append(time.perf_counter() - start)
+        assert count == 0, "{} files to index in an unchanged tree".format(count)
+    return {"rescan_s": min(times), "gather_files_s": min(gather_times)}
+
+
+def bench_queries(fusearchd: types.ModuleType, config, path: str, queries: typing.List[str], k: int) -> dict:
+    tokenizer = fusearchd.get_tokenizer(config)
+    db = {"provider": "sqlite", "filename": os.path.join(path, fusearchd.INDEX_DB)}
+    index = fusearchd.Index(db, tokenizer, cache_entries=0)
+    # Loads the scorer statistics
+    start = time.perf_counter()
+    index.top_k(queries[0], k)
+    result = {"first_query_ms": (time.perf_counter() - start) * 1000}
+    # Prefix and fuzzy words, see fusearch.query
+    prefixes = [x.split()[0][:4] + "*" for x in queries]
+    fuzzy = [x.split()[0] + "~" for x in queries]
+    for name, query, txts in (
+        ("top_k", lambda x: index.top_k(x, k), queries),
+        ("ranked", index.ranked, queries),
+        ("prefix", lambda x: index.top_k(x, k), prefixes),
+        ("fuzzy", lambda x: index.top_k(x, k), fuzzy),
+    ):
+        times = []
+        for txt in txts:
+            start = time.perf_counter()
+            query(txt)
+            times.append(time.perf_counter() - start)
+        result.update(percentiles(times, "query_" + name))
+    return result
+
+
+def bench_terms(size: int, count: int, seed: int) -> dict:
+    """Lookups in a term dictionary of size terms, see fusearch.terms"""
+    from fusearch.terms import MAX_EXPANSIONS, TermDictionary
+
+    terms = vocabulary(size, seed)
+    tracemalloc.start()
+    start = time.perf_counter()
+    dictionary = TermDictionary(terms)
+    result = {"terms_build_s": time.perf_counter() - start, "terms_memory_bytes": tracemalloc.get_traced_memory()[0]}
+    tracemalloc.stop()
+    # Queries of existing terms and of typos of them
+    rnd = random.Random(seed + 1)
+    words = rnd.sample(terms, count)
+    typos = []
+    for word in words:
+        i = rnd.randrange(1, len(word))
+        typos.append(word[:i] + rnd.choice("aeiou") + word[i + 1 :])
+    lookups = {
+        "prefix": lambda i: dictionary.prefix(words[i][:3], MAX_EXPANSIONS),
+        "wildcard": lambda i: dictionary.wildcard(words[i][:2] + "*" + words[i][-2:], MAX_EXPANSIONS),
+        "suffix": lambda i: dictionary.wildcard("*" + words[i][-4:], MAX_EXPANSIONS),
+        "fuzzy1": lambda i: dictionary.fuzzy(typos[i], 1, MAX_EXPANSIONS, 1),
+        "fuzzy2": lambda i: dictionary.fuzzy(typos[i], 2, MAX_EXPANSIONS, 1),
+    }
+    for name, lookup in lookups.items():
+        # Builds the reversed terms of suffix wildcards
+        lookup(0)
+        times = []
+        for i in range(count):
+            start = time.perf_counter()
+            lookup(i)
+            times.append(time.perf_counter() - start)
+        result.update(percentiles(times, "terms_" + name))
+    return result
+
+
+def bench_dense(postings: int, terms: int, k: int, repeat: int, seed: int) -> dict:
+    """Decoding and scoring a query of terms in every document, postings in total, with the Python loops and with numpy,
+    the median of repeat runs. Needs numpy, see fusearch.topk"""
+    try:
+        import numpy
+    except ImportError:
+        print("numpy is not installed, skipping the dense scoring benchmark", file=sys.stderr)
+        return {}
+    from collections import defaultdict
+    from fusearch import postings as postings_codec
+    from fusearch.scoring import BM25
+    from fusearch.topk import TermPostings, dense_scores, dense_top_k, max_score
+
+    rnd = random.Random(seed)
+    docs = postings // terms
+    doc_ids = list(range(1, docs + 1))
+    scorer = BM25()
+    scorer.load((doc_id, rnd.randint(50, 5000)) for doc_id in doc_ids)
+    blobs = []
+    for _ in range(terms):
+        tfs = [min(int(rnd.paretovariate(2)), 100) for _ in doc_ids]
+        blobs.append((postings_codec.encode(doc_ids, tfs), max(tfs)))
+
+    def term_postings(decode) -> typing.List[TermPostings]:
+        result = []
+        for blob, max_tf in blobs:
+            ids, tfs = decode(blob)
+            weight = scorer.weight(len(ids))
+            result.append(TermPostings(weight, scorer.upper_bound(weight, max_tf, max_tf), ids, tfs))
+        return result
+
+    lists = term_postings(postings_codec.decode)
+    arrays = term_postings(postings_codec.decode_arrays)
+
+    def ranked_loop() -> list:
+        # Like Searcher._ranked_scores
+        scores = defaultdict(float)
+        for term in lists:
+            for doc_id, tf in zip(term.doc_ids, term.tfs):
+                scores[doc_id] += scorer.term_score(term.weight, tf, doc_id)
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+    def ranked_dense() -> list:
+        # Like Searcher._ranked_arrays
+        positions, scores = dense_scores(arrays, scorer.doc_ids, scorer.term_scores)
+        order = numpy.lexsort((positions, -scores))
+        return list(zip(scorer.doc_ids[positions[order]].tolist(), scores[order].tolist()))
+
+    # Builds the doc id and norm arrays of the scorer
+    dense_top_k(arrays, k, scorer.doc_ids, scorer.term_scores)
+    cases = {
+        "decode_loop": lambda: [postings_codec.decode(blob) for blob, _ in blobs],
+        "decode_dense": lambda: [postings_codec.decode_arrays(blob) for blob, _ in blobs],
+        "top_k_loop": lambda: max_score(lists, k, scorer.term_score),
+        "top_k_dense": lambda: dense_top_k(arrays, k, scorer.doc_ids, scorer.term_scores),
+        "ranked_loop": ranked_loop,
+        "ranked_dense": ranked_dense,
+    }
+    result = {}
+    for name, case in cases.items():
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            case()
+            times.append(time.perf_counter() - start)
+        result["dense_{}_ms".format(name)] = statistics.median(times) * 1000
+    return result
+
+
+def run(args) -> dict:
+    fusearchd = load_fusearchd()
+    corpus = Corpus(args.docs, args.words, args.vocabulary, args.zipf_s, args.seed)
+    config = fusearchd.Config(
+        index_dirs=[],
+        verbose=False,
+        include_extensions=["txt"],
+        # Measure the extraction, not the cache
+        extraction_cache="",
+        positional_index=args.positional,
+        index_batch_size=256,
+    )
+    results = {}
+    with tempfile.TemporaryDirectory(dir=args.tmpdir) as path:
+        start = time.perf_counter()
+        corpus.write(path)
+        print(
+            "corpus of {} documents written in {:.1f}s".format(args.docs, time.perf_counter() - start), file=sys.stderr
+        )
+        results.update(bench_startup(max(args.repeat, 3)))
+        results.update(bench_tokenize(fusearchd, config, corpus))
+        for mode in args.modes:
+            results.update(bench_ingest(fusearchd, config, path, args.docs, mode, args.repeat))
+        results["index_size_bytes"] = index_size(path, fusearchd.INDEX_DB)
+        results.update(bench_rescan(fusearchd, config, path, args.repeat))
+        results.update(bench_queries(fusearchd, config, path, corpus.queries(args.queries, args.seed + 1), args.k))
+    if args.terms:
+        results.update(bench_terms(args.terms, args.queries, args.seed))
+    if args.dense_postings:
+        results.update(bench_dense(args.dense_postings, args.dense_terms, args.k, max(args.repeat, 5), args.seed))
+    parameters = {x: getattr(args, x) for x in ("docs", "words", "vocabulary", "zipf_s", "seed", "positional")}
+    parameters.update(
+        {x: getattr(args, x) for x in ("modes", "repeat", "queries", "k", "terms", "dense_postings", "dense_terms")}
+    )
+    return {
+        "format": FORMAT,
+        "commit": git_commit(),
+        "date": datetime.datetime.utcnow().isoformat(timespec="seconds") + "Z",
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": parameters,
+        "results": results,
+    }
+
+
+def higher_is_better(metric: str) -> bool:
+    return metric.endswith("_per_s")
+
+
+def compare(before: dict, after: dict) -> str:
+    """:returns: table of the change of every metric, positive improvements are better"""
+    lines = []
+    if before["parameters"] != after["parameters"]:
+        lines.append("warning: different parameters {} {}".format(before["parameters"], after["parameters"]))
+    lines.append("{:<32} {:>14} {:>14} {:>9}".format("metric", before["commit"], after["commit"], "better"))
+    for metric, old in before["results"].items():
+        new = after["results"].get(metric)
+        if new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        improvement = change if higher_is_better(metric) else -change
+        lines.append("{:<32} {:>14.4g} {:>14.4g} {:>+8.1f}%".format(metric, old, new, improvement * 100))
+    return "\n".join(lines)
+
+
+def config_argparse() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--docs", type=int, default=2000, help="number of documents")
+    parser.add_argument("--words", type=int, default=300, help="mean words per document")
+    parser.add_argument("--vocabulary", type=int, default=50000, help="number of distinct words")
+    parser.add_argument("--zipf-s", type=float, default=1.1, help="exponent of the word frequency distribution")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--positional", action="store_true", help="index token positions")
+    parser.add_argument(
+        "--modes", nargs="+", choices=["serial", "parallel"], default=["serial", "parallel"], help="ingest modes"
+    )
+    parser.add_argument("--repeat", type=int, default=1, help="runs of ingest and rescan, the best is reported")
+    parser.add_argument("--queries", type=int, default=500, help="number of queries")
+    parser.add_argument("-k", type=int, default=20, help="results of top k queries")
+    parser.add_argument(
+        "--terms", type=int, default=1000000, help="number of terms of the term dictionary lookups, 0 to skip them"
+    )
+    parser.add_argument(
+        "--dense-postings",
+        type=int,
+        default=1000000,
+        help="postings of the query scored with and without numpy, 0 to skip it",
+    )
+    parser.add_argument("--dense-terms", type=int, default=4, help="terms of that query, each in every document")
+    parser.add_argument("--tmpdir", help="directory for the corpus and the index, defaults to the system's")
+    parser.add_argument("-o", "--output", help="write the results to this file instead of stdout")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="compare two results files")
+    return parser
+
+
+def main() -> int:
+    args = config_argparse().parse_args()
+    if args.compare:
+        with open(args.compare[0]) as before, open(args.compare[1]) as after:
+            print(compare(json.load(before), json.load(after)))
+        return 0
+    results = json.dumps(run(args), indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(results + "\n")
+    else:
+        print(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""Deterministic synthetic corpus for the benchmarks
+
+Words are made of syllables and drawn from a Zipfian distribution over the vocabulary, the frequency of the word of
+rank r is proportional to 1 / r ** zipf_s, like in natural language text. Documents are plain text files, indexed
+without external text extraction programs. The same parameters and seed always generate the same files.
+"""
+
+import itertools
+import os
+import random
+import typing
+
+SYLLABLES = [c + v for c in "bcdfghjklmnprstvz" for v in "aeiou"]
+# Documents per subdirectory
+FILES_PER_DIR = 100
+WORDS_PER_LINE = 12
+
+
+def vocabulary(size: int, seed: int = 0) -> typing.List[str]:
+    """:returns: size distinct words, in a random order which is their frequency rank"""
+    rnd = random.Random(seed)
+    words = set()
+    result = []
+    while len(result) < size:
+        word = "".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4)))
+        if word not in words:
+            words.add(word)
+            result.append(word)
+    return result
+
+
+def zipf_cum_weights(size: int, zipf_s: float) -> typing.List[float]:
+    return list(itertools.accumulate(1 / rank**zipf_s for rank in range(1, size + 1)))
+
+
+class Corpus:
+    def __init__(self, docs: int, words: int = 300, vocabulary_size: int = 50000, zipf_s: float = 1.1, seed: int = 0):
+        """
+        :param docs: number of documents
+        :param words: mean number of words per document, lengths are uniform between half and one and a half of it
+        :param vocabulary_size: number of distinct words
+        :param zipf_s: exponent of the Zipfian distribution of the words
+        :param seed: seed of the random generator
+        """
+        self.docs = docs
+        self.words = words
+        self.seed = seed
+        self.vocabulary = vocabulary(vocabulary_size, seed)
+        self.cum_weights = zipf_cum_weights(vocabulary_size, zipf_s)
+
+    def texts(self) -> typing.Iterator[str]:
+        """:returns: iterator over the text of the documents"""
+        rnd = random.Random(self.seed)
+        for _ in range(self.docs):
+            length = rnd.randint(self.words // 2 + 1, self.words * 3 // 2)
+            words = rnd.choices(self.vocabulary, cum_weights=self.cum_weights, k=length)
+            lines = (" ".join(words[i : i + WORDS_PER_LINE]) for i in range(0, length, WORDS_PER_LINE))
+            yield "\n".join(lines) + "\n"
+
+    def write(self, directory: str) -> typing.List[str]:
+        """Write the documents as text files under directory
+        :returns: list of the paths of the files
+        """
+        files = []
+        for i, text in enumerate(self.texts()):
+            subdir = os.path.join(directory, "{:04d}".format(i // FILES_PER_DIR))
+            if i % FILES_PER_DIR == 0:
+                os.makedirs(subdir, exist_ok=True)
+            file = os.path.join(subdir, "doc{:06d}.txt".format(i))
+            with open(file, "w") as f:
+                f.write(text)
+            files.append(file)
+        return files
+
+    def queries(self, count: int, seed: int = 1) -> typing.List[str]:
+        """:returns: count queries of one to three words, half of them drawn with the frequencies of the corpus and
+        half uniformly from the vocabulary, which are mostly rare words"""
+        rnd = random.Random(seed)
+        result = []
+        for _ in range(count):
+            terms = []
+            for _ in range(rnd.choice([1, 2, 2, 3])):
+                if rnd.random() < 0.5:
+                    terms.extend(rnd.choices(self.vocabulary, cum_weights=self.cum_weights))
+                else:
+                    terms.append(rnd.choice(self.vocabulary))
+            result.append(" ".join(terms))
+        return result
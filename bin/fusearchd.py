@@ -7,33 +7,89 @@ import os
 import signal
 import sys
 import logging
-import textract
 import functools
-import progressbar
 import tempfile
 import pickle
 import io
+import threading
+import time
+import typing
+from fusearch.client import default_socket
 from fusearch.index import Index
 from fusearch.model import Document
-from fusearch.tokenizer import get_tokenizer, tokfreq, Tokenizer
-from fusearch.util import bytes_to_str, file_generator_ext, filename_without_extension, mtime, pickle_loader
+from fusearch.tokenizer import get_tokenizer, positions, Tokenizer
+from fusearch.util import (
+    bytes_to_str,
+    chunks,
+    file_state,
+    file_unchanged,
+    filename_without_extension,
+    filetype_admissible,
+    normalize_extensions,
+    pickle_loader,
+    scan_files,
+    path_under,
+    sha1_file,
+    stat_files,
+)
 from fusearch.config import Config
+from fusearch.extraction_cache import ExtractionCache
+from fusearch import metrics
+from fusearch.metrics import REGISTRY, MetricsServer, StatsWriter
+from fusearch.segments import merge_segments, remove_incomplete, segments_dir, write_segment
+from fusearch.server import QueryServer
+from fusearch.snapshot import export_snapshot
+from fusearch.snippets import token_offsets
+from fusearch.spool import Spool
+from fusearch.watch import Changes, get_watcher
 from multiprocessing import Process, Queue, cpu_count
 import collections.abc
 
-progressbar_index_widgets_ = [
-    " [",
-    progressbar.Timer(format="Elapsed %(elapsed)s"),
-    ", ",
-    progressbar.SimpleProgress(),
-    " files"
-    #'count: ', progressbar.Counter(),
-    "] ",
-    progressbar.Bar(),
-    " (",
-    progressbar.ETA(),
-    ") ",
-]
+INDEX_DB = ".fusearch.db"
+# Starts with INDEX_DB so that watch ignores it
+SNAPSHOT = INDEX_DB + ".snapshot"
+
+
+def index_progressbar(file_count: int):
+    """:returns: progress bar of the files indexed, progressbar is only imported when it's shown"""
+    import progressbar
+
+    widgets = [
+        " [",
+        progressbar.Timer(format="Elapsed %(elapsed)s"),
+        ", ",
+        progressbar.SimpleProgress(),
+        " files"
+        #'count: ', progressbar.Counter(),
+        "] ",
+        progressbar.Bar(),
+        " (",
+        progressbar.ETA(),
+        ") ",
+    ]
+    return progressbar.ProgressBar(max_value=file_count, widgets=widgets)
+
+
+@functools.lru_cache(maxsize=None)
+def extractor_version() -> str:
+    """Part of the extraction cache keys, change it when the extraction changes. The textract version is read from
+    the package metadata, importing textract is only needed on cache misses"""
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        # Python < 3.8
+        import pkg_resources
+
+        try:
+            textract_version = pkg_resources.get_distribution("textract").version
+        except pkg_resources.DistributionNotFound:
+            textract_version = ""
+    else:
+        try:
+            textract_version = version("textract")
+        except PackageNotFoundError:
+            textract_version = ""
+    return "textract-{}-pdftotext-1".format(textract_version)
 
 
 def cleanup() -> None:
@@ -54,22 +110,22 @@ def config_signal_handlers() -> None:
 
 
 def redirect_stream(system_stream, target_stream):
-    """ Redirect a system stream to a specified file.
+    """Redirect a system stream to a specified file.
 
-        :param standard_stream: A file object representing a standard I/O
-            stream.
-        :param target_stream: The target file object for the redirected
-            stream, or ``None`` to specify the null device.
-        :return: ``None``.
+    :param standard_stream: A file object representing a standard I/O
+        stream.
+    :param target_stream: The target file object for the redirected
+        stream, or ``None`` to specify the null device.
+    :return: ``None``.
 
-        `system_stream` is a standard system stream such as
-        ``sys.stdout``. `target_stream` is an open file object that
-        should replace the corresponding system stream object.
+    `system_stream` is a standard system stream such as
+    ``sys.stdout``. `target_stream` is an open file object that
+    should replace the corresponding system stream object.
 
-        If `target_stream` is ``None``, defaults to opening the
-        operating system's null device and using its file descriptor.
+    If `target_stream` is ``None``, defaults to opening the
+    operating system's null device and using its file descriptor.
 
-        """
+    """
     if target_stream is None:
         target_fd = os.open(os.devnull, os.O_RDWR)
     else:
@@ -83,7 +139,7 @@ def fork_exit_parent() -> None:
         sys.exit(0)
 
 
-def daemonize() -> None:
+def daemonize(args) -> None:
     fork_exit_parent()
     os.setsid()
     fork_exit_parent()
@@ -93,20 +149,35 @@ def daemonize() -> None:
     redirect_stream(sys.stdin, None)
     redirect_stream(sys.stdout, open("/tmp/fusearch.out", "a"))
     redirect_stream(sys.stderr, open("/tmp/fusearch.err", "a"))
-    fusearch_main()
+    fusearch_main(args)
 
 
 def config_argparse() -> argparse.ArgumentParser:
     parser = argparse.ArgumentParser(description="fusearch daemon", epilog="")
     parser.add_argument("-f", "--foreground", action="store_true", help="Don't daemonize")
     parser.add_argument("-c", "--config", type=str, default="/etc/fusearch/config.yaml", help="config file")
+    parser.add_argument("-w", "--watch", action="store_true", help="Keep running and index changes as they happen")
+    parser.add_argument(
+        "-s", "--serve", action="store_true", help="Keep running and answer queries from the fusearch client"
+    )
     return parser
 
 
-def to_text(file: str) -> str:
+def to_text(file: str, file_sha: str = None, cache: ExtractionCache = None) -> str:
+    """:param cache: consulted first when file_sha is given, successful extractions are added to it"""
     assert os.path.isfile(file)
+    if cache is not None and file_sha:
+        txt = cache.get(file_sha)
+        if txt is not None:
+            REGISTRY.inc("fusearch_extraction_cache_hits_total")
+            return txt
+    extension = os.path.splitext(file)[1][1:].lower()
     try:
-        txt_b = textract.process(file, method="pdftotext")
+        # Imported on first use, it takes a while and most runs have nothing to extract
+        import textract
+
+        with REGISTRY.timer("fusearch_extract_seconds", extension=extension):
+            txt_b = textract.process(file, method="pdftotext")
         # TODO more intelligent decoding? there be dragons
         txt = bytes_to_str(txt_b)
         # print(file)
@@ -116,50 +187,152 @@ def to_text(file: str) -> str:
     except Exception as e:
         txt = ""
         logging.exception("Exception while extracting text from '%s'", file)
+        REGISTRY.inc("fusearch_extract_errors_total", extension=extension)
         # TODO mark it as failed instead of empty text
+        return txt
+    if cache is not None and file_sha:
+        cache.put(file_sha, txt)
     return txt
 
 
-def document_from_file(file: str, tokenizer: Tokenizer) -> Document:
-    mtime_latest = mtime(file)
+def get_extraction_cache(config: Config) -> typing.Optional[ExtractionCache]:
+    """:returns: the extraction cache configured in config.extraction_cache or None if it's disabled, the default. It
+    stores a copy of the text of every indexed document"""
+    path = getattr(config, "extraction_cache", "")
+    if not path:
+        return None
+    max_size = getattr(config, "extraction_cache_size_mb", 1024) * 1024 * 1024
+    return ExtractionCache(os.path.expanduser(path), max_size, extractor_version())
+
+
+def document_from_file(
+    file: str, tokenizer: Tokenizer, positional: bool = False, cache: ExtractionCache = None
+) -> Document:
+    """
+    :param positional: record token positions for phrase queries
+    :param cache: extraction cache
+    """
+    mtime_latest, size = file_state(os.stat(file))
     filename = filename_without_extension(file)
-    txt = filename + "\n" + to_text(file)
+    file_sha = sha1_file(file)
+    txt = filename + "\n" + to_text(file, file_sha, cache)
     # Detect language and check that the document makes sense, OCR returns garbage sometimes
     # TODO: add filename to content
-    document = Document(url=file, filename=filename, content=txt, tokfreq=tokfreq(tokenizer(txt)), mtime=mtime_latest)
-    return document
+    return make_document(file, filename, txt, mtime_latest, size, file_sha, tokenizer, positional)
 
 
-def needs_indexing(index: Index, file: str) -> bool:
-    mtime_latest = mtime(file)
-    # document = index.document_from_url(file)
-    mtime_last_known = index.mtime(file)
-    if not mtime_last_known or mtime_last_known and mtime_latest > mtime_last_known:
-        # logging.debug("needs_indexing: need '%s'", file)
-        return True
-    else:
-        # logging.debug("needs_indexing: NOT need '%s'", file)
-        return False
+def document_from_copy(file: str, original: Document, tokenizer: Tokenizer, positional: bool = False) -> Document:
+    """Document for a file with the same contents as an indexed one, reusing its extracted text. The tokens are reused
+    too unless the file name, which is part of the content, is different or positions are needed"""
+    mtime_latest, size = file_state(os.stat(file))
+    filename = filename_without_extension(file)
+    if filename == original.filename and not positional:
+        return original._replace(url=file, mtime=mtime_latest, size=size)
+    txt = original.content or ""
+    if txt.startswith(original.filename + "\n"):
+        txt = txt[len(original.filename) + 1 :]
+    txt = filename + "\n" + txt
+    return make_document(file, filename, txt, mtime_latest, size, original.file_sha, tokenizer, positional)
+
+
+def make_document(
+    file: str, filename: str, txt: str, mtime: int, size: int, file_sha: str, tokenizer: Tokenizer, positional: bool
+) -> Document:
+    # Offsets of the first occurrences of the tokens, for snippets
+    with REGISTRY.timer("fusearch_tokenize_seconds"):
+        if positional:
+            spans = list(tokenizer.spans(txt))
+            freq, tok_offsets = token_offsets(spans)
+            tok_positions = positions([tok for tok, _, _ in spans])
+        else:
+            freq, tok_offsets = token_offsets(tokenizer.spans(txt))
+            tok_positions = None
+    document = Document(
+        url=file,
+        filename=filename,
+        content=txt,
+        tokfreq=freq,
+        mtime=mtime,
+        positions=tok_positions,
+        size=size,
+        file_sha=file_sha,
+        offsets=tok_offsets,
+    )
+    return document
 
 
-def get_index(path: str, config: Config) -> Index:
-    index_db = os.path.join(path, ".fusearch.db")
-    index = Index({"provider": "sqlite", "filename": index_db, "create_db": True}, tokenizer=get_tokenizer(config))
+def get_index(path: str, config: Config, tokenizer: Tokenizer = None) -> Index:
+    """:param tokenizer: defaults to a new one for config"""
+    index_db = os.path.join(path, INDEX_DB)
+    index = Index(
+        {"provider": "sqlite", "filename": index_db, "create_db": True},
+        tokenizer=tokenizer or get_tokenizer(config),
+        collapse_duplicates=getattr(config, "collapse_duplicates", False),
+        wal=getattr(config, "wal", True),
+    )
     logging.debug("get_index: '%s' %d docs", index_db, index.doc_count)
     return index
 
 
+def get_indexes(config: Config) -> typing.Dict[str, Index]:
+    """:returns: dictionary of directory -> index for the existing directories of config.index_dirs"""
+    # Shared by the indexes, it's the slowest part to initialize
+    tokenizer = get_tokenizer(config)
+    paths = [os.path.abspath(x) for x in config.index_dirs if os.path.isdir(x)]
+    return {path: get_index(path, config, tokenizer) for path in paths}
+
+
 class NeedsIndexFileGenerator(object):
-    def __init__(self, path, config):
+    def __init__(self, path, config, changes: Changes = None, index: Index = None):
+        """:param changes: only look at these changed and deleted paths under path instead of scanning it
+        :param index: the index of path, opened if not given"""
         self.path = path
         self.config = config
-        self.index = get_index(path, config)
+        self.changes = changes
+        self.index = index or get_index(path, config)
         assert os.path.isdir(path)
+        # Files with the same contents as an indexed file or as another file to extract, see index_copies
+        self.copies = []
+        # Indexed files which don't exist anymore
+        self.vanished = []
 
     def __call__(self) -> collections.abc.Iterable:
-        """:returns a generator of files which are updated from the mtime in the index"""
-        file_needs_indexing = functools.partial(needs_indexing, self.index)
-        return filter(file_needs_indexing, file_generator_ext(self.path, self.config.include_extensions))
+        """:returns a generator of files which are new or changed (mtime or size) since they were indexed and need text
+        extraction. The state of the indexed files is loaded in one query, files are only opened to sniff their type
+        when they have an unknown extension. Files are only hashed when their size matches the size of an indexed file
+        or of another file to extract, the copies are collected in self.copies instead of yielded"""
+        known = self.index.file_states()
+        indexed_sizes = self.index.file_sizes()
+        # size -> list of [file, sha1] of the files to extract, sha1 is None until another file with the same size
+        to_extract = {}
+        seen = set()
+        admissible = functools.partial(filetype_admissible, normalize_extensions(self.config.include_extensions))
+        files = scan_files(self.path) if self.changes is None else stat_files(self.changes.changed)
+        for file, stat_result in files:
+            seen.add(file)
+            state = known.get(file)
+            if state and file_unchanged(state, stat_result):
+                continue
+            if not admissible(file):
+                continue
+            size = stat_result.st_size
+            same_size = to_extract.setdefault(size, [])
+            file_sha = None
+            if same_size or size in indexed_sizes:
+                file_sha = sha1_file(file)
+                for entry in same_size:
+                    if entry[1] is None:
+                        entry[1] = sha1_file(entry[0])
+                if any(entry[1] == file_sha for entry in same_size) or self.index.has_file_sha(file_sha):
+                    self.copies.append((file, file_sha))
+                    continue
+            same_size.append([file, file_sha])
+            yield file
+        if self.changes is None:
+            vanished = (url for url in known if url not in seen)
+        else:
+            vanished = (url for url in known if path_under(url, self.changes.deleted))
+        self.vanished = [url for url in vanished if not os.path.exists(url)]
 
 
 def file_producer(path: str, config: Config, file_queue: Queue, file_inventory: io.IOBase) -> None:
@@ -169,54 +342,123 @@ def file_producer(path: str, config: Config, file_queue: Queue, file_inventory:
     logging.debug("file_producer is done")
 
 
-def text_extract(config: Config, file_queue: Queue, document_queue: Queue):
+def queue_get(queue: Queue, name: str):
+    """:returns: the next item of queue, recording the time waiting for it"""
+    with REGISTRY.timer("fusearch_queue_wait_seconds", queue=name):
+        return queue.get()
+
+
+def text_extract(config: Config, file_queue: Queue, document_queue: Queue, spool: Spool, metrics_queue: Queue = None):
+    """Extract documents from the files in file_queue, documents go through spool and their handles to
+    document_queue
+    :param metrics_queue: where to send the metrics of the process, see :func:`fusearch.metrics.start_worker`
+    """
     # logging.debug("text_extract started")
+    if metrics_queue is not None:
+        metrics.start_worker(metrics_queue)
     tokenizer = get_tokenizer(config)
-    while True:
-        file = file_queue.get()
-        if file is None:
-            logging.debug("text_extract is done")
-            return
-        logging.debug(
-            "text_extract: file_queue.qsize %d document_queue.qsize %d", file_queue.qsize(), document_queue.qsize()
-        )
+    cache = get_extraction_cache(config)
+    for file in iter(functools.partial(queue_get, file_queue, "file"), None):
         logging.debug("text_extract: '%s'", file)
-        # logging.debug("text_extract: %s", file)
-        document = document_from_file(file, tokenizer)
-        document_queue.put(document)
-
-
-def document_consumer(path: str, config: Config, document_queue: Queue, file_count: int) -> None:
+        document = document_from_file(file, tokenizer, getattr(config, "positional_index", False), cache)
+        document_queue.put(spool.put(document))
+    logging.debug("text_extract is done")
+    REGISTRY.send()
+
+
+def segment_writer(
+    config: Config, file_queue: Queue, segment_queue: Queue, directory: str, metrics_queue: Queue = None
+):
+    """Extract documents from the files in file_queue and write them to segments in directory, the paths of the
+    segments go to segment_queue
+    :param metrics_queue: where to send the metrics of the process, see :func:`fusearch.metrics.start_worker`
+    """
+    if metrics_queue is not None:
+        metrics.start_worker(metrics_queue)
+    tokenizer = get_tokenizer(config)
+    cache = get_extraction_cache(config)
+    max_documents = getattr(config, "segment_documents", 256)
+    max_size = getattr(config, "segment_size_mb", 64) * 1024 * 1024
+    documents = []
+    size = 0
+
+    def write() -> None:
+        with REGISTRY.timer("fusearch_segment_write_seconds"):
+            segment = write_segment(directory, documents, tokenizer)
+        segment_queue.put((segment, len(documents)))
+
+    for file in iter(functools.partial(queue_get, file_queue, "file"), None):
+        logging.debug("segment_writer: '%s'", file)
+        document = document_from_file(file, tokenizer, getattr(config, "positional_index", False), cache)
+        documents.append(document)
+        size += len(document.content)
+        if len(documents) >= max_documents or size >= max_size:
+            write()
+            documents = []
+            size = 0
+    if documents:
+        write()
+    logging.debug("segment_writer is done")
+    REGISTRY.send()
+
+
+def segment_merger(
+    path: str, config: Config, segment_queue: Queue, file_count: int, metrics_queue: Queue = None
+) -> None:
+    """Merge the segments in segment_queue into the index and remove them
+    :param metrics_queue: where to send the metrics of the process, see :func:`fusearch.metrics.start_worker`
+    """
+    if metrics_queue is not None:
+        metrics.start_worker(metrics_queue)
     index = get_index(path, config)
     if config.verbose:
-        pbar = progressbar.ProgressBar(max_value=file_count, widgets=progressbar_index_widgets_)
+        pbar = index_progressbar(file_count)
     file_i = 0
-    while True:
-        doc = document_queue.get()
-        logging.debug("document_consumer(%d): document_queue.qsize %d", os.getpid(), document_queue.qsize())
-        if doc is None:
-            logging.debug("Document consumer, no more elements in the queue")
-            if config.verbose:
-                pbar.finish()
-            return
-        try:
-            index.add_document(doc)
-            logging.debug("document_consumer(%d): added %s", os.getpid(), doc.url)
-        except Exception as e:
-            logging.exception("document_consumer: index.add_document exception. Document[%s]", doc.url)
+    merged = 0
+    for segment, documents in iter(functools.partial(queue_get, segment_queue, "segment"), None):
+        merged += index.merge_segment(segment)
+        os.remove(segment)
+        file_i += documents
         if config.verbose:
             pbar.update(file_i)
-        file_i += 1
+    logging.debug("segment_merger(%d): merged %d documents", os.getpid(), merged)
+    if config.verbose:
+        pbar.finish()
+    REGISTRY.send()
+
+
+def document_consumer(
+    path: str, config: Config, document_queue: Queue, file_count: int, spool: Spool, metrics_queue: Queue = None
+) -> None:
+    """:param metrics_queue: where to send the metrics of the process, see :func:`fusearch.metrics.start_worker`"""
+    if metrics_queue is not None:
+        metrics.start_worker(metrics_queue)
+    index = get_index(path, config)
+    if config.verbose:
+        pbar = index_progressbar(file_count)
+
+    def documents() -> collections.abc.Iterable:
+        for file_i, handle in enumerate(iter(functools.partial(queue_get, document_queue, "document"), None)):
+            doc = spool.get(handle)
+            if config.verbose:
+                pbar.update(file_i)
+            yield doc
+        logging.debug("Document consumer, no more elements in the queue")
+
+    added = index.add_documents(documents(), batch_size=getattr(config, "index_batch_size", 256))
+    logging.debug("document_consumer(%d): added %d documents", os.getpid(), added)
+    if config.verbose:
+        pbar.finish()
+    REGISTRY.send()
 
 
-def gather_files(path, config, file_inventory) -> int:
+def gather_files(needs_index: NeedsIndexFileGenerator, config, file_inventory) -> int:
     """:returns file count"""
-    if not os.path.isdir(path):
-        logging.error("Not a directory: '%s', skipping indexing", path)
-        return
-    logging.info("Indexing %s", path)
+    logging.info("Indexing %s", needs_index.path)
     logging.info("Calculating number of files to index (.=100files)")
     if config.verbose:
+        import progressbar
+
         widgets = [
             " [",
             progressbar.Timer(format="Elapsed %(elapsed)s"),
@@ -227,8 +469,9 @@ def gather_files(path, config, file_inventory) -> int:
             progressbar.BouncingBar(),
         ]
         pbar = progressbar.ProgressBar(widgets=widgets)
+    start = time.perf_counter()
     file_count = 0
-    for file in NeedsIndexFileGenerator(path, config)():
+    for file in needs_index():
         pickle.dump(file, file_inventory)
         file_count += 1
         # if config.verbose and (file_count % 100) == 0:
@@ -240,44 +483,113 @@ def gather_files(path, config, file_inventory) -> int:
     #    sys.stdout.write('\n')
     if config.verbose:
         pbar.finish()
+    REGISTRY.observe("fusearch_gather_seconds", time.perf_counter() - start)
+    REGISTRY.inc("fusearch_files_gathered_total", file_count)
     file_inventory.seek(0)
     return file_count
 
 
-def index_do(path, config) -> None:
+def index_do(path, config, changes: Changes = None) -> None:
+    """:param changes: index only these changed and deleted paths under path, by default the whole path is scanned"""
+    if not os.path.isdir(path):
+        logging.error("Not a directory: '%s', skipping indexing", path)
+        return
+    # Opening an index maps and upgrades its schema, it's opened once and used for every step
+    index = get_index(path, config)
+    # Segments written but not merged by an interrupted run
+    segments = segments_dir(os.path.join(path, INDEX_DB))
+    remove_incomplete(segments)
+    merged = merge_segments(index, segments)
+    if merged:
+        logging.info("Merged %d documents of pending segments", merged)
     file_inventory = tempfile.TemporaryFile()
-    file_count = gather_files(path, config, file_inventory)
-    logging.info("%d files to process", file_count)
-    if config.parallel_extraction:
-        index_parallel(path, config, file_count, file_inventory)
-    else:
-        index_serial(path, config, file_count, file_inventory)
+    needs_index = NeedsIndexFileGenerator(path, config, changes, index)
+    file_count = gather_files(needs_index, config, file_inventory)
+    logging.info("%d files to process, %d copies", file_count, len(needs_index.copies))
+    if file_count:
+        if config.parallel_extraction:
+            index_parallel(path, config, file_count, file_inventory)
+            # Documents were added by the child processes
+            index.update()
+        else:
+            index_serial(index, config, file_count, file_inventory)
+    # After extraction, so copies of the new files are found in the index, and before removing the vanished files so
+    # moves find the original
+    index_copies(index, config, needs_index.copies)
+    removed = index.remove_documents(needs_index.vanished)
+    logging.info("Removed %d documents of vanished files", removed)
+    index.checkpoint()
+    if getattr(config, "snapshot", False):
+        export_snapshot(index, os.path.join(path, SNAPSHOT))
+        logging.info("Wrote snapshot %s", os.path.join(path, SNAPSHOT))
+
+
+def index_copies(index: Index, config: Config, copies: typing.List[typing.Tuple[str, str]]) -> None:
+    """Add the files with the same contents as an indexed file reusing its text and tokens, files whose original
+    can't be found are extracted
+    :param copies: list of (file, sha1)
+    """
+    tokenizer = get_tokenizer(config)
+    positional = getattr(config, "positional_index", False)
+    cache = get_extraction_cache(config)
+
+    def documents() -> collections.abc.Iterable:
+        for chunk in chunks(copies, 256):
+            originals = index.documents_by_file_sha(file_sha for _, file_sha in chunk)
+            for file, file_sha in chunk:
+                try:
+                    if file_sha in originals:
+                        yield document_from_copy(file, originals[file_sha], tokenizer, positional)
+                    else:
+                        yield document_from_file(file, tokenizer, positional, cache)
+                except OSError:
+                    logging.exception("index_copies: can't read '%s'", file)
+
+    added = index.add_documents(documents(), batch_size=getattr(config, "index_batch_size", 256))
+    logging.info("Added %d copies of indexed files", added)
 
 
 def index_parallel(path: str, config: Config, file_count: int, file_inventory) -> None:
+    #
+    # file_producer -> N * segment_writer -> segment_merger
+    #
+    # or without index_segments, indexing every document in a single process:
     #
     # file_producer -> N * test_extract -> document_consumer
     #
     # TODO: check that processes are alive to prevent deadlocks on exceptions in children
+    # Built before forking, the workers inherit it instead of building their own
+    get_tokenizer(config)
     file_queue = Queue(cpu_count() * 8)
-    document_queue = Queue(256)
+    # Metrics of the child processes, merged into the ones of this process
+    metrics_queue = Queue()
+    metrics_merger = metrics.merge_from(metrics_queue)
+    spool = None
+    if getattr(config, "index_segments", True):
+        document_queue = Queue()
+        queue_name = "segment"
+        consumer, consumer_args = segment_merger, (path, config, document_queue, file_count, metrics_queue)
+        segments = segments_dir(os.path.join(path, INDEX_DB))
+        extract, extract_args = segment_writer, (config, file_queue, document_queue, segments, metrics_queue)
+    else:
+        # Documents are passed through the spool, the queue only has their handles
+        spool = Spool(getattr(config, "spool_dir", None))
+        document_queue = Queue(256)
+        queue_name = "document"
+        consumer, consumer_args = document_consumer, (path, config, document_queue, file_count, spool, metrics_queue)
+        extract, extract_args = text_extract, (config, file_queue, document_queue, spool, metrics_queue)
+    REGISTRY.gauge_function("fusearch_queue_depth", file_queue.qsize, queue="file")
+    REGISTRY.gauge_function("fusearch_queue_depth", document_queue.qsize, queue=queue_name)
     text_extract_procs = []
     file_producer_proc = Process(
         name="file producer", target=file_producer, daemon=True, args=(path, config, file_queue, file_inventory)
     )
     file_producer_proc.start()
 
-    document_consumer_proc = Process(
-        name="document consumer", target=document_consumer, daemon=True, args=(path, config, document_queue, file_count)
-    )
+    document_consumer_proc = Process(name="document consumer", target=consumer, daemon=True, args=consumer_args)
 
     for i in range(cpu_count()):
-        p = Process(
-            name="text extractor {}".format(i),
-            target=text_extract,
-            daemon=True,
-            args=(config, file_queue, document_queue),
-        )
+        p = Process(name="text extractor {}".format(i), target=extract, daemon=True, args=extract_args)
         text_extract_procs.append(p)
         p.start()
     document_consumer_proc.start()
@@ -295,35 +607,123 @@ def index_parallel(path: str, config: Config, file_count: int, file_inventory) -
     document_queue.put(None)
     logging.debug("joining document_consumer")
     document_consumer_proc.join()
+    if spool:
+        spool.close()
+    REGISTRY.gauge_function("fusearch_queue_depth", None, queue="file")
+    REGISTRY.gauge_function("fusearch_queue_depth", None, queue=queue_name)
+    metrics_queue.put(None)
+    metrics_merger.join()
     logging.info("Parallel indexing finished")
 
 
-def index_serial(path, config, file_count, file_inventory):
+def index_serial(index: Index, config, file_count, file_inventory):
     if config.verbose:
-        pbar = progressbar.ProgressBar(max_value=file_count, widgets=progressbar_index_widgets_)
-    file_i = 0
+        pbar = index_progressbar(file_count)
     tokenizer = get_tokenizer(config)
+    cache = get_extraction_cache(config)
     logging.info("Indexing started")
-    index = get_index(path, config)
-    for file in pickle_loader(file_inventory):
-        doc = document_from_file(file, tokenizer)
-        try:
-            index.add_document(doc)
-        except Exception as e:
-            logging.exception("index_serial: index.add_document exception. Document[%s]", doc.url)
-        if config.verbose:
-            pbar.update(file_i)
-        file_i += 1
+
+    def documents() -> collections.abc.Iterable:
+        for file_i, file in enumerate(pickle_loader(file_inventory)):
+            yield document_from_file(file, tokenizer, getattr(config, "positional_index", False), cache)
+            if config.verbose:
+                pbar.update(file_i)
+
+    index.add_documents(documents(), batch_size=getattr(config, "index_batch_size", 256))
     if config.verbose:
         pbar.finish()
 
 
+def indexed_paths(paths: typing.Iterable[str], path: str) -> set:
+    """:returns: the paths under path, except the files of its index: writes to the index itself and the removal of
+    merged segments are not changes"""
+    return set(
+        x for x in paths if path_under(x, {path}) and not os.path.relpath(x, path).split(os.sep)[0].startswith(INDEX_DB)
+    )
+
+
+def watch(config: Config) -> None:
+    """Index the changes in config.index_dirs as they happen, bursts of changes are indexed together once they settle
+    for config.watch_debounce seconds"""
+    paths = [os.path.abspath(x) for x in config.index_dirs if os.path.isdir(x)]
+    watcher = get_watcher(paths, getattr(config, "watch_poll_interval", 30))
+    debounce = getattr(config, "watch_debounce", 2)
+    logging.info("Watching %s", paths)
+    try:
+        while True:
+            changes = watcher.changes(debounce, max_delay=getattr(config, "watch_max_delay", 30))
+            for path in paths:
+                if changes.rescan:
+                    index_do(path, config)
+                    continue
+                changed = indexed_paths(changes.changed, path)
+                deleted = indexed_paths(changes.deleted, path)
+                if changed or deleted:
+                    logging.debug("watch: '%s' %d changed %d deleted", path, len(changed), len(deleted))
+                    index_do(path, config, Changes(changed, deleted, False))
+    finally:
+        watcher.close()
+
+
+def start_server(config: Config) -> QueryServer:
+    """Start answering queries over the indexes of config.index_dirs on config.query_socket in a background thread.
+    The indexes and the tokenizer stay loaded between queries, changes made by the indexer are seen by the next query"""
+    indexes = get_indexes(config)
+    path = os.path.expanduser(getattr(config, "query_socket", None) or default_socket())
+    server = QueryServer(
+        path, indexes, getattr(config, "query_threads", 4), getattr(config, "query_parallel_reads", False)
+    )
+    threading.Thread(name="query server", target=server.serve_forever, daemon=True).start()
+    logging.info("Answering queries on %s", path)
+    return server
+
+
+def start_stats(config: Config) -> typing.Optional[StatsWriter]:
+    """Write the metrics of the indexing pipeline to config.stats_file every config.stats_interval seconds, see
+    fusearch.metrics. Off by default"""
+    path = getattr(config, "stats_file", "")
+    if not path:
+        return None
+    logging.info("Writing stats to %s", path)
+    return StatsWriter(os.path.expanduser(path), getattr(config, "stats_interval", 10))
+
+
+def start_metrics_server(config: Config) -> typing.Optional[MetricsServer]:
+    """Serve the metrics of the indexing pipeline in the Prometheus text format on config.metrics_address, host:port,
+    in a background thread"""
+    address = getattr(config, "metrics_address", None)
+    if not address:
+        return None
+    host, port = address.rsplit(":", 1)
+    server = MetricsServer((host, int(port)))
+    threading.Thread(name="metrics server", target=server.serve_forever, daemon=True).start()
+    logging.info("Serving metrics on http://%s/metrics", address)
+    return server
+
+
 def fusearch_main(args) -> int:
     logging.info("reading config from %s", args.config)
     config = Config.from_file(args.config)
     logging.info("%s", config)
-    for path in config.index_dirs:
-        index_do(path, config)
+    server = start_server(config) if args.serve else None
+    stats = start_stats(config)
+    metrics_server = start_metrics_server(config)
+    try:
+        for path in config.index_dirs:
+            index_do(path, config)
+        if args.watch:
+            watch(config)
+        elif server:
+            threading.Event().wait()
+    finally:
+        if server:
+            server.shutdown()
+            server.server_close()
+        if metrics_server:
+            metrics_server.shutdown()
+            metrics_server.server_close()
+        if stats:
+            stats.close()
 
 
 def script_name() -> str:
@@ -345,7 +745,7 @@ def main() -> int:
     parser = config_argparse()
     args = parser.parse_args()
     if not args.foreground:
-        return daemonize()
+        return daemonize(args)
     fusearch_main(args)
 
 
@@ -1,9 +1,8 @@
 from setuptools import find_packages, setup
 
-
 INSTALL_REQUIRES = ["textract", "nltk"]
 
-EXTRAS_REQUIRE = {"test": ["flake8", "black", "mock", "pre-commit", "pytest", "nose"]}
+EXTRAS_REQUIRE = {"test": ["flake8", "black", "mock", "pre-commit", "pytest", "nose"], "numpy": ["numpy"]}
 
 
 with open("README.md", "r") as f:
@@ -19,7 +18,9 @@ setup(
     license="Apache 2",
     keywords="search console fulltext documents",
     url="https://github.com/larroy/fusearch",
-    project_urls={"Source Code": "https://github.com/larroy/fusearch",},
+    project_urls={
+        "Source Code": "https://github.com/larroy/fusearch",
+    },
     packages=find_packages("src"),
     package_dir={"": "src"},
     long_description=LONG_DESCRIPTION,
@@ -33,6 +34,6 @@ setup(
         "Programming Language :: Python",
         "Programming Language :: Python :: 3.6",
     ],
-    package_data={},
-    scripts=["bin/fusearchd.py"],
+    package_data={"fusearch": ["data/*.txt"]},
+    scripts=["bin/fusearchd.py", "bin/fusearch"],
 )
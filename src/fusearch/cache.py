@@ -0,0 +1,65 @@
+from collections import OrderedDict, namedtuple
+import threading
+import typing
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "entries", "size", "max_entries", "max_size"])
+
+
+class LRUCache:
+    """Thread safe least recently used cache bounded by number of entries and total size of the values, the size of
+    each value is given by the caller"""
+
+    def __init__(self, max_entries: int, max_size: int):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = 0
+        # key -> (value, size)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size: int = 1) -> None:
+        if size > self.max_size or self.max_entries <= 0:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._entries[key] = (value, size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_size:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.size -= evicted_size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(self.hits, self.misses, len(self._entries), self.size, self.max_entries, self.max_size)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key) -> bool:
+        return key in self._entries
+
+
+def results_size(results: typing.Sequence[tuple]) -> int:
+    """:returns: approximate memory used by a list of (url, score) or (url, score, snippet)"""
+    # tuple, float and list slot overhead
+    size = 64 + sum(len(x[0]) + 120 for x in results)
+    # Snippet text and highlights
+    return size + sum(len(x[2].text) + 64 * len(x[2].highlights) + 120 for x in results if len(x) > 2 and x[2])
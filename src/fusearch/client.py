@@ -0,0 +1,88 @@
+"""Client of the query server of fusearchd, see :mod:`fusearch.server`
+
+Only depends on the standard library so that the command line client starts in milliseconds.
+"""
+
+import json
+import os
+import socket
+import typing
+
+SOCKET_NAME = "fusearch.sock"
+
+
+def default_socket() -> str:
+    """:returns: path of the query server socket, in the user's runtime directory when there's one"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir and os.path.isdir(runtime_dir):
+        return os.path.join(runtime_dir, SOCKET_NAME)
+    return os.path.join(os.path.expanduser("~/.cache/fusearch"), SOCKET_NAME)
+
+
+class QueryError(Exception):
+    """The server couldn't answer the query"""
+
+    pass
+
+
+class Client:
+    def __init__(self, path: str = None, timeout: float = 60):
+        """
+        :param path: socket of the server, defaults to :func:`default_socket`
+        :param timeout: seconds to wait for an answer
+        """
+        self.path = path or default_socket()
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Blocking connect, with a timeout it fails instead of waiting when the server's backlog is full
+        self.sock.connect(self.path)
+        self.sock.settimeout(timeout)
+        self.rfile = self.sock.makefile("rb")
+
+    def request(self, request: dict) -> dict:
+        """Send a request and wait for the answer, several requests can be sent over the same connection
+        :raises QueryError: when the server answers with an error
+        """
+        self.sock.sendall(json.dumps(request).encode() + b"\n")
+        line = self.rfile.readline()
+        if not line:
+            raise QueryError("connection closed by the server")
+        answer = json.loads(line)
+        if "error" in answer:
+            raise QueryError(answer["error"])
+        return answer
+
+    def query(
+        self, txt: str, k: int = 20, snippets: bool = False, boolean: bool = False, index: str = None
+    ) -> typing.List[dict]:
+        """:param boolean: query with operators, phrases and parentheses, see :meth:`fusearch.index.Searcher.search`,
+        by default a ranked query of the terms, see :meth:`fusearch.index.Searcher.top_k`
+        :param index: only query the index of this directory, by default all of them
+        :returns: list of results, dictionaries with url, score and with snippets, snippet, see
+        :class:`fusearch.model.Snippet`
+        """
+        request = {"query": txt, "k": k, "snippets": snippets, "boolean": boolean}
+        if index:
+            request["index"] = index
+        return self.request(request)["results"]
+
+    def close(self) -> None:
+        self.rfile.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def highlight(snippet: dict, before: str = "**", after: str = "**") -> str:
+    """Same as :func:`fusearch.snippets.highlight` for the snippets of the results of :meth:`Client.query`"""
+    parts = []
+    last = 0
+    text = snippet["text"]
+    for start, end in snippet["highlights"]:
+        parts.extend((text[last:start], before, text[start:end], after))
+        last = end
+    parts.append(text[last:])
+    return "".join(parts)
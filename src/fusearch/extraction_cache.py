@@ -0,0 +1,125 @@
+"""On disk cache of extracted text
+
+Text extraction, specially OCR, is much slower than tokenizing and indexing. Extracted text is cached in a sqlite
+database keyed by the sha1 of the file contents and the extractor version, so rebuilding an index or re-adding a file
+which was seen before skips extraction. The text is stored compressed and the least recently used entries are evicted
+when the compressed size exceeds the limit.
+
+The cache can be shared by several processes, each of them needs its own :class:`ExtractionCache`.
+"""
+
+import contextlib
+import logging
+import os
+import sqlite3
+import time
+import typing
+import zlib
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS entry (
+    key TEXT PRIMARY KEY,
+    text BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    atime REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entry_atime ON entry (atime);
+CREATE TABLE IF NOT EXISTS total (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    size INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO total VALUES (0, 0);
+"""
+
+
+class ExtractionCache:
+    def __init__(self, path: str, max_size: int = 1024 * 1024 * 1024, version: str = "", compress_level: int = 6):
+        """
+        :param path: sqlite database file, created if it doesn't exist
+        :param max_size: maximum size in bytes of the compressed text
+        :param version: extractor version, entries from other versions are not used
+        :param compress_level: zlib compression level
+        """
+        self.path = path
+        self.max_size = max_size
+        self.version = version
+        self.compress_level = compress_level
+        self.hits = 0
+        self.misses = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Autocommit, transactions are explicit
+        self.connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.executescript(SCHEMA)
+
+    def _key(self, file_sha: str) -> str:
+        return "{}:{}".format(self.version, file_sha)
+
+    def get(self, file_sha: str) -> typing.Optional[str]:
+        """:returns: the cached text of the file with the given sha1 or None"""
+        key = self._key(file_sha)
+        row = self.connection.execute("SELECT text FROM entry WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.connection.execute("UPDATE entry SET atime = ? WHERE key = ?", (time.time(), key))
+        return zlib.decompress(row[0]).decode(errors="surrogatepass")
+
+    def put(self, file_sha: str, text: str) -> None:
+        blob = zlib.compress(text.encode(errors="surrogatepass"), self.compress_level)
+        size = len(blob)
+        if size > self.max_size:
+            return
+        key = self._key(file_sha)
+        with self._transaction() as cursor:
+            old = cursor.execute("SELECT size FROM entry WHERE key = ?", (key,)).fetchone()
+            cursor.execute("INSERT OR REPLACE INTO entry VALUES (?, ?, ?, ?)", (key, blob, size, time.time()))
+            cursor.execute("UPDATE total SET size = size + ? WHERE id = 0", (size - (old[0] if old else 0),))
+            self._evict(cursor)
+
+    def _evict(self, cursor: sqlite3.Cursor) -> None:
+        total = cursor.execute("SELECT size FROM total WHERE id = 0").fetchone()[0]
+        if total <= self.max_size:
+            return
+        # Leave some room so not every put evicts
+        target = self.max_size * 9 // 10
+        evicted = 0
+        while total > target:
+            rows = cursor.execute("SELECT key, size FROM entry ORDER BY atime LIMIT 64").fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                cursor.execute("DELETE FROM entry WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+                if total <= target:
+                    break
+        cursor.execute("UPDATE total SET size = ? WHERE id = 0", (total,))
+        logging.debug("ExtractionCache: evicted %d entries, %d bytes", evicted, total)
+
+    @contextlib.contextmanager
+    def _transaction(self) -> typing.Generator[sqlite3.Cursor, None, None]:
+        cursor = self.connection.cursor()
+        # Take the write lock upfront, concurrent writers wait instead of failing to upgrade a read lock
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    @property
+    def size(self) -> int:
+        """:returns: total size of the compressed text"""
+        return self.connection.execute("SELECT size FROM total WHERE id = 0").fetchone()[0]
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM entry").fetchone()[0]
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,17 +1,51 @@
-from pony.orm import Database, LongStr, ObjectNotFound, Optional, PrimaryKey, Required, Set, db_session
+from pony.orm import Database, Optional, PrimaryKey, Required, commit, db_session, flush, select
 from .tokenizer import Tokenizer
+from . import migrate, postings, query
+from .cache import CacheInfo, LRUCache, results_size
+from .metrics import REGISTRY
+from .scoring import BM25, Scorer
+from .snippets import MAX_SNIPPETS, decode_offsets, encode_offsets, make_snippet
+from .terms import MAX_EXPANSIONS, TermDictionary
+from .topk import TermPostings, dense_scores, dense_top_k, max_score
 from collections import defaultdict
-from .util import uniq
-import math
+from .util import chunks, compress_text, decompress_text, uniq
 from .model import Result, Document
 import operator
 import logging
 import json
+import copy
 import hashlib
+import sqlite3
+import threading
+import time
 import typing
+import urllib.parse
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # TODO add typing
 
+# Maximum number of bound parameters in a single IN (...) lookup, sqlite limits them
+SQL_IN_CHUNK = 500
+# With numpy, top k queries with at least this many postings score all of them vectorized instead of pruning. Below
+# it, allocating the scores of every document costs more than pruning saves
+DENSE_MIN_POSTINGS = 2000
+
+# Pages in the write ahead log of Index(wal=True) after which a commit copies them to the database file. Larger than
+# sqlite's default of 1000, checkpoints are fewer and pages modified by several batches are written once
+CHECKPOINT_PAGES = 16384
+# Milliseconds to wait for the lock of the writer with WAL, opening an index writes the schema
+BUSY_TIMEOUT_MS = 60000
+
+# Columns copied by Index.merge_segment
+DOCUMENT_COLUMNS = '"id", "url_sha", "url", "filename", "mtime", "size", "content_sha", "file_sha", "tokfreq", "length"'
+TOKEN_COLUMNS = '"tok", "doc_freq", "num_docs", "last_doc", "postings", "max_tf", "max_tf_norm", "positions"'
+
 
 def sha1_mem(x):
     if type(x) is str:
@@ -21,48 +55,460 @@ def sha1_mem(x):
     return ctx.hexdigest()
 
 
-class Index:
+class Searcher(ABC):
+    """Ranked, top k and boolean queries over the postings provided by the subclass. Query methods open a db_session
+    and call the abstract data access methods inside it"""
+
+    def __init__(
+        self,
+        tokenizer: Tokenizer,
+        scorer: Scorer = None,
+        cache_entries: int = 1024,
+        cache_memory: int = 64 * 1024 * 1024,
+        collapse_duplicates: bool = False,
+    ):
+        self.tokenizer = tokenizer
+        self.scorer = scorer if scorer else BM25()
+        self.query_cache = LRUCache(cache_entries, cache_memory)
+        self.collapse_duplicates = collapse_duplicates
+        # Incremented on every modification of the index, cached results are only valid for their generation
+        self.generation = 0
+        # Queries can come from several threads, the query server's. They check for external changes and load the
+        # scorer statistics under the lock, then run without it
+        self._lock = threading.Lock()
+
+    @abstractmethod
+    def _check_external_changes(self) -> None:
+        """Start a new generation if the data changed since the last call"""
+        pass
+
+    @abstractmethod
+    def _load_scorer(self) -> None:
+        """Start a new generation if the data changed since the last call and load the scorer statistics if needed"""
+        pass
+
+    @abstractmethod
+    def _term_postings(self, toks: typing.List[str], arrays: bool = False) -> typing.List[tuple]:
+        """:returns: list of (tok, num_docs, max_tf, max_tf_norm, doc ids, tfs) for the toks present, sorted by the
+        utf-8 bytes of the toks. Scores are added in this order, so that rankings don't depend on how terms are stored
+        :param arrays: doc ids and tfs as numpy arrays instead of lists
+        """
+        pass
+
+    @abstractmethod
+    def _term_positions(self, toks: typing.List[str]) -> dict:
+        """:returns: dictionary of tok -> positions aligned with the postings, for the toks with positions"""
+        pass
+
+    @abstractmethod
+    def _match_terms(self, pattern, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        """:returns: up to limit (term, edit distance) of the terms matching a :mod:`fusearch.terms` pattern, sorted by
+        distance then term, see :meth:`terms.TermDictionary.expand`. Must be called inside a db_session"""
+        pass
+
+    @abstractmethod
+    def _urls(self, doc_ids: typing.Iterable[int]) -> dict:
+        """:returns: dictionary of doc id -> url"""
+        pass
+
+    @abstractmethod
+    def _file_shas(self, doc_ids: list) -> dict:
+        """:returns: dictionary of doc id -> file sha of the documents. Must be called inside a db_session"""
+        pass
+
+    @abstractmethod
+    def _stored_contents(self, urls: typing.List[str]) -> dict:
+        """:returns: dictionary of url -> (compressed content, encoded token offsets or None), must be called inside a
+        db_session"""
+        pass
+
+    def _with_snippets(self, results: list, toks: typing.Iterable[str], n: int) -> list:
+        """:returns: the (url, score) results as (url, score, snippet), the snippet is None after the first n, and after
+        the first :data:`snippets.MAX_SNIPPETS`"""
+        with db_session:
+            stored = self._stored_contents([x[0] for x in results[: min(n, MAX_SNIPPETS)]])
+        with_snippets = []
+        for url, score in results:
+            snippet = None
+            if url in stored:
+                blob, offsets = stored[url]
+                snippet = make_snippet(blob, offsets and decode_offsets(offsets, toks), toks, self.tokenizer)
+            with_snippets.append((url, score, snippet))
+        return with_snippets
+
+    def _collapse(self, results: list) -> list:
+        """:returns: the ranked (doc id, score) results without the documents which have the same file contents as a
+        better ranked one. Must be called inside a db_session"""
+        keys = self._file_shas([x[0] for x in results])
+        seen = set()
+        collapsed = []
+        for x in results:
+            # Documents without file sha are unique
+            key = keys.get(x[0]) or x[0]
+            if key not in seen:
+                seen.add(key)
+                collapsed.append(x)
+        return collapsed
+
+    @contextmanager
+    def _session(self):
+        """db_session of a query, the db_sessions nested in it are part of it"""
+        with db_session:
+            yield
+
+    def _new_generation(self) -> None:
+        self.generation += 1
+        self.query_cache.clear()
+
+    def _unload_scorer(self) -> None:
+        """Drop the scorer statistics. They are loaded again in a copy of the scorer, queries in progress keep the old
+        one"""
+        self.scorer = copy.copy(self.scorer)
+        self.scorer.unload()
+
+    def _loaded_scorer(self) -> typing.Tuple[int, Scorer]:
+        """Check for changes and load the scorer statistics under the lock, must be called inside the db_session of the
+        query, whose reads are from the snapshot the statistics were loaded from
+        :returns: (generation, scorer), the query uses the scorer without the lock
+        """
+        with self._lock:
+            self._load_scorer()
+            return self.generation, self.scorer
+
+    def _cached(self, key: tuple, compute: typing.Callable[[Scorer], list]) -> list:
+        """:returns: results for key from the query cache, computing and caching them on a miss"""
+        # A single db_session, the nested ones of compute are part of it and read the same snapshot
+        with self._session():
+            generation, scorer = self._loaded_scorer()
+            key = (generation,) + key
+            results = self.query_cache.get(key)
+            if results is None:
+                results = compute(scorer)
+                self.query_cache.put(key, results, results_size(results))
+        return list(results)
+
+    def cache_info(self) -> CacheInfo:
+        """:returns: query cache statistics"""
+        return self.query_cache.info()
+
+    def _expand(self, patterns: list) -> typing.List[str]:
+        """:returns: the terms matching any of the :mod:`fusearch.terms` patterns, at most MAX_EXPANSIONS for each"""
+        with self._lock:
+            with self._session():
+                self._check_external_changes()
+                return uniq(term for pattern in patterns for term, _ in self._match_terms(pattern, MAX_EXPANSIONS))
+
+    def _tokens(self, txt: str) -> typing.List[str]:
+        """:returns: the unique tokens of txt, words which are patterns, see :mod:`fusearch.query`, are replaced by the
+        terms they match"""
+        txt, patterns = query.split_patterns(txt, self.tokenizer.tokenize)
+        toks = list(self.tokenizer.tokenize(txt))
+        if patterns:
+            toks.extend(self._expand(patterns))
+        return uniq(toks)
+
+    def query(self, txt):
+        """Given a query string, return a list of search results"""
+        txt_tokens = self._tokens(txt)
+        with self._session():
+            _, scorer = self._loaded_scorer()
+            return self._query(txt_tokens, scorer)
+
+    def _query(self, txt_tokens: typing.List[str], scorer: Scorer):
+        logging.debug("Query tokens: %s", txt_tokens)
+        results = []
+        with self._session():
+            token_postings = self._term_postings(txt_tokens)
+            urls = self._urls(set(doc_id for x in token_postings for doc_id in x[4]))
+        for tok, num_docs, _, _, doc_ids, tfs in token_postings:
+            logging.debug("token: %s in %d documents", tok, num_docs)
+            weight = scorer.weight(num_docs)
+            for doc_id, tf in zip(doc_ids, tfs):
+                results.append(Result(tok=tok, tfidf=scorer.term_score(weight, tf, doc_id), url=urls[doc_id]))
+        return results
+
+    def rank(self, results):
+        """Convert list of Result to a ranked list of urls"""
+        by_doc = defaultdict(float)
+        for x in results:
+            by_doc[x.url] += x.tfidf
+        sorted_results = sorted(by_doc.items(), key=operator.itemgetter(1), reverse=True)
+        # urls = [x[0] for x in sorted_results]
+        return sorted_results
+
+    def ranked(self, txt, snippets: int = 0):
+        """Documents with any of the terms of txt ranked by score. Words ending in ``*`` match the terms with that
+        prefix, words with ``*`` wildcards match any characters there and words ending in ``~`` or ``~N`` the terms
+        within N edits, see :mod:`fusearch.query`
+
+        :param snippets: number of best ranked results with a snippet of the content, at most
+        :data:`snippets.MAX_SNIPPETS`, see :mod:`fusearch.snippets`
+        :returns: list of (url, score), or (url, score, snippet) when snippets are requested
+        """
+        txt_tokens = self._tokens(txt)
+        return self._cached(
+            ("ranked", tuple(sorted(txt_tokens)), snippets), lambda scorer: self._ranked(txt_tokens, scorer, snippets)
+        )
+
+    def _ranked(self, txt_tokens: typing.List[str], scorer: Scorer, snippets: int = 0):
+        if numpy is None:
+            ranked = self._ranked_scores(txt_tokens, scorer)
+        else:
+            ranked = self._ranked_arrays(txt_tokens, scorer)
+        with db_session:
+            if self.collapse_duplicates:
+                ranked = self._collapse(ranked)
+            urls = self._urls(doc_id for doc_id, _ in ranked)
+        ranked = [(urls[doc_id], score) for doc_id, score in ranked]
+        if snippets:
+            ranked = self._with_snippets(ranked, txt_tokens, snippets)
+        return ranked
+
+    def top_k(self, txt, k: int = 20, snippets: bool = False):
+        """Same ranking as :meth:`ranked` truncated to k results, without scoring the documents that can't make it to
+        the top k
+        :param snippets: add a snippet of the content to each result, None after :data:`snippets.MAX_SNIPPETS`
+        :returns: list of (url, score), or (url, score, snippet) with snippets
+        """
+        txt_tokens = self._tokens(txt)
+        return self._cached(
+            ("top_k", tuple(sorted(txt_tokens)), k, snippets),
+            lambda scorer: self._top_k(txt_tokens, scorer, k, snippets),
+        )
+
+    def _ranked_scores(self, txt_tokens: typing.List[str], scorer: Scorer) -> list:
+        """:returns: list of (doc id, score) of the documents with any of the tokens, sorted by descending score, ties by
+        ascending doc id. Like top k queries, scores are summed in the order of the terms of :meth:`_term_postings`, so
+        that the top k are the first k"""
+        with db_session:
+            token_postings = self._term_postings(txt_tokens)
+        scores = defaultdict(float)
+        for _, num_docs, _, _, doc_ids, tfs in token_postings:
+            weight = scorer.weight(num_docs)
+            for doc_id, tf in zip(doc_ids, tfs):
+                scores[doc_id] += scorer.term_score(weight, tf, doc_id)
+        return sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+
+    def _ranked_arrays(self, txt_tokens: typing.List[str], scorer: Scorer) -> list:
+        """Same as :meth:`_ranked_scores` with numpy, only the ranked documents go through Python"""
+        with db_session:
+            token_postings = self._term_postings(txt_tokens, arrays=True)
+        terms = [
+            TermPostings(weight=scorer.weight(num_docs), upper_bound=None, doc_ids=doc_ids, tfs=tfs)
+            for _, num_docs, _, _, doc_ids, tfs in token_postings
+        ]
+        positions, scores = dense_scores(terms, scorer.doc_ids, scorer.term_scores)
+        # Ties by position, which is by doc id
+        order = numpy.lexsort((positions, -scores))
+        return list(zip(scorer.doc_ids[positions[order]].tolist(), scores[order].tolist()))
+
+    def _top_n(
+        self, txt_tokens: typing.List[str], scorer: Scorer
+    ) -> typing.Callable[[int], typing.List[typing.Tuple[int, float]]]:
+        """:returns: function of n -> the n best (doc id, score) for the tokens, sorted by descending score, ties by
+        ascending doc id"""
+        with db_session:
+            token_postings = self._term_postings(txt_tokens, arrays=numpy is not None)
+        terms = []
+        for _, num_docs, max_tf, max_tf_norm, doc_ids, tfs in token_postings:
+            weight = scorer.weight(num_docs)
+            upper_bound = scorer.upper_bound(weight, max_tf, max_tf_norm)
+            terms.append(TermPostings(weight=weight, upper_bound=upper_bound, doc_ids=doc_ids, tfs=tfs))
+        if numpy is None:
+            return lambda n: max_score(terms, n, scorer.term_score)
+        if sum(len(x.doc_ids) for x in terms) >= DENSE_MIN_POSTINGS:
+            return lambda n: dense_top_k(terms, n, scorer.doc_ids, scorer.term_scores)
+        # Pruning reads the postings one by one, faster from lists
+        terms = [x._replace(doc_ids=x.doc_ids.tolist(), tfs=x.tfs.tolist()) for x in terms]
+        return lambda n: max_score(terms, n, scorer.term_score)
+
+    def _top_k(self, txt_tokens: typing.List[str], scorer: Scorer, k: int, snippets: bool = False):
+        top_n = self._top_n(txt_tokens, scorer)
+        n = k
+        while True:
+            top = top_n(n)
+            if not self.collapse_duplicates:
+                break
+            with db_session:
+                collapsed = self._collapse(top)
+            if len(collapsed) >= k or len(top) < n:
+                top = collapsed[:k]
+                break
+            # Not enough distinct documents in the top n
+            n *= 2
+        with db_session:
+            urls = self._urls(x[0] for x in top)
+        results = [(urls[doc_id], score) for doc_id, score in top]
+        if snippets:
+            results = self._with_snippets(results, txt_tokens, k)
+        return results
+
+    def search(self, txt, k: int = None, snippets: bool = False):
+        """Boolean query with AND, OR, NOT, parentheses, quoted phrases, prefixes, wildcards and fuzzy words, see
+        :mod:`fusearch.query`. Phrases need documents indexed with positions. Matching documents are ranked by the
+        terms which are not negated.
+
+        :param k: maximum number of results
+        :param snippets: add a snippet of the content to each result, highlighting the terms which are not negated, None
+        after :data:`snippets.MAX_SNIPPETS`
+        :returns: list of (url, score), or (url, score, snippet) with snippets
+        """
+        node = query.parse(txt, self.tokenizer.tokenize, self._expand)
+        if node is None:
+            return []
+        return self._cached(("search", node, k, snippets), lambda scorer: self._search(node, scorer, k, snippets))
+
+    def _search(self, node, scorer: Scorer, k: typing.Optional[int], snippets: bool = False):
+        with db_session:
+            token_postings = {x[0]: x for x in self._term_postings(list(query.tokens(node)))}
+            term_positions = self._term_positions(list(query.phrase_tokens(node)))
+        doc_ids = query.evaluate(
+            node,
+            {tok: x[4] for tok, x in token_postings.items()},
+            term_positions.get,
+            lambda: sorted(scorer.lengths),
+        )
+        scores = dict.fromkeys(doc_ids, 0.0)
+        for tok in query.positive_tokens(node):
+            if tok not in token_postings:
+                continue
+            _, num_docs, _, _, tok_doc_ids, tfs = token_postings[tok]
+            weight = scorer.weight(num_docs)
+            i = 0
+            for doc_id in doc_ids:
+                i = query.gallop(tok_doc_ids, doc_id, i)
+                if i == len(tok_doc_ids):
+                    break
+                if tok_doc_ids[i] == doc_id:
+                    scores[doc_id] += scorer.term_score(weight, tfs[i], doc_id)
+        ranked = sorted(scores.items(), key=lambda x: (-x[1], x[0]))
+        if self.collapse_duplicates:
+            with db_session:
+                ranked = self._collapse(ranked)
+        if k is not None:
+            ranked = ranked[:k]
+        with db_session:
+            urls = self._urls(doc_id for doc_id, _ in ranked)
+        results = [(urls[doc_id], score) for doc_id, score in ranked]
+        if snippets:
+            results = self._with_snippets(results, query.positive_tokens(node), len(results))
+        return results
+
+
+class Index(Searcher):
     """Inverted index implemented with Pony ORM"""
 
-    def __init__(self, bindargs, tokenizer: Tokenizer):
+    def __init__(
+        self,
+        bindargs,
+        tokenizer: Tokenizer,
+        scorer: Scorer = None,
+        cache_entries: int = 1024,
+        cache_memory: int = 64 * 1024 * 1024,
+        collapse_duplicates: bool = False,
+        wal: bool = False,
+        checkpoint_pages: int = CHECKPOINT_PAGES,
+    ):
         """
         :param bindargs: pony bind args such as {'provider':'sqlite', 'filename':':memory:'}
         :param tokenizer: A class implementing :class:`tokenizer.Tokenizer`
+        :param scorer: A class implementing :class:`scoring.Scorer`, defaults to :class:`scoring.BM25`
+        :param cache_entries: maximum number of cached query results, 0 disables the cache
+        :param cache_memory: approximate maximum memory in bytes used by cached query results
+        :param collapse_duplicates: only return the best ranked of the documents with the same file contents
+        :param wal: keep the database in write ahead log mode. Commits survive the writer being killed and queries
+        from other processes read a consistent snapshot while it writes. Without it there is no journal at all, which
+        is only safe for databases that can be rebuilt, a crash while writing can corrupt them
+        :param checkpoint_pages: with wal, pages in the log after which a commit copies them to the database file
         """
-        self.tokenizer = tokenizer
+        super().__init__(tokenizer, scorer, cache_entries, cache_memory, collapse_duplicates)
         # set_sql_debug(True)
 
         db = Database()
         self.db = db
+        # Every thread has its own in memory database
+        self.in_memory = bindargs.get("filename") == ":memory:"
+        self.wal = wal and not self.in_memory
+        # The sqlite connection of each thread, see _read_transaction, and the PRAGMA data_version it last saw, see
+        # _check_external_changes
+        self._connections = threading.local()
 
         @db.on_connect(provider="sqlite")
-        def sqlite_sync_off(db, connection):
+        def sqlite_pragmas(db, connection):
             cursor = connection.cursor()
-            cursor.execute("PRAGMA synchronous = OFF")
             cursor.execute("PRAGMA cache_size = 64000")
-            cursor.execute("PRAGMA journal_mode = OFF")
+            if self.wal:
+                cursor.execute("PRAGMA journal_mode = WAL")
+                # Only checkpoints sync, a commit can be lost on power failure but the database isn't corrupted
+                cursor.execute("PRAGMA synchronous = NORMAL")
+                cursor.execute("PRAGMA wal_autocheckpoint = {:d}".format(checkpoint_pages))
+                cursor.execute("PRAGMA busy_timeout = {:d}".format(BUSY_TIMEOUT_MS))
+            else:
+                cursor.execute("PRAGMA synchronous = OFF")
+                # Databases in WAL mode stay in it, other connections can be using them
+                if cursor.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+                    cursor.execute("PRAGMA journal_mode = OFF")
+            self._connections.connection = connection
+            # PRAGMA data_version is only comparable between calls on the same connection
+            self._connections.data_version = None
 
         class Token(db.Entity):
             tok = Required(str, unique=True)
+            # Total occurrences of the token in the collection
             doc_freq = Required(int)
-            documents = Set("Document")
+            # Number of documents in postings
+            num_docs = Required(int)
+            # Last doc id in postings, base for appending to the delta encoding
+            last_doc = Required(int)
+            # See :mod:`fusearch.postings`
+            postings = Required(bytes)
+            # Upper bounds of tf and tf / length in postings, for top k pruning
+            max_tf = Required(int)
+            max_tf_norm = Required(float)
+            # Token positions aligned with postings, see :func:`fusearch.postings.encode_positions`. Only present
+            # when documents with positions have been added
+            positions = Optional(bytes)
 
         class Document(db.Entity):
-            # url = pony.orm.core.Index(Required(str))
-            url_sha = PrimaryKey(str)
+            # Dense integer id referenced by the postings
+            id = PrimaryKey(int, auto=True)
+            url_sha = Required(str, unique=True)
             url = Required(str, unique=True)
             filename = Required(str)
             mtime = Required(int)
-            content = Optional(LongStr)
+            size = Optional(int)
+            # The text is in Content
             content_sha = Optional(str)
-            tokens = Set("Token")
+            # sha1 of the raw file, to reuse the extracted text of copies and moves
+            file_sha = Optional(str, index=True, nullable=True)
             tokfreq = Required(bytes)
+            # Number of tokens counting repetitions, the document length of the scorer
+            length = Required(int)
+
+        class Content(db.Entity):
+            # Extracted text of the documents, apart from Document so that queries and scans of the documents don't
+            # read it. Loaded only on request, see :meth:`Index.content`
+            id = PrimaryKey(int)
+            # See :func:`fusearch.util.compress_text`
+            text = Required(bytes)
+            # Offsets of the first occurrences of the tokens, see :func:`fusearch.snippets.encode_offsets`
+            offsets = Optional(bytes)
 
         self.Token = Token
         self.Document = Document
+        self.Content = Content
+        # Terms for pattern queries, built on first use, see _term_dictionary
+        self._terms = None
+        # Generation and largest Token id the term dictionary is up to date with
+        self._terms_generation = None
+        self._terms_last_id = 0
         db.bind(**bindargs)
+        legacy = migrate.upgrade(db)
         db.generate_mapping(create_tables=True)
         self.update()
+        if legacy:
+            migrate.import_legacy(self)
+        migrate.stamp(db)
 
     def mtime(self, url: str) -> typing.Optional[int]:
         """:returns mtime of the given url or None if not found"""
@@ -74,75 +520,462 @@ class Index:
         else:
             return None
 
+    def file_states(self) -> typing.Dict[str, typing.Tuple[int, typing.Optional[int]]]:
+        """:returns: dictionary of url -> (mtime, size) of all the documents, size can be None"""
+        with db_session:
+            return {url: (mtime, size) for url, mtime, size in select((x.url, x.mtime, x.size) for x in self.Document)}
+
+    def file_sizes(self) -> set:
+        """:returns: sizes of the documents with a known file sha, only files with these sizes can be copies"""
+        with db_session:
+            return set(select(x.size for x in self.Document if x.file_sha is not None))
+
+    def has_file_sha(self, file_sha: str) -> bool:
+        with db_session:
+            return self.Document.exists(file_sha=file_sha)
+
+    def documents_by_file_sha(self, file_shas: typing.Iterable[str]) -> typing.Dict[str, Document]:
+        """:returns: dictionary of file sha -> one of the documents with that file sha, for the ones in the index"""
+        result = {}
+        with db_session:
+            for chunk in chunks(set(file_shas), SQL_IN_CHUNK):
+                docs = {doc.file_sha: doc for doc in self.Document.select(lambda x: x.file_sha in chunk)}
+                stored = self._stored_contents([doc.url for doc in docs.values()])
+                for doc in docs.values():
+                    text, offsets = stored.get(doc.url, (None, None))
+                    result[doc.file_sha] = Document(
+                        url=doc.url,
+                        filename=doc.filename,
+                        content=decompress_text(text) if text else None,
+                        tokfreq=json.loads(doc.tokfreq),
+                        mtime=doc.mtime,
+                        size=doc.size,
+                        file_sha=doc.file_sha,
+                        offsets=decode_offsets(offsets) if offsets else None,
+                    )
+        return result
+
     def document_from_url(self, url: str) -> dict:
         """Raises ObjectNotFound when there's no such document or a dictionary with the Document entity when found"""
-        url_sha = None
         url_sha = sha1_mem(url)
         with db_session:
-            try:
-                document = self.Document[url_sha]
+            document = self.Document.get(url_sha=url_sha)
+            if document:
                 return document.to_dict()
-            except ObjectNotFound as ex:
-                return None
+            return None
+
+    def content(self, url: str) -> typing.Optional[str]:
+        """:returns: extracted text of the document with the given url, None if not found"""
+        url_sha = sha1_mem(url)
+        with db_session:
+            doc_ids = self.db.select('"id" FROM "Document" WHERE "url_sha" = $url_sha')
+            return self._contents(doc_ids).get(doc_ids[0]) if doc_ids else None
+
+    def _contents(self, doc_ids: typing.Iterable[int]) -> typing.Dict[int, str]:
+        """:returns: dictionary of doc id -> extracted text, must be called inside a db_session"""
+        contents = {}
+        for chunk in chunks(doc_ids, SQL_IN_CHUNK):
+            for doc_id, blob in select((x.id, x.text) for x in self.Content if x.id in chunk):
+                contents[doc_id] = decompress_text(blob)
+        return contents
 
     def add_document(self, document: Document):
-        # tokens = self.tokenizer.tokenize(document.content)
-        url_sha = sha1_mem(document.url)
-        content_sha = sha1_mem(document.content)
-        with db_session:
-            doc = self.Document(
-                url=document.url,
-                url_sha=url_sha,
-                filename=document.filename,
-                mtime=document.mtime,
-                content=document.content,
-                content_sha=content_sha,
-                tokfreq=json.dumps(document.tokfreq).encode(),
-            )
+        """Add a document, replacing the one with the same url. Unlike :meth:`add_documents`, a document that can't be
+        added raises the exception"""
+        self._add_batch([document])
+
+    def add_documents(self, documents: typing.Iterable[Document], batch_size: int = 256) -> int:
+        """Add a stream of documents to the index. The tokens of each batch are resolved in bulk and each batch is
+        committed in a single transaction. Documents with an url already in the index replace the existing one.
+
+        :param documents: iterable of :class:`model.Document`
+        :param batch_size: number of documents per transaction
+        :returns: number of documents added
+        """
+        added = 0
+        for batch in chunks(documents, batch_size):
+            try:
+                self._add_batch(batch)
+                added += len(batch)
+            except Exception:
+                if len(batch) == 1:
+                    logging.exception("add_documents: exception adding Document[%s]", batch[0].url)
+                    continue
+                # Don't lose the whole batch because of a single bad document
+                logging.exception("add_documents: batch of %d documents failed, retrying one by one", len(batch))
+                for document in batch:
+                    try:
+                        self._add_batch([document])
+                        added += 1
+                    except Exception:
+                        logging.exception("add_documents: exception adding Document[%s]", document.url)
+        return added
+
+    def remove_documents(self, urls: typing.Iterable[str]) -> int:
+        """Remove documents from the index, urls which are not in the index are ignored
+        :returns: number of documents removed
+        """
+        with db_session:
+            removed, deleted_toks = self._remove_documents([sha1_mem(url) for url in urls])
+        self._removed(removed, deleted_toks)
+        return len(removed)
+
+    def _removed(self, removed: typing.List[int], deleted_toks: typing.List[str]) -> None:
+        """Update the statistics and the term dictionary after removing documents and deleting the tokens which were
+        only in them"""
+        if deleted_toks and self._terms is not None:
+            # Before the new generation, which makes the next query sync the dictionary
+            with self._lock:
+                self._terms.remove(deleted_toks)
+        self.doc_count -= len(removed)
+        self._new_generation()
+        if self.scorer.loaded:
+            for doc_id in removed:
+                self.scorer.remove(doc_id)
+
+    def _add_batch(self, batch: typing.List[Document]) -> None:
+        # When an url is repeated in the batch the last one wins
+        by_url = {document.url: document for document in batch}
+        doc_freq = defaultdict(int)
+        new_postings = defaultdict(list)
+        max_tf = defaultdict(int)
+        tf_norm = defaultdict(float)
+        new_positions = defaultdict(list)
+        start = time.perf_counter()
+        with db_session:
+            removed, deleted_toks = self._remove_documents([sha1_mem(url) for url in by_url])
+            docs = []
+            for url, document in by_url.items():
+                doc = self.Document(
+                    url=url,
+                    url_sha=sha1_mem(url),
+                    filename=document.filename,
+                    mtime=document.mtime,
+                    size=document.size,
+                    content_sha=sha1_mem(document.content),
+                    file_sha=document.file_sha,
+                    tokfreq=json.dumps(document.tokfreq).encode(),
+                    length=sum(document.tokfreq.values()),
+                )
+                docs.append((doc, document))
+            # Assigns doc ids
+            flush()
+            for doc, document in docs:
+                # Attribute access on pony entities is slow, not done per token
+                doc_id = doc.id
+                length = max(doc.length, 1)
+                if document.content:
+                    offsets = None
+                    if document.offsets is not None:
+                        offsets = encode_offsets(document.offsets)
+                    self.Content(id=doc_id, text=compress_text(document.content), offsets=offsets)
+                for tok, freq in document.tokfreq.items():
+                    doc_freq[tok] += freq
+                    new_postings[tok].append((doc_id, freq))
+                    max_tf[tok] = max(max_tf[tok], freq)
+                    tf_norm[tok] = max(tf_norm[tok], freq / length)
+                    if document.positions is not None:
+                        new_positions[tok].append((doc_id, document.positions.get(tok, [])))
 
-            for tok, freq in document.tokfreq.items():
-                token = self.Token.get(tok=tok)
+            tokens = self._get_tokens(doc_freq.keys())
+            for tok, freq in doc_freq.items():
+                doc_ids, tfs = zip(*sorted(new_postings[tok]))
+                positions = self._aligned_positions(doc_ids, new_positions.get(tok))
+                token = tokens.get(tok)
                 if token:
+                    if positions or token.positions:
+                        # Postings without positions have an empty list of positions
+                        token.positions = (token.positions or b"\0" * token.num_docs) + (
+                            positions or b"\0" * len(doc_ids)
+                        )
+                    token.postings += postings.encode(doc_ids, tfs, base=token.last_doc)
                     token.doc_freq += freq
-                    token.documents += doc
+                    token.num_docs += len(doc_ids)
+                    token.last_doc = doc_ids[-1]
+                    token.max_tf = max(token.max_tf, max_tf[tok])
+                    token.max_tf_norm = max(token.max_tf_norm, tf_norm[tok])
                 else:
-                    self.Token(tok=tok, doc_freq=freq, documents=doc)
-        self.doc_count += 1
+                    self.Token(
+                        tok=tok,
+                        doc_freq=freq,
+                        num_docs=len(doc_ids),
+                        last_doc=doc_ids[-1],
+                        postings=postings.encode(doc_ids, tfs),
+                        max_tf=max_tf[tok],
+                        max_tf_norm=tf_norm[tok],
+                        positions=positions,
+                    )
+            lengths = [(doc.id, doc.length) for doc, _ in docs]
+            self._commit(start, "batch", len(docs))
+        self._added(lengths, removed, deleted_toks)
+
+    def _added(
+        self, lengths: typing.List[typing.Tuple[int, int]], removed: typing.List[int], deleted_toks: typing.List[str]
+    ) -> None:
+        """Update the statistics after adding documents with the given (doc id, length) replacing the removed ones.
+        New tokens are added to the term dictionary on its next use"""
+        self.doc_count += len(lengths)
+        self._removed(removed, deleted_toks)
+        if self.scorer.loaded:
+            for doc_id, length in lengths:
+                self.scorer.add(doc_id, length)
+
+    def merge_segment(self, path: str) -> int:
+        """Move the documents of a segment, an index database built separately by :class:`Index`, to this index.
+        Documents with an url already in the index replace the existing ones. Segment doc ids are shifted past the
+        ones ever used in this index, so its postings are appended without decoding them. Rows are copied with plain
+        SQL, creating an entity for each of them would cost more than indexing the documents.
+
+        :param path: segment database file, it's not modified
+        :returns: number of documents merged
+        """
+        segment = sqlite3.connect("file:{}?mode=ro".format(urllib.parse.quote(path)), uri=True)
+        try:
+            docs = segment.execute('SELECT {} FROM "Document" ORDER BY "id"'.format(DOCUMENT_COLUMNS)).fetchall()
+            tokens = segment.execute('SELECT {} FROM "Token"'.format(TOKEN_COLUMNS)).fetchall()
+            contents = segment.execute('SELECT "id", "text", "offsets" FROM "Content"').fetchall()
+        finally:
+            segment.close()
+        if not docs:
+            return 0
+        start = time.perf_counter()
+        with db_session:
+            removed, deleted_toks = self._remove_documents([x[1] for x in docs])
+            offset = self.db.select("coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'Document'")[0]
+            connection = self.db.get_connection()
+            connection.executemany(
+                'INSERT INTO "Document" ({}) VALUES ({})'.format(DOCUMENT_COLUMNS, ", ".join("?" * len(docs[0]))),
+                ((offset + x[0],) + x[1:] for x in docs),
+            )
+            connection.executemany(
+                'INSERT INTO "Content" ("id", "text", "offsets") VALUES (?, ?, ?)',
+                ((offset + x[0],) + x[1:] for x in contents),
+            )
+            existing = {}
+            for chunk in chunks([x[0] for x in tokens], SQL_IN_CHUNK):
+                rows = connection.execute(
+                    'SELECT {} FROM "Token" WHERE "tok" IN ({})'.format(TOKEN_COLUMNS, ", ".join("?" * len(chunk))),
+                    chunk,
+                )
+                existing.update((x[0], x) for x in rows)
+            updates = []
+            inserts = []
+            for tok, doc_freq, num_docs, last_doc, blob, max_tf, max_tf_norm, positions in tokens:
+                token = existing.get(tok)
+                if token:
+                    _, old_freq, old_num_docs, old_last_doc, old_blob, old_max_tf, old_tf_norm, old_positions = token
+                    if positions or old_positions:
+                        # Postings without positions have an empty list of positions
+                        positions = (old_positions or b"\0" * old_num_docs) + (positions or b"\0" * num_docs)
+                    updates.append(
+                        (
+                            old_freq + doc_freq,
+                            old_num_docs + num_docs,
+                            offset + last_doc,
+                            old_blob + postings.rebase(blob, offset, old_last_doc),
+                            max(old_max_tf, max_tf),
+                            max(old_tf_norm, max_tf_norm),
+                            positions,
+                            tok,
+                        )
+                    )
+                else:
+                    blob = postings.rebase(blob, offset, 0)
+                    inserts.append((tok, doc_freq, num_docs, offset + last_doc, blob, max_tf, max_tf_norm, positions))
+            connection.executemany(
+                'UPDATE "Token" SET "doc_freq" = ?, "num_docs" = ?, "last_doc" = ?, "postings" = ?, "max_tf" = ?, '
+                '"max_tf_norm" = ?, "positions" = ? WHERE "tok" = ?',
+                updates,
+            )
+            connection.executemany(
+                'INSERT INTO "Token" ({}) VALUES ({})'.format(TOKEN_COLUMNS, ", ".join("?" * 8)), inserts
+            )
+            self._commit(start, "segment", len(docs))
+        self._added([(offset + x[0], x[-1]) for x in docs], removed, deleted_toks)
+        return len(docs)
+
+    @staticmethod
+    def _commit(start: float, source: str, documents: int) -> None:
+        """Commit the db_session, recording the time spent since start inserting the documents and committing"""
+        REGISTRY.observe("fusearch_index_insert_seconds", time.perf_counter() - start, source=source)
+        with REGISTRY.timer("fusearch_commit_seconds"):
+            commit()
+        REGISTRY.inc("fusearch_documents_indexed_total", documents, source=source)
+
+    @staticmethod
+    def _aligned_positions(doc_ids: typing.List[int], doc_positions: typing.List[tuple]) -> typing.Optional[bytes]:
+        """:returns: encoded positions for the postings doc_ids given a list of (doc id, positions) or None"""
+        if not doc_positions:
+            return None
+        by_doc = dict(doc_positions)
+        return postings.encode_positions(by_doc.get(doc_id, []) for doc_id in doc_ids)
+
+    def _get_tokens(self, toks: typing.Iterable[str]) -> dict:
+        """:returns: dictionary of tok -> Token entity for the given toks which exist in the index"""
+        tokens = {}
+        for chunk in chunks(toks, SQL_IN_CHUNK):
+            for token in self.Token.select(lambda x: x.tok in chunk):
+                tokens[token.tok] = token
+        return tokens
+
+    def _remove_documents(self, url_shas: typing.List[str]) -> typing.Tuple[typing.List[int], typing.List[str]]:
+        """Remove documents and their postings, must be called inside a db_session
+        :returns: ids of the removed documents and the tokens deleted because they were only in them"""
+        removed = []
+        deleted_toks = []
+        removed_postings = defaultdict(set)
+        removed_freq = defaultdict(int)
+        for chunk in chunks(url_shas, SQL_IN_CHUNK):
+            for doc in self.Document.select(lambda x: x.url_sha in chunk):
+                for tok, freq in json.loads(doc.tokfreq).items():
+                    removed_postings[tok].add(doc.id)
+                    removed_freq[tok] += freq
+                removed.append(doc.id)
+                doc.delete()
+        for chunk in chunks(removed, SQL_IN_CHUNK):
+            self.Content.select(lambda x: x.id in chunk).delete(bulk=True)
+        for tok, token in self._get_tokens(removed_postings.keys()).items():
+            if token.positions:
+                doc_ids, _ = postings.decode(token.postings)
+                token.positions = postings.remove_positions(token.positions, doc_ids, removed_postings[tok])
+            blob, num_docs, last_doc = postings.remove(token.postings, removed_postings[tok])
+            if num_docs:
+                token.postings = blob
+                token.num_docs = num_docs
+                token.last_doc = last_doc
+                token.doc_freq -= removed_freq[tok]
+            else:
+                token.delete()
+                deleted_toks.append(tok)
+        if removed:
+            # Deletions need to reach the db before inserting documents with the same url
+            flush()
+        return removed, deleted_toks
 
     def update(self):
         with db_session:
             self.doc_count = self.Document.select().count()
+        self._unload_scorer()
+        self._new_generation()
 
-    def query(self, txt):
-        """Given a query string, return a list of search results"""
-        txt_tokens = uniq(self.tokenizer.tokenize(txt))
-        logging.debug("Query tokens: %s", txt_tokens)
-        results = []
-        with db_session:
-            tokens = self.Token.select(lambda x: x.tok in txt_tokens)
-            for token in tokens:
-                numdocs_t = len(token.documents)
-                logging.debug("token: %s in %d documents", token, numdocs_t)
-                for document in token.documents:
-                    try:
-                        tokfreq = json.loads(document.tokfreq)
-                    except RuntimeError as e:
-                        logging.error("json.loads WTF?")
-                    tok = token.tok
-                    numtok = 1 if len(tokfreq) == 0 else len(tokfreq)
-                    tfidf = tokfreq.get(tok, 0) * math.log(self.doc_count / numdocs_t) / numtok
-                    results.append(Result(tok=tok, tfidf=tfidf, url=document.url))
-        return results
+    def checkpoint(self) -> None:
+        """With wal, copy the log to the database file and truncate it, waiting for the readers of old pages. Commits
+        only copy it once it's checkpoint_pages long. Can't be called inside a db_session"""
+        if not self.wal:
+            return
+        connection, _ = self.db.provider.connect()
+        try:
+            with REGISTRY.timer("fusearch_checkpoint_seconds"):
+                busy, pages, _ = connection.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()
+        finally:
+            self.db.provider.release(connection)
+        if busy:
+            logging.warning("checkpoint: readers are using the log, %d pages not truncated", pages)
 
-    def rank(self, results):
-        """Convert list of Result to a ranked list of urls"""
-        by_doc = defaultdict(float)
-        # Is this the best way to combine TFIDF? probably not
-        for x in results:
-            by_doc[x.url] += x.tfidf
-        sorted_results = sorted(by_doc.items(), key=operator.itemgetter(1), reverse=True)
-        # urls = [x[0] for x in sorted_results]
-        return sorted_results
+    def _read_transaction(self) -> sqlite3.Connection:
+        """Start a read transaction if there isn't one, so that the rest of the db_session reads a single snapshot of
+        the database. Unlike the write transactions of db.get_connection it doesn't lock out writers, with wal. It ends
+        with the db_session, which must not modify the database. Must be called inside a db_session
+        :returns: the sqlite connection of the db_session
+        """
+        # Connects if needed, the connection is released, ending the transaction, with the db_session
+        self.db.select("1")
+        connection = self._connections.connection
+        if not connection.in_transaction:
+            connection.execute("BEGIN")
+        return connection
+
+    def _check_external_changes(self) -> None:
+        """Drop cached statistics and results when another connection has modified the database since the connection
+        of this thread last checked. A new connection can't tell what the others saw, they are dropped on its first
+        check. Starts the read transaction of the queries in the db_session, see :meth:`_read_transaction`. Must be
+        called inside a db_session"""
+        data_version = self._read_transaction().execute("PRAGMA data_version").fetchone()[0]
+        if data_version != self._connections.data_version:
+            self._connections.data_version = data_version
+            self._unload_scorer()
+            self._new_generation()
+
+    def _term_dictionary(self) -> TermDictionary:
+        """:returns: the dictionary of the tokens, built on first use. After changes, tokens with an id past the last
+        one seen are added, the ones deleted by this index were removed already. If some were deleted by another
+        connection it's rebuilt. Must be called inside a db_session"""
+        if self._terms is not None and self._terms_generation == self.generation:
+            return self._terms
+        connection = self._read_transaction()
+        last_id, count = connection.execute('SELECT coalesce(max("id"), 0), count(*) FROM "Token"').fetchone()
+        if self._terms is not None:
+            self._terms.add(
+                x for x, in connection.execute('SELECT "tok" FROM "Token" WHERE "id" > ?', (self._terms_last_id,))
+            )
+        if self._terms is None or len(self._terms) != count:
+            self._terms = TermDictionary(x for x, in connection.execute('SELECT "tok" FROM "Token"'))
+        self._terms_generation = self.generation
+        self._terms_last_id = last_id
+        return self._terms
+
+    def _match_terms(self, pattern, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        """:returns: up to limit (term, edit distance) of the terms matching a :mod:`fusearch.terms` pattern, sorted by
+        distance then term. Must be called inside a db_session"""
+        return self._term_dictionary().expand(pattern, limit)
+
+    def _load_scorer(self) -> None:
+        """Load the scorer statistics if needed, must be called inside a db_session"""
+        self._check_external_changes()
+        if not self.scorer.loaded:
+            self.scorer.load(select((x.id, x.length) for x in self.Document)[:])
+            self.doc_count = self.scorer.doc_count
+
+    def _term_postings(self, toks: typing.List[str], arrays: bool = False) -> typing.List[tuple]:
+        """:returns: list of (tok, num_docs, max_tf, max_tf_norm, doc ids, tfs) for the toks present in the index,
+        sorted by tok, must be called inside a db_session
+        :param arrays: doc ids and tfs as numpy arrays instead of lists
+        """
+        rows = []
+        for chunk in chunks(toks, SQL_IN_CHUNK):
+            rows.extend(
+                select((x.tok, x.num_docs, x.max_tf, x.max_tf_norm, x.postings) for x in self.Token if x.tok in chunk)
+            )
+        # Like sqlite, which compares text with memcmp, sorted by the utf-8 bytes of the toks
+        rows.sort(key=lambda x: x[0].encode(errors="surrogatepass"))
+        decode = postings.decode_arrays if arrays else postings.decode
+        return [
+            (tok, num_docs, max_tf, max_tf_norm) + decode(blob) for tok, num_docs, max_tf, max_tf_norm, blob in rows
+        ]
+
+    def _urls(self, doc_ids: typing.Iterable[int]) -> dict:
+        """:returns: dictionary of doc id -> url, must be called inside a db_session"""
+        urls = {}
+        for chunk in chunks(doc_ids, SQL_IN_CHUNK):
+            urls.update(select((x.id, x.url) for x in self.Document if x.id in chunk))
+        return urls
+
+    def _stored_contents(self, urls: typing.List[str]) -> dict:
+        """:returns: dictionary of url -> (compressed content, encoded token offsets or None), must be called inside a
+        db_session"""
+        stored = {}
+        for chunk in chunks(urls, SQL_IN_CHUNK):
+            rows = select(
+                (d.url, c.text, c.offsets)
+                for d in self.Document
+                for c in self.Content
+                if c.id == d.id and d.url in chunk
+            )
+            stored.update((url, (text, offsets)) for url, text, offsets in rows)
+        return stored
+
+    def _file_shas(self, doc_ids: list) -> dict:
+        """:returns: dictionary of doc id -> file sha of the documents, must be called inside a db_session"""
+        file_shas = {}
+        for chunk in chunks(doc_ids, SQL_IN_CHUNK):
+            file_shas.update(select((x.id, x.file_sha) for x in self.Document if x.id in chunk))
+        return file_shas
 
-    def ranked(self, txt):
-        return self.rank(self.query(txt))
+    def _term_positions(self, toks: typing.List[str]) -> dict:
+        """:returns: dictionary of tok -> positions aligned with the postings, for the toks with positions. Must be
+        called inside a db_session"""
+        positions = {}
+        for chunk in chunks(toks, SQL_IN_CHUNK):
+            rows = select((x.tok, x.positions) for x in self.Token if x.tok in chunk and x.positions is not None)
+            positions.update((tok, postings.decode_positions(blob)) for tok, blob in rows)
+        return positions
@@ -0,0 +1,349 @@
+"""Metrics of the indexing pipeline
+
+Counters, latency histograms and gauges, identified by a name and labels. Every process records into its own
+:data:`REGISTRY`. Worker processes of the pipeline call :func:`start_worker` with a queue, their metrics are sent
+through it every ``interval`` seconds and when they finish, and the parent merges them with :func:`merge_from`, so the
+registry of the main process has the metrics of the whole pipeline. They are exported in the Prometheus text format by
+:class:`MetricsServer` and written to a JSON file by :class:`StatsWriter`.
+
+Histograms have fixed buckets, they are merged by adding their counts. Quantiles in the stats file are the upper
+bounds of the buckets they fall in.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import http.server
+import json
+import logging
+import math
+import os
+import queue as queue_module
+import socketserver
+import threading
+import time
+import typing
+
+#: Upper bounds in seconds of the histogram buckets, the last one counts everything
+BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    120.0,
+    math.inf,
+)
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class Histogram:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, counts: typing.List[int] = None, sum: float = 0.0):
+        self.counts = counts or [0] * len(BUCKETS)
+        self.sum = sum
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+
+    def merge(self, counts: typing.List[int], sum: float) -> None:
+        for i, count in enumerate(counts):
+            self.counts[i] += count
+        self.sum += sum
+
+    def quantile(self, q: float) -> float:
+        """:returns: upper bound of the bucket of the q quantile, 0 when empty"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return (
+        "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+    )
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # (name, sorted labels) -> value
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        # (name, sorted labels) -> function returning the current value, sampled into gauges
+        self._gauge_functions = {}
+        # Worker processes send their metrics to the parent through this queue
+        self._queue = None
+        self._interval = 0
+        self._last_send = 0
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+        self._maybe_send()
+
+    def observe(self, name: str, seconds: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+        self._maybe_send()
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe the duration of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def set_gauge(self, name: str, value: float, **labels) -> None:
+        with self._lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def gauge_function(self, name: str, function: typing.Optional[typing.Callable[[], float]], **labels) -> None:
+        """Sample function into the gauge name and its maximum into name_max, None to stop sampling"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            if function is None:
+                self._gauge_functions.pop(key, None)
+            else:
+                self._gauge_functions[key] = function
+
+    def sample(self) -> None:
+        """Update the gauges with functions"""
+        with self._lock:
+            functions = list(self._gauge_functions.items())
+        for (name, labels), function in functions:
+            try:
+                value = function()
+            except (NotImplementedError, OSError, ValueError):
+                # qsize is not implemented on some platforms, the queue can be closed
+                continue
+            with self._lock:
+                self.gauges[(name, labels)] = value
+                max_key = (name + "_max", labels)
+                self.gauges[max_key] = max(self.gauges.get(max_key, value), value)
+
+    def take(self) -> dict:
+        """:returns: the counters and histograms as plain data to pass to :meth:`merge`, and reset them"""
+        with self._lock:
+            data = {
+                "counters": self.counters,
+                "histograms": {key: (x.counts, x.sum) for key, x in self.histograms.items()},
+                "gauges": self.gauges,
+            }
+            self.counters = {}
+            self.histograms = {}
+            self.gauges = {}
+        return data
+
+    def merge(self, data: dict) -> None:
+        """Add metrics returned by :meth:`take` in another process"""
+        with self._lock:
+            for key, value in data["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, sum) in data["histograms"].items():
+                histogram = self.histograms.get(key)
+                if histogram is None:
+                    histogram = self.histograms[key] = Histogram()
+                histogram.merge(counts, sum)
+            for key, value in data["gauges"].items():
+                if key[0].endswith("_max"):
+                    value = max(self.gauges.get(key, value), value)
+                self.gauges[key] = value
+
+    def start_worker(self, queue, interval: float = 5) -> None:
+        """Send the metrics to queue from now on, every interval seconds and on :meth:`send`. Forked processes inherit
+        the metrics of their parent, they are dropped"""
+        # The lock could have been held by another thread of the parent when forking
+        self._lock = threading.Lock()
+        self.take()
+        self._gauge_functions = {}
+        self._queue = queue
+        self._interval = interval
+        self._last_send = time.monotonic()
+
+    def _maybe_send(self) -> None:
+        if self._queue is not None and time.monotonic() - self._last_send >= self._interval:
+            self.send()
+
+    def send(self) -> None:
+        """Send the metrics recorded since the last time to the queue of :meth:`start_worker`"""
+        if self._queue is None:
+            return
+        self._last_send = time.monotonic()
+        data = self.take()
+        if data["counters"] or data["histograms"] or data["gauges"]:
+            self._queue.put(data)
+
+    def as_dict(self) -> dict:
+        """:returns: JSON serializable summary of the metrics, histograms with count, sum and quantiles"""
+        self.sample()
+        with self._lock:
+            histograms = {}
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                summary = {"count": histogram.count, "sum": histogram.sum}
+                for q in QUANTILES:
+                    summary["p{:g}".format(q * 100)] = histogram.quantile(q)
+                histograms[name + format_labels(labels)] = summary
+            return {
+                "counters": {name + format_labels(labels): x for (name, labels), x in sorted(self.counters.items())},
+                "gauges": {name + format_labels(labels): x for (name, labels), x in sorted(self.gauges.items())},
+                "histograms": histograms,
+            }
+
+    def prometheus_text(self) -> str:
+        """:returns: the metrics in the Prometheus text exposition format"""
+        self.sample()
+        lines = []
+        with self._lock:
+            for kind, metrics in (("counter", self.counters), ("gauge", self.gauges)):
+                last = None
+                for (name, labels), value in sorted(metrics.items()):
+                    if name != last:
+                        lines.append("# TYPE {} {}".format(name, kind))
+                        last = name
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+            last = None
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if name != last:
+                    lines.append("# TYPE {} histogram".format(name))
+                    last = name
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else repr(bound)
+                    lines.append("{}_bucket{} {}".format(name, format_labels(labels + (("le", le),)), cumulative))
+                lines.append("{}_sum{} {}".format(name, format_labels(labels), histogram.sum))
+                lines.append("{}_count{} {}".format(name, format_labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+#: Metrics of this process
+REGISTRY = Registry()
+
+
+def start_worker(queue, interval: float = 5) -> None:
+    """Send the metrics of this worker process to queue, see :meth:`Registry.start_worker`"""
+    REGISTRY.start_worker(queue, interval)
+
+
+def merge_from(queue, registry: Registry = None, interval: float = 1) -> threading.Thread:
+    """Merge the metrics sent by workers to queue into registry, by default :data:`REGISTRY`, until None is received.
+    Gauges are sampled every interval seconds meanwhile.
+    :returns: the thread doing it
+    """
+    registry = registry or REGISTRY
+
+    def merge() -> None:
+        last_sample = 0
+        while True:
+            try:
+                data = queue.get(timeout=interval)
+            except queue_module.Empty:
+                data = {}
+            if data is None:
+                return
+            if data:
+                registry.merge(data)
+            if time.monotonic() - last_sample >= interval:
+                registry.sample()
+                last_sample = time.monotonic()
+
+    thread = threading.Thread(name="metrics merger", target=merge, daemon=True)
+    thread.start()
+    return thread
+
+
+class StatsWriter:
+    def __init__(self, path: str, interval: float = 10, registry: Registry = None):
+        """Write the metrics of registry, by default :data:`REGISTRY`, to the JSON file path every interval seconds,
+        from a background thread
+        """
+        self.path = path
+        self.interval = interval
+        self.registry = registry or REGISTRY
+        self._stop = threading.Event()
+        self._thread = threading.Thread(name="stats writer", target=self._run, daemon=True)
+        self._thread.start()
+
+    def write(self) -> None:
+        stats = {"time": time.time(), "pid": os.getpid()}
+        stats.update(self.registry.as_dict())
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(stats, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                logging.exception("StatsWriter: can't write %s", self.path)
+
+    def close(self) -> None:
+        """Stop and write the final metrics"""
+        self._stop.set()
+        self._thread.join()
+        self.write()
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.registry.prometheus_text().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        logging.debug("MetricsHandler: " + format, *args)
+
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address: typing.Tuple[str, int], registry: Registry = None):
+        """Serve the metrics of registry, by default :data:`REGISTRY`, on http://address/metrics
+        :param address: (host, port), use a loopback host, the metrics reveal names of indexed file types
+        """
+        self.registry = registry or REGISTRY
+        super().__init__(address, MetricsHandler)
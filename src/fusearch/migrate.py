@@ -0,0 +1,295 @@
+"""Schema migrations of existing index databases
+
+The schema version is kept in sqlite's ``PRAGMA user_version``, databases created before it was set are detected by
+their tables and columns.
+"""
+
+import array
+import itertools
+import json
+import logging
+import sys
+import typing
+import zlib
+
+from pony.orm import Database, commit, db_session
+
+from .model import Document
+from .snippets import encode_offsets
+from .util import compress_text
+from . import postings
+
+#: Postings in the implicit Token <-> Document join table
+LEGACY = 0
+#: Postings as varint blobs, see :mod:`fusearch.postings`
+POSTINGS_BLOB = 1
+#: Document length column
+DOCUMENT_LENGTH = 2
+#: Token max_tf_norm column
+MAX_TF_NORM = 3
+#: Token max_tf column
+MAX_TF = 4
+#: Token positions column
+POSITIONS = 5
+#: Document size column
+DOCUMENT_SIZE = 6
+#: Document file_sha column
+FILE_SHA = 7
+#: Compressed text in the Content table instead of the Document content column
+CONTENT_STORE = 8
+#: Content offsets column
+TOKEN_OFFSETS = 9
+#: Content text in independently compressed blocks and offsets sorted by token
+CONTENT_BLOCKS = 10
+
+SCHEMA_VERSION = CONTENT_BLOCKS
+
+LEGACY_SUFFIX = "_v0"
+LEGACY_TABLES = ["Document_Token", "Document", "Token"]
+
+
+def _tables(db: Database) -> set:
+    return set(db.select("name FROM sqlite_master WHERE type = 'table'"))
+
+
+def _columns(db: Database, table: str) -> set:
+    return set(row[1] for row in db.execute('PRAGMA table_info("{}")'.format(table)).fetchall())
+
+
+def schema_version(db: Database) -> typing.Optional[int]:
+    """:returns: the schema version of the database or None when it's empty, must be called inside a db_session"""
+    tables = _tables(db)
+    if "Document" + LEGACY_SUFFIX in tables:
+        # Legacy import didn't finish
+        return LEGACY
+    if "Document" not in tables:
+        return None
+    version = db.execute("PRAGMA user_version").fetchone()[0]
+    if version:
+        return version
+    if "Document_Token" in tables:
+        return LEGACY
+    if "length" not in _columns(db, "Document"):
+        return POSTINGS_BLOB
+    if "max_tf_norm" not in _columns(db, "Token"):
+        return DOCUMENT_LENGTH
+    if "max_tf" not in _columns(db, "Token"):
+        return MAX_TF_NORM
+    if "positions" not in _columns(db, "Token"):
+        return MAX_TF
+    if "size" not in _columns(db, "Document"):
+        return POSITIONS
+    if "file_sha" not in _columns(db, "Document"):
+        return DOCUMENT_SIZE
+    if "Content" not in tables:
+        return FILE_SHA
+    if "offsets" not in _columns(db, "Content"):
+        return CONTENT_STORE
+    return TOKEN_OFFSETS
+
+
+def _set_aside_legacy(db: Database) -> None:
+    if "Document" + LEGACY_SUFFIX in _tables(db):
+        return
+    for name in db.select("name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL"):
+        db.execute('DROP INDEX "{}"'.format(name))
+    for table in LEGACY_TABLES:
+        db.execute('ALTER TABLE "{0}" RENAME TO "{0}{1}"'.format(table, LEGACY_SUFFIX))
+
+
+def _add_document_length(db: Database) -> None:
+    db.execute('ALTER TABLE "Document" ADD COLUMN "length" INTEGER NOT NULL DEFAULT 0')
+    for doc_id, tokfreq in db.select('"id", "tokfreq" FROM "Document"'):
+        length = sum(json.loads(tokfreq).values())
+        db.execute('UPDATE "Document" SET "length" = $length WHERE "id" = $doc_id')
+
+
+def _add_max_tf_norm(db: Database) -> None:
+    db.execute('ALTER TABLE "Token" ADD COLUMN "max_tf_norm" REAL NOT NULL DEFAULT 0')
+    lengths = dict(db.select('"id", "length" FROM "Document"'))
+    for token_id, blob in db.select('"id", "postings" FROM "Token"'):
+        doc_ids, tfs = postings.decode(blob)
+        max_tf_norm = max(tf / max(lengths[doc_id], 1) for doc_id, tf in zip(doc_ids, tfs))
+        db.execute('UPDATE "Token" SET "max_tf_norm" = $max_tf_norm WHERE "id" = $token_id')
+
+
+def _add_max_tf(db: Database) -> None:
+    db.execute('ALTER TABLE "Token" ADD COLUMN "max_tf" INTEGER NOT NULL DEFAULT 0')
+    for token_id, blob in db.select('"id", "postings" FROM "Token"'):
+        max_tf = max(postings.decode(blob)[1])
+        db.execute('UPDATE "Token" SET "max_tf" = $max_tf WHERE "id" = $token_id')
+
+
+def _add_positions(db: Database) -> None:
+    db.execute('ALTER TABLE "Token" ADD COLUMN "positions" BLOB')
+
+
+def _add_document_size(db: Database) -> None:
+    # Unknown until the document is indexed again
+    db.execute('ALTER TABLE "Document" ADD COLUMN "size" INTEGER')
+
+
+def _add_file_sha(db: Database) -> None:
+    # Unknown until the document is indexed again, same index name as generated by pony
+    db.execute('ALTER TABLE "Document" ADD COLUMN "file_sha" TEXT')
+    db.execute('CREATE INDEX "idx_document__file_sha" ON "Document" ("file_sha")')
+
+
+def _move_content(db: Database, batch_size: int = 256) -> None:
+    # Same table as generated by pony
+    db.execute('CREATE TABLE "Content" ("id" INTEGER NOT NULL PRIMARY KEY, "text" BLOB NOT NULL)')
+    doc_id = 0
+    while True:
+        rows = db.select(
+            '"id", "content" FROM "Document" WHERE "id" > $doc_id AND "content" != \'\' ORDER BY "id" LIMIT $batch_size'
+        )
+        if not rows:
+            break
+        for doc_id, content in rows:
+            # Compressed as a whole, converted to blocks by _content_blocks
+            text = zlib.compress(content.encode(errors="surrogatepass"))
+            db.execute('INSERT INTO "Content" ("id", "text") VALUES ($doc_id, $text)')
+    _drop_document_content(db)
+
+
+def _drop_document_content(db: Database) -> None:
+    # ALTER TABLE DROP COLUMN needs sqlite 3.35, the table is rebuilt without the column. Same table as generated by
+    # pony
+    db.execute("""CREATE TABLE "Document_new" (
+  "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+  "url_sha" TEXT UNIQUE NOT NULL,
+  "url" TEXT UNIQUE NOT NULL,
+  "filename" TEXT NOT NULL,
+  "mtime" INTEGER NOT NULL,
+  "size" INTEGER,
+  "content_sha" TEXT NOT NULL,
+  "file_sha" TEXT,
+  "tokfreq" BLOB NOT NULL,
+  "length" INTEGER NOT NULL
+)""")
+    columns = '"id", "url_sha", "url", "filename", "mtime", "size", "content_sha", "file_sha", "tokfreq", "length"'
+    db.execute('INSERT INTO "Document_new" ({0}) SELECT {0} FROM "Document"'.format(columns))
+    # Ids of deleted documents are not reused
+    seq = db.select("coalesce(max(seq), 0) FROM sqlite_sequence WHERE name = 'Document'")[0]
+    db.execute('DROP TABLE "Document"')
+    db.execute('ALTER TABLE "Document_new" RENAME TO "Document"')
+    db.execute("DELETE FROM sqlite_sequence WHERE name = 'Document'")
+    db.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('Document', $seq)")
+    db.execute('CREATE INDEX "idx_document__file_sha" ON "Document" ("file_sha")')
+
+
+def _add_token_offsets(db: Database) -> None:
+    # Unknown until the document is indexed again, snippets of these documents show their beginning
+    db.execute('ALTER TABLE "Content" ADD COLUMN "offsets" BLOB')
+
+
+def _legacy_offsets(blob: bytes, tokfreq: dict) -> dict:
+    """:returns: token offsets as compressed before CONTENT_BLOCKS, the number of offsets of each token of tokfreq in
+    a byte followed by all the offsets delta encoded per token as 32 bit integers"""
+    keys = list(tokfreq)
+    data = zlib.decompress(blob)
+    deltas = array.array("I", data[len(keys) :])
+    if sys.byteorder == "big":
+        deltas.byteswap()
+    offsets = {}
+    start = 0
+    for tok, count in zip(keys, data[: len(keys)]):
+        if count:
+            offsets[tok] = list(itertools.accumulate(deltas[start : start + count]))
+            start += count
+    return offsets
+
+
+def _content_blocks(db: Database, batch_size: int = 256) -> None:
+    doc_id = 0
+    while True:
+        rows = db.select(
+            'c."id", c."text", c."offsets", d."tokfreq" FROM "Content" c LEFT JOIN "Document" d ON d."id" = c."id" '
+            'WHERE c."id" > $doc_id ORDER BY c."id" LIMIT $batch_size'
+        )
+        if not rows:
+            break
+        for doc_id, text, offsets, tokfreq in rows:
+            text = compress_text(zlib.decompress(text).decode(errors="surrogatepass"))
+            if offsets is not None:
+                offsets = encode_offsets(_legacy_offsets(offsets, json.loads(tokfreq))) if tokfreq else None
+            db.execute('UPDATE "Content" SET "text" = $text, "offsets" = $offsets WHERE "id" = $doc_id')
+
+
+# Steps to upgrade from the previous version
+_UPGRADE_STEPS = {
+    DOCUMENT_LENGTH: _add_document_length,
+    MAX_TF_NORM: _add_max_tf_norm,
+    MAX_TF: _add_max_tf,
+    POSITIONS: _add_positions,
+    DOCUMENT_SIZE: _add_document_size,
+    FILE_SHA: _add_file_sha,
+    CONTENT_STORE: _move_content,
+    TOKEN_OFFSETS: _add_token_offsets,
+    CONTENT_BLOCKS: _content_blocks,
+}
+
+
+def upgrade(db: Database) -> bool:
+    """Upgrade the schema of a bound database before generating the mapping
+
+    :returns: True when there are legacy documents to import with :func:`import_legacy` after generating the mapping
+    """
+    with db_session:
+        version = schema_version(db)
+        if version is None or version == SCHEMA_VERSION:
+            return False
+        logging.info("Upgrading index schema from version %d to %d", version, SCHEMA_VERSION)
+        if version == LEGACY:
+            # Postings are rebuilt from the stored documents once the new tables exist
+            _set_aside_legacy(db)
+            commit()
+            return True
+        for step in range(version + 1, SCHEMA_VERSION + 1):
+            _UPGRADE_STEPS[step](db)
+        commit()
+    if version < CONTENT_STORE:
+        # The text moved out of the Document table, shrink the file
+        vacuum(db)
+    return False
+
+
+def vacuum(db: Database) -> None:
+    """Rebuild the database file to reclaim the space of deleted data, can't be called inside a db_session"""
+    # VACUUM can't run in a transaction and db_session starts one
+    connection, _ = db.provider.connect()
+    try:
+        connection.execute("VACUUM")
+    finally:
+        db.provider.release(connection)
+
+
+def _legacy_documents(db: Database, batch_size: int = 256) -> typing.Iterable[Document]:
+    rowid = 0
+    while True:
+        with db_session:
+            rows = db.select(
+                'rowid, "url", "filename", "content", "tokfreq", "mtime" FROM "Document{}" '
+                "WHERE rowid > $rowid ORDER BY rowid LIMIT $batch_size".format(LEGACY_SUFFIX)
+            )
+        if not rows:
+            return
+        for rowid, url, filename, content, tokfreq, mtime in rows:
+            yield Document(url=url, filename=filename, content=content, tokfreq=json.loads(tokfreq), mtime=mtime)
+
+
+def import_legacy(index) -> None:
+    """Re-add the documents of a legacy database to index and drop the legacy tables"""
+    added = index.add_documents(_legacy_documents(index.db))
+    with db_session:
+        for table in LEGACY_TABLES:
+            index.db.execute('DROP TABLE "{}{}"'.format(table, LEGACY_SUFFIX))
+        commit()
+    logging.info("Imported %d legacy documents, VACUUM the database to reclaim space", added)
+
+
+def stamp(db: Database) -> None:
+    """Record the current schema version"""
+    with db_session:
+        db.execute("PRAGMA user_version = {}".format(SCHEMA_VERSION))
+        commit()
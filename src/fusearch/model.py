@@ -1,6 +1,17 @@
 from collections import namedtuple
 
-Document = namedtuple("Document", ["url", "filename", "content", "tokfreq", "mtime"])
+Document = namedtuple(
+    "Document", ["url", "filename", "content", "tokfreq", "mtime", "positions", "size", "file_sha", "offsets"]
+)
+# positions: optional dictionary of token -> sorted token positions, for the positional index
+# size: optional file size in bytes, to detect changes on rescan
+# file_sha: optional sha1 of the raw file, to detect copies and moves of indexed files
+# offsets: optional dictionary of token -> character offsets in content of its first occurrences, for snippets
+Document.__new__.__defaults__ = (None, None, None, None)
 
 
 Result = namedtuple("Result", ["tok", "tfidf", "url"])
+
+# text: a window of the document content, highlights: (start, end) of the query terms in text, offset: character offset
+# of text in the content
+Snippet = namedtuple("Snippet", ["text", "highlights", "offset"])
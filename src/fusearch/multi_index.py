@@ -0,0 +1,232 @@
+"""Queries over several indexes as if they were a single one
+
+Doc ids of each index are mapped to disjoint ranges, ``part << PART_SHIFT | doc id``, so the postings of a term are the
+concatenation of its postings in every index, in order. The scorer statistics, number of documents, lengths and
+number of documents of each term, are global, so scores and rankings are the same as with a single index containing
+all the documents.
+
+Optionally the parts are read concurrently, from a thread per part. Decoding the postings holds the GIL, so it only
+pays off when reading the parts waits for I/O, for example with the indexes on different disks.
+"""
+
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import itertools
+import threading
+import typing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pony.orm import db_session, select
+
+from .index import Index, Searcher
+from .scoring import Scorer
+
+# Doc ids of a part must be smaller than 2 ** PART_SHIFT
+PART_SHIFT = 40
+DOC_ID_MASK = (1 << PART_SHIFT) - 1
+
+
+class MultiIndex(Searcher):
+    def __init__(
+        self,
+        indexes: typing.List[Index],
+        scorer: Scorer = None,
+        cache_entries: int = 1024,
+        cache_memory: int = 64 * 1024 * 1024,
+        collapse_duplicates: bool = False,
+        parallel: bool = False,
+    ):
+        """
+        :param indexes: the parts, all of them with the same tokenizer as the first one. They are queried, not
+        modified, changes to them are seen by the next query
+        :param scorer: A class implementing :class:`scoring.Scorer`, defaults to :class:`scoring.BM25`
+        :param cache_entries: maximum number of cached query results, 0 disables the cache
+        :param cache_memory: approximate maximum memory in bytes used by cached query results
+        :param collapse_duplicates: only return the best ranked of the documents with the same file contents
+        :param parallel: read the parts from a thread per part, unless some of them are in memory
+        """
+        assert indexes, "a MultiIndex needs at least one index"
+        super().__init__(indexes[0].tokenizer, scorer, cache_entries, cache_memory, collapse_duplicates)
+        self.indexes = list(indexes)
+        # With parallel reads, the thread of each part. Parts are always read from the same thread, on the same
+        # connection, so that a query reads a single snapshot of them, see _session
+        self._executors = None
+        if parallel and len(self.indexes) > 1 and not any(index.in_memory for index in self.indexes):
+            self._executors = [ThreadPoolExecutor(1, thread_name_prefix="fusearch-part") for _ in self.indexes]
+        # Queries reading the parts in parallel take turns, the db_sessions of the part threads are opened and closed by
+        # the outermost _session of a query
+        self._sessions_lock = threading.RLock()
+        self._sessions = 0
+        # Generations of the parts the scorer statistics were loaded at
+        self._generations = None
+
+    def _on_parts(self, fn: typing.Callable[[int, Index], typing.Any]) -> list:
+        """:returns: list of fn(part number, part) for every part, concurrently on the thread of each part when
+        parallel"""
+        if self._executors is None:
+            return [fn(part, index) for part, index in enumerate(self.indexes)]
+        futures = [
+            executor.submit(fn, part, index)
+            for part, (executor, index) in enumerate(zip(self._executors, self.indexes))
+        ]
+        return [x.result() for x in futures]
+
+    def _map_parts(self, fn: typing.Callable[[Index], typing.Any]) -> list:
+        """:returns: list of fn applied to every part inside a db_session, concurrently when parallel"""
+
+        def in_session(part: int, index: Index):
+            with db_session:
+                return fn(index)
+
+        return self._on_parts(in_session)
+
+    def _map_doc_ids(self, doc_ids: typing.Iterable[int], fn: typing.Callable[[Index, typing.List[int]], dict]) -> dict:
+        """:returns: dictionary of doc id -> value for the doc ids, fn(part, doc ids in the part) returns the values of
+        the part by its doc ids. Must be called inside a db_session"""
+        by_part = self._by_part(doc_ids)
+
+        def in_session(part: int, index: Index) -> dict:
+            with db_session:
+                return fn(index, by_part.get(part, []))
+
+        values = {}
+        for part, part_values in enumerate(self._on_parts(in_session)):
+            offset = part << PART_SHIFT
+            values.update((offset | doc_id, x) for doc_id, x in part_values.items())
+        return values
+
+    @contextmanager
+    def _session(self):
+        """db_session of a query. With parallel reads, the threads of the parts keep a db_session open meanwhile, the
+        ones of _map_parts are part of it and read the snapshot started by :meth:`_check_external_changes`"""
+        with db_session:
+            if self._executors is None:
+                yield
+                return
+            with self._sessions_lock:
+                self._sessions += 1
+                if self._sessions == 1:
+                    self._on_parts(lambda part, index: db_session.__enter__())
+                try:
+                    yield
+                finally:
+                    self._sessions -= 1
+                    if self._sessions == 0:
+                        self._on_parts(lambda part, index: db_session.__exit__())
+
+    def _by_part(self, doc_ids: typing.Iterable[int]) -> typing.Dict[int, typing.List[int]]:
+        """:returns: dictionary of part -> doc ids of the part"""
+        by_part = defaultdict(list)
+        for doc_id in doc_ids:
+            by_part[doc_id >> PART_SHIFT].append(doc_id & DOC_ID_MASK)
+        return by_part
+
+    def _check_external_changes(self) -> None:
+        """Drop cached statistics and results when any of the parts changed, must be called inside a db_session"""
+
+        def check(index: Index) -> None:
+            # Parts can be queried directly at the same time, their statistics and cache change under their lock
+            with index._lock:
+                index._check_external_changes()
+
+        self._map_parts(check)
+        generations = tuple(index.generation for index in self.indexes)
+        if generations != self._generations:
+            self._generations = generations
+            self._unload_scorer()
+            self._new_generation()
+
+    def _load_scorer(self) -> None:
+        """Load the statistics of all the parts in the scorer if needed, must be called inside a db_session"""
+        self._check_external_changes()
+        if not self.scorer.loaded:
+            lengths = []
+            part_lengths = self._map_parts(lambda index: select((x.id, x.length) for x in index.Document)[:])
+            for part, rows in enumerate(part_lengths):
+                offset = part << PART_SHIFT
+                lengths.extend((offset | doc_id, length) for doc_id, length in rows)
+            self.scorer.load(lengths)
+
+    def _term_postings(self, toks: typing.List[str], arrays: bool = False) -> typing.List[tuple]:
+        """:returns: list of (tok, num_docs, max_tf, max_tf_norm, doc ids, tfs) for the toks present in any of the
+        parts, sorted by tok, must be called inside a db_session
+        :param arrays: doc ids and tfs as numpy arrays instead of lists
+        """
+        merged = {}
+        for part, part_postings in enumerate(self._map_parts(lambda index: index._term_postings(toks, arrays))):
+            offset = part << PART_SHIFT
+            for tok, num_docs, max_tf, max_tf_norm, doc_ids, tfs in part_postings:
+                if arrays:
+                    doc_ids = offset | doc_ids
+                else:
+                    doc_ids = [offset | doc_id for doc_id in doc_ids]
+                term = merged.get(tok)
+                if term is None:
+                    merged[tok] = [tok, num_docs, max_tf, max_tf_norm, [doc_ids], [tfs]]
+                else:
+                    term[1] += num_docs
+                    term[2] = max(term[2], max_tf)
+                    term[3] = max(term[3], max_tf_norm)
+                    term[4].append(doc_ids)
+                    term[5].append(tfs)
+        join = numpy.concatenate if arrays else lambda xs: list(itertools.chain.from_iterable(xs))
+        # In the order of the parts, toks missing from the first parts would come last
+        return [
+            (tok, num_docs, max_tf, max_tf_norm, join(doc_ids), join(tfs))
+            for tok, num_docs, max_tf, max_tf_norm, doc_ids, tfs in sorted(
+                merged.values(), key=lambda x: x[0].encode(errors="surrogatepass")
+            )
+        ]
+
+    def _term_positions(self, toks: typing.List[str]) -> dict:
+        """:returns: dictionary of tok -> positions aligned with the postings, for the toks with positions in any of
+        the parts. Must be called inside a db_session"""
+        if not toks:
+            return {}
+        merged = defaultdict(list)
+        with_positions = set()
+        part_positions = self._map_parts(
+            lambda index: (
+                index._term_positions(toks),
+                select((x.tok, x.num_docs) for x in index.Token if x.tok in toks)[:],
+            )
+        )
+        for positions, num_docs_by_tok in part_positions:
+            with_positions.update(positions)
+            for tok, num_docs in num_docs_by_tok:
+                # Postings without positions have an empty list of positions
+                merged[tok].extend(positions.get(tok) or [[]] * num_docs)
+        return {tok: merged[tok] for tok in with_positions}
+
+    def _match_terms(self, pattern, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        """:returns: up to limit (term, edit distance) of the terms matching a :mod:`fusearch.terms` pattern in any of
+        the parts, sorted by distance then term. Must be called inside a db_session"""
+
+        def match(index: Index) -> list:
+            # Syncs the term dictionary of the part
+            with index._lock:
+                return index._match_terms(pattern, limit)
+
+        matches = set(itertools.chain.from_iterable(self._map_parts(match)))
+        return sorted(matches, key=lambda x: (x[1], x[0]))[:limit]
+
+    def _urls(self, doc_ids: typing.Iterable[int]) -> dict:
+        """:returns: dictionary of doc id -> url, must be called inside a db_session"""
+        return self._map_doc_ids(doc_ids, lambda index, part_doc_ids: index._urls(part_doc_ids))
+
+    def _stored_contents(self, urls: typing.List[str]) -> dict:
+        """:returns: dictionary of url -> (compressed content, encoded token offsets or None), must be called inside a
+        db_session"""
+        stored = {}
+        for part_stored in self._map_parts(lambda index: index._stored_contents(urls)):
+            stored.update(part_stored)
+        return stored
+
+    def _file_shas(self, doc_ids: list) -> dict:
+        """:returns: dictionary of doc id -> file sha of the documents, must be called inside a db_session"""
+        return self._map_doc_ids(doc_ids, lambda index, part_doc_ids: index._file_shas(part_doc_ids))
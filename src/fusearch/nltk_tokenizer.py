@@ -1,29 +1,35 @@
 from fusearch import tokenizer
 
-from nltk.stem import PorterStemmer
-from nltk.tokenize import RegexpTokenizer
-from nltk.corpus import stopwords
-
-import nltk
+from collections import Counter
+import functools
+import os
 import re
 
 from fusearch.util import compose
 
-nltk.download("punkt")
+# The english stop words of the NLTK corpus, bundled so that nothing is downloaded
+STOPWORDS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "english_stopwords.txt")
+
+
+def load_stopwords(path: str = STOPWORDS_FILE) -> set:
+    """:returns: set of the words in path, one per line"""
+    with open(path, encoding="utf-8") as f:
+        return set(line.strip() for line in f if line.strip())
 
 
 class NLTKTokenizer(tokenizer.Tokenizer):
-    def __init__(self):
+    def __init__(self, stem_cache_size: int = 2**17):
+        """
+        :param stem_cache_size: maximum number of raw tokens whose normalized stem is memoized
+        """
+        # Importing nltk takes a fraction of a second, only pay for it when a tokenizer is needed
+        from nltk.stem import PorterStemmer
+        from nltk.tokenize import RegexpTokenizer
+
         self.stemmer = PorterStemmer()
         # TODO: move to config
         self.tok = RegexpTokenizer(r"[\w\']+")
-        try:
-            self.stopWords = set(stopwords.words("english"))
-        except LookupError:
-            nltk.download("stopwords")
-            self.stopWords = set(stopwords.words("english"))
-        else:
-            self.stopWords = set(stopwords.words("english"))
+        self.stopWords = load_stopwords()
         self.substitutions = [
             (re.compile("^'"), ""),
             (re.compile("'$"), ""),
@@ -31,14 +37,48 @@ class NLTKTokenizer(tokenizer.Tokenizer):
             (re.compile("_+$"), ""),
             (re.compile("^_+"), ""),
         ]
-        self.token_normalize = compose(self.subst, lambda x: x.lower(),)
+        self.token_normalize = compose(
+            self.subst,
+            lambda x: x.lower(),
+        )
+        # Fast path, same results as the pipeline above
+        self.words = re.compile(self.tok._pattern, self.tok._flags).findall
+        self.word_matches = re.compile(self.tok._pattern, self.tok._flags).finditer
+        self.underscores = re.compile("__+")
+        # Vocabulary is Zipfian, most raw tokens are seen many times
+        self.normalize_stem = functools.lru_cache(maxsize=stem_cache_size)(self._normalize_stem)
 
     def subst(self, x):
         for s in self.substitutions:
             x = s[0].sub(s[1], x)
         return x
 
+    def _normalize_stem(self, x):
+        """:returns: the stem of a raw token or None if it's discarded, equivalent to substitutions, lowercase,
+        stop words filter and stem"""
+        if x[:1] == "'":
+            x = x[1:]
+        if x[-1:] == "'":
+            x = x[:-1]
+        if "_" in x:
+            x = self.underscores.sub("_", x).strip("_")
+        x = x.lower()
+        if not x or x in self.stopWords:
+            return None
+        return self.stemmer.stem(x)
+
     def tokenize(self, x):
+        return [tok for tok in map(self.normalize_stem, self.words(x)) if tok]
+
+    def spans(self, x):
+        normalize_stem = self.normalize_stem
+        for match in self.word_matches(x):
+            tok = normalize_stem(match.group())
+            if tok:
+                yield tok, match.start(), match.end()
+
+    def tokenize_slow(self, x):
+        """Reference implementation of :meth:`tokenize`"""
         toks = map(
             self.stemmer.stem,
             filter(
@@ -47,3 +87,8 @@ class NLTKTokenizer(tokenizer.Tokenizer):
             ),
         )
         return toks
+
+    def tokfreq(self, x) -> dict:
+        freq = Counter(map(self.normalize_stem, self.words(x)))
+        freq.pop(None, None)
+        return freq
@@ -0,0 +1,138 @@
+"""Compact postings lists
+
+A postings list is a sequence of (doc id, term frequency) pairs sorted by doc id. It's stored as a blob of unsigned
+LEB128 varints where doc ids are delta encoded from the previous doc id in the list::
+
+    varint(doc_id_0 - base) varint(tf_0) varint(doc_id_1 - doc_id_0) varint(tf_1) ...
+
+``base`` is 0 for a whole list, which allows appending postings with higher doc ids by encoding with the last doc id of
+the list as base and concatenating the blobs.
+"""
+
+from itertools import accumulate
+from typing import Iterable, List, Tuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def encode_varints(xs: Iterable[int], out: bytearray) -> bytearray:
+    """Append the varint encoding of the non negative integers xs to out"""
+    append = out.append
+    for x in xs:
+        while x >= 0x80:
+            append((x & 0x7F) | 0x80)
+            x >>= 7
+        append(x)
+    return out
+
+
+def decode_varints(data: bytes) -> List[int]:
+    result = []
+    append = result.append
+    value = 0
+    shift = 0
+    for b in data:
+        if b < 0x80:
+            append(value | (b << shift))
+            value = 0
+            shift = 0
+        else:
+            value |= (b & 0x7F) << shift
+            shift += 7
+    assert shift == 0, "truncated varint"
+    return result
+
+
+def encode(doc_ids: List[int], tfs: List[int], base: int = 0) -> bytes:
+    """Encode sorted doc ids and their term frequencies
+
+    :param base: doc id the first delta is relative to, last doc id of the list being appended to
+    """
+    assert len(doc_ids) == len(tfs)
+    out = bytearray()
+    prev = base
+    for doc_id, tf in zip(doc_ids, tfs):
+        assert doc_id > prev, "doc ids must be increasing"
+        encode_varints((doc_id - prev, tf), out)
+        prev = doc_id
+    return bytes(out)
+
+
+def rebase(blob: bytes, offset: int, base: int) -> bytes:
+    """Shift the doc ids of a whole postings list by offset, to be appended to a list whose last doc id is base. Only
+    the first delta changes, the rest of the blob is reused as is"""
+    end = 0
+    while blob[end] >= 0x80:
+        end += 1
+    first = decode_varints(blob[: end + 1])[0] + offset
+    assert first > base, "doc ids must be increasing"
+    return bytes(encode_varints((first - base,), bytearray())) + blob[end + 1 :]
+
+
+def decode(blob: bytes) -> Tuple[List[int], List[int]]:
+    """:returns: doc ids and term frequencies"""
+    xs = decode_varints(blob)
+    return list(accumulate(xs[0::2])), xs[1::2]
+
+
+def remove(blob: bytes, doc_ids: set) -> Tuple[bytes, int, int]:
+    """Remove doc_ids from the postings in blob
+    :returns: new blob, number of postings and last doc id
+    """
+    ids, tfs = decode(blob)
+    kept = [(doc_id, tf) for doc_id, tf in zip(ids, tfs) if doc_id not in doc_ids]
+    if not kept:
+        return b"", 0, 0
+    ids, tfs = zip(*kept)
+    return encode(ids, tfs), len(ids), ids[-1]
+
+
+def decode_arrays(blob: bytes) -> Tuple["numpy.ndarray", "numpy.ndarray"]:
+    """Same as :func:`decode` returning int64 numpy arrays, decoded without a Python loop. Needs numpy"""
+    data = numpy.frombuffer(blob, dtype=numpy.uint8)
+    # Last byte of each varint
+    ends = numpy.flatnonzero(data < 0x80)
+    assert not len(data) or ends[-1] == len(data) - 1, "truncated varint"
+    if len(ends) == len(data):
+        values = data.astype(numpy.int64)
+    else:
+        starts = numpy.empty_like(ends)
+        starts[0] = 0
+        starts[1:] = ends[:-1] + 1
+        # Position of each byte in its varint
+        shifts = numpy.arange(len(data)) - numpy.repeat(starts, ends - starts + 1)
+        values = numpy.add.reduceat((data & 0x7F).astype(numpy.int64) << (7 * shifts), starts)
+    return numpy.cumsum(values[0::2]), values[1::2]
+
+
+def encode_positions(positions: Iterable[List[int]]) -> bytes:
+    """Encode the sorted token positions of each posting as varint(count) followed by the delta encoded positions"""
+    out = bytearray()
+    for xs in positions:
+        encode_varints((len(xs),), out)
+        prev = 0
+        for x in xs:
+            encode_varints((x - prev,), out)
+            prev = x
+    return bytes(out)
+
+
+def decode_positions(blob: bytes) -> List[List[int]]:
+    xs = decode_varints(blob)
+    result = []
+    i = 0
+    while i < len(xs):
+        count = xs[i]
+        result.append(list(accumulate(xs[i + 1 : i + 1 + count])))
+        i += 1 + count
+    return result
+
+
+def remove_positions(blob: bytes, doc_ids: List[int], removed: set) -> bytes:
+    """Remove the positions of the postings with doc ids in removed from blob, aligned with doc_ids"""
+    positions = decode_positions(blob)
+    assert len(positions) == len(doc_ids)
+    return encode_positions(xs for doc_id, xs in zip(doc_ids, positions) if doc_id not in removed)
@@ -0,0 +1,327 @@
+"""Boolean and phrase queries
+
+Syntax::
+
+    or_expr  := and_expr ("OR" and_expr)*
+    and_expr := not_expr (["AND"] not_expr)*
+    not_expr := "NOT" not_expr | atom
+    atom     := '"' words '"' | "(" or_expr ")" | pattern | word
+    pattern  := word "*" | word with "*" wildcards | word "~" [digit]
+
+Adjacent terms are ANDed. Words are normalized with the index tokenizer: words without tokens (stop words) are
+ignored and words with several tokens are treated as phrases.
+
+Patterns match the terms of the index, see :mod:`fusearch.terms`, and are replaced by the OR of the terms they match,
+which are stems. ``word*`` matches the terms starting with word and ``*`` in other places any characters, the pattern is
+only lowercased. ``word~N`` matches the terms within N edits of the stem of word which start with the same letter,
+``word~`` picks N from its length.
+
+Queries are evaluated over sorted doc id lists, intersections and differences gallop over the longer list.
+"""
+
+from bisect import bisect_left
+from collections import namedtuple
+import heapq
+import re
+import typing
+
+from .terms import MAX_EDITS, Fuzzy, Prefix, Wildcard, auto_max_edits
+
+Term = namedtuple("Term", ["tok"])
+Phrase = namedtuple("Phrase", ["toks"])
+And = namedtuple("And", ["children"])
+Or = namedtuple("Or", ["children"])
+Not = namedtuple("Not", ["child"])
+
+OPERATORS = {"AND", "OR", "NOT"}
+
+_LEXER = re.compile(r'\s*(?:"([^"]*)"?|([()])|([^\s()"]+))')
+_WORD = re.compile(r'[^\s()"]+')
+_FUZZY = re.compile(r"(.+)~(\d?)$")
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+def _lex(txt: str) -> typing.List[typing.Tuple[str, str]]:
+    """:returns: list of (kind, value) where kind is one of phrase, paren, op and word"""
+    result = []
+    for match in _LEXER.finditer(txt.strip()):
+        phrase, paren, word = match.groups()
+        if phrase is not None:
+            result.append(("phrase", phrase))
+        elif paren:
+            result.append(("paren", paren))
+        elif word in OPERATORS:
+            result.append(("op", word))
+        elif word:
+            result.append(("word", word))
+    return result
+
+
+def patterns(word: str, tokenize: typing.Callable[[str], typing.Iterable[str]]) -> typing.Optional[list]:
+    """:returns: None if word is not a pattern, otherwise the list of :mod:`fusearch.terms` patterns to match, empty
+    for fuzzy stop words"""
+    match = _FUZZY.match(word)
+    if match:
+        max_edits = match.group(2)
+        return [
+            Fuzzy(tok, auto_max_edits(tok) if not max_edits else min(int(max_edits), MAX_EDITS))
+            for tok in tokenize(match.group(1))
+        ]
+    if "*" not in word or not word.strip("*"):
+        return None
+    word = word.lower()
+    if "*" not in word[:-1]:
+        return [Prefix(word[:-1])]
+    return [Wildcard(word)]
+
+
+def split_patterns(txt: str, tokenize: typing.Callable[[str], typing.Iterable[str]]) -> typing.Tuple[str, list]:
+    """:returns: txt without the words which are patterns, and the patterns, see :func:`patterns`"""
+    if "*" not in txt and "~" not in txt:
+        return txt, []
+    result = []
+
+    def replace(match) -> str:
+        word_patterns = patterns(match.group(), tokenize)
+        if word_patterns is None:
+            return match.group()
+        result.extend(word_patterns)
+        return " "
+
+    return _WORD.sub(replace, txt), result
+
+
+class _Parser:
+    def __init__(self, tokens, tokenize, expand=None):
+        self.tokens = tokens
+        self.tokenize = tokenize
+        self.expand = expand
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else (None, None)
+
+    def next(self):
+        token = self.peek()
+        self.pos += 1
+        return token
+
+    def or_expr(self):
+        children = [self.and_expr()]
+        while self.peek() == ("op", "OR"):
+            self.next()
+            children.append(self.and_expr())
+        return _simplify(Or, children)
+
+    def and_expr(self):
+        children = [self.not_expr()]
+        while True:
+            kind, value = self.peek()
+            if kind == "op" and value == "AND":
+                self.next()
+            elif kind is None or (kind, value) in (("op", "OR"), ("paren", ")")):
+                break
+            children.append(self.not_expr())
+        return _simplify(And, children)
+
+    def not_expr(self):
+        if self.peek() == ("op", "NOT"):
+            self.next()
+            child = self.not_expr()
+            return Not(child) if child is not None else None
+        return self.atom()
+
+    def atom(self):
+        kind, value = self.next()
+        if kind == "paren" and value == "(":
+            node = self.or_expr()
+            if self.next() != ("paren", ")"):
+                raise QuerySyntaxError("missing )")
+            return node
+        if kind == "word" and self.expand is not None:
+            word_patterns = patterns(value, self.tokenize)
+            if word_patterns is not None:
+                if not word_patterns:
+                    return None
+                toks = self.expand(word_patterns)
+                # Without matching terms it matches no documents
+                return Term(toks[0]) if len(toks) == 1 else Or(tuple(Term(tok) for tok in toks))
+        if kind in ("word", "phrase"):
+            toks = list(self.tokenize(value))
+            if not toks:
+                return None
+            if len(toks) == 1:
+                return Term(toks[0])
+            return Phrase(tuple(toks))
+        raise QuerySyntaxError("unexpected {}".format(value if value else "end of query"))
+
+
+def _simplify(cls, children):
+    children = [x for x in children if x is not None]
+    if not children:
+        return None
+    if len(children) == 1:
+        return children[0]
+    return cls(tuple(children))
+
+
+def parse(
+    txt: str,
+    tokenize: typing.Callable[[str], typing.Iterable[str]],
+    expand: typing.Callable[[list], typing.List[str]] = None,
+):
+    """:param expand: returns the terms matching any of a list of patterns, without it patterns are plain words
+    :returns: the query tree or None if the query has no terms"""
+    parser = _Parser(_lex(txt), tokenize, expand)
+    if not parser.tokens:
+        return None
+    node = parser.or_expr()
+    if parser.pos < len(parser.tokens):
+        raise QuerySyntaxError("unexpected {}".format(parser.tokens[parser.pos][1]))
+    return node
+
+
+def tokens(node) -> set:
+    """:returns: all the tokens in the query tree"""
+    if node is None:
+        return set()
+    if isinstance(node, Term):
+        return {node.tok}
+    if isinstance(node, Phrase):
+        return set(node.toks)
+    if isinstance(node, Not):
+        return tokens(node.child)
+    return set().union(*(tokens(x) for x in node.children))
+
+
+def positive_tokens(node) -> set:
+    """:returns: tokens which are not negated, the ones used for ranking"""
+    if isinstance(node, Not):
+        return set()
+    if isinstance(node, (And, Or)):
+        return set().union(*(positive_tokens(x) for x in node.children))
+    return tokens(node)
+
+
+def phrase_tokens(node) -> set:
+    """:returns: tokens in phrases, which need positions"""
+    if isinstance(node, Phrase):
+        return set(node.toks)
+    if isinstance(node, Not):
+        return phrase_tokens(node.child)
+    if isinstance(node, (And, Or)):
+        return set().union(*(phrase_tokens(x) for x in node.children))
+    return set()
+
+
+def gallop(xs: typing.List[int], x: int, lo: int = 0) -> int:
+    """:returns: index of the first element >= x in sorted xs at or after lo, searching exponentially from lo"""
+    n = len(xs)
+    bound = 1
+    while lo + bound < n and xs[lo + bound] < x:
+        bound *= 2
+    return bisect_left(xs, x, lo + bound // 2, min(lo + bound + 1, n))
+
+
+def intersect(a: typing.List[int], b: typing.List[int]) -> typing.List[int]:
+    if len(a) > len(b):
+        a, b = b, a
+    result = []
+    lo = 0
+    n = len(b)
+    for x in a:
+        lo = gallop(b, x, lo)
+        if lo == n:
+            break
+        if b[lo] == x:
+            result.append(x)
+    return result
+
+
+def difference(a: typing.List[int], b: typing.List[int]) -> typing.List[int]:
+    result = []
+    lo = 0
+    n = len(b)
+    for x in a:
+        lo = gallop(b, x, lo) if lo < n else n
+        if lo == n or b[lo] != x:
+            result.append(x)
+    return result
+
+
+def union(lists: typing.List[typing.List[int]]) -> typing.List[int]:
+    result = []
+    for x in heapq.merge(*lists):
+        if not result or result[-1] != x:
+            result.append(x)
+    return result
+
+
+def evaluate(
+    node,
+    postings: typing.Dict[str, typing.List[int]],
+    positions: typing.Callable[[str], typing.Optional[typing.List[typing.List[int]]]],
+    universe: typing.Callable[[], typing.List[int]],
+) -> typing.List[int]:
+    """
+    :param node: query tree from :func:`parse`
+    :param postings: tok -> sorted doc ids
+    :param positions: tok -> token positions aligned with postings[tok], or None when not available
+    :param universe: returns all the doc ids sorted, only called for queries with a top level NOT
+    :returns: sorted doc ids matching the query
+    """
+
+    def ev(node):
+        if isinstance(node, Term):
+            return postings.get(node.tok, [])
+        if isinstance(node, Phrase):
+            return _phrase(node.toks, postings, positions)
+        if isinstance(node, Not):
+            return difference(universe(), ev(node.child))
+        if isinstance(node, Or):
+            return union([ev(x) for x in node.children])
+        # AND: intersect the positive children shortest first then subtract the negated ones
+        positive = sorted((ev(x) for x in node.children if not isinstance(x, Not)), key=len)
+        result = universe() if not positive else positive[0]
+        for xs in positive[1:]:
+            if not result:
+                break
+            result = intersect(result, xs)
+        for x in node.children:
+            if isinstance(x, Not) and result:
+                result = difference(result, ev(x.child))
+        return result
+
+    if node is None:
+        return []
+    return ev(node)
+
+
+def _phrase(toks, postings, positions) -> typing.List[int]:
+    unique_toks = set(toks)
+    candidates = sorted((postings.get(tok, []) for tok in unique_toks), key=len)
+    docs = candidates[0]
+    for xs in candidates[1:]:
+        docs = intersect(docs, xs)
+    if not docs:
+        return []
+    tok_positions = {}
+    for tok in unique_toks:
+        tok_positions[tok] = positions(tok)
+        if tok_positions[tok] is None:
+            return []
+    result = []
+    for doc_id in docs:
+        starts = None
+        for offset, tok in enumerate(toks):
+            doc_positions = tok_positions[tok][bisect_left(postings[tok], doc_id)]
+            shifted = set(x - offset for x in doc_positions)
+            starts = shifted if starts is None else starts & shifted
+            if not starts:
+                break
+        if starts:
+            result.append(doc_id)
+    return result
@@ -0,0 +1,257 @@
+"""Ranking functions
+
+The score of a document for a query is the sum, over the query terms in the document, of
+``term_score(weight(num_docs), tf, doc_id)``. Per term weights only depend on the number of documents containing the
+term and per document normalizations only on the document length, both are precomputed and kept up to date as
+documents are added and removed.
+
+With numpy, :meth:`Scorer.term_scores` scores whole postings arrays at once, with the same floating point operations as
+:meth:`Scorer.term_score`.
+
+Scorers loaded with :class:`SortedLengths`, such as the ones of snapshots, read the lengths from the given arrays and
+compute the normalizations on use instead of keeping them per document, they can't be modified.
+"""
+
+import bisect
+import collections.abc
+import math
+import typing
+from abc import ABC, abstractmethod
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class SortedLengths(collections.abc.Mapping):
+    """Read only mapping of doc id -> length over sequences of the sorted doc ids and their lengths, such as memoryviews
+    of a snapshot, looked up with binary search. Nothing is copied"""
+
+    def __init__(self, doc_ids: typing.Sequence[int], lengths: typing.Sequence[int]):
+        self.doc_ids = doc_ids
+        self._lengths = lengths
+
+    def __getitem__(self, doc_id: int) -> int:
+        i = bisect.bisect_left(self.doc_ids, doc_id)
+        if i == len(self.doc_ids) or self.doc_ids[i] != doc_id:
+            raise KeyError(doc_id)
+        return self._lengths[i]
+
+    def __len__(self) -> int:
+        return len(self.doc_ids)
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self.doc_ids)
+
+    def values(self) -> typing.Sequence[int]:
+        return self._lengths
+
+
+class _Norms(collections.abc.Mapping):
+    """Read only mapping of doc id -> norm(length), computed on use"""
+
+    def __init__(self, lengths: SortedLengths, norm: typing.Callable[[int], float]):
+        self._lengths = lengths
+        self._norm = norm
+
+    def __getitem__(self, doc_id: int) -> float:
+        return self._norm(self._lengths[doc_id])
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def __iter__(self) -> typing.Iterator[int]:
+        return iter(self._lengths)
+
+
+class Scorer(ABC):
+    def __init__(self):
+        # doc id -> length, None until loaded
+        self.lengths = None
+        self.total_length = 0
+        # num_docs -> weight, depends on doc_count
+        self._weights = {}
+        # (sorted doc ids, their values for term_scores) numpy arrays, built on demand
+        self._arrays = None
+
+    @property
+    def loaded(self) -> bool:
+        return self.lengths is not None
+
+    @property
+    def doc_count(self) -> int:
+        return len(self.lengths)
+
+    @property
+    def avg_length(self) -> float:
+        return self.total_length / self.doc_count if self.doc_count else 0.0
+
+    def load(self, lengths: typing.Union[typing.Iterable[typing.Tuple[int, int]], SortedLengths]) -> None:
+        """Load collection statistics from (doc id, length) pairs, or from :class:`SortedLengths` which are used as
+        is"""
+        if isinstance(lengths, SortedLengths):
+            self.lengths = lengths
+            values = lengths.values()
+            self.total_length = int(numpy.asarray(values).sum()) if numpy is not None else sum(values)
+        else:
+            self.lengths = dict(lengths)
+            self.total_length = sum(self.lengths.values())
+        self._weights = {}
+        self._arrays = None
+
+    def unload(self) -> None:
+        self.lengths = None
+        self.total_length = 0
+        self._weights = {}
+        self._arrays = None
+
+    def add(self, doc_id: int, length: int) -> None:
+        self.lengths[doc_id] = length
+        self.total_length += length
+        self._weights = {}
+        self._arrays = None
+
+    def remove(self, doc_id: int) -> None:
+        self.total_length -= self.lengths.pop(doc_id)
+        self._weights = {}
+        self._arrays = None
+
+    def weight(self, num_docs: int) -> float:
+        """:returns: weight of a term present in num_docs documents"""
+        weight = self._weights.get(num_docs)
+        if weight is None:
+            weight = self._weights[num_docs] = self.term_weight(num_docs)
+        return weight
+
+    @property
+    def doc_ids(self) -> "numpy.ndarray":
+        """:returns: sorted array of the doc ids, positions in it are the doc positions of :meth:`term_scores`"""
+        return self._doc_arrays()[0]
+
+    def _doc_arrays(self) -> tuple:
+        if self._arrays is None:
+            if isinstance(self.lengths, SortedLengths):
+                # Views of the sequences, only the per document values are computed
+                doc_ids = numpy.asarray(self.lengths.doc_ids)
+                self._arrays = (doc_ids, self._doc_values_array(numpy.asarray(self.lengths.values())))
+            else:
+                values = self._doc_values()
+                doc_ids = numpy.array(sorted(values), dtype=numpy.int64)
+                self._arrays = (doc_ids, numpy.array([values[x] for x in doc_ids.tolist()], dtype=numpy.float64))
+        return self._arrays
+
+    def _doc_values(self) -> dict:
+        """:returns: dictionary of doc id -> per document value used by :meth:`term_scores`"""
+        return self.lengths
+
+    def _doc_values_array(self, lengths: "numpy.ndarray") -> "numpy.ndarray":
+        """:returns: array of the per document values of :meth:`_doc_values` given the array of the lengths"""
+        return lengths.astype(numpy.float64)
+
+    @abstractmethod
+    def term_weight(self, num_docs: int) -> float:
+        pass
+
+    @abstractmethod
+    def term_score(self, weight: float, tf: int, doc_id: int) -> float:
+        """:returns: score contribution of a term with the given weight and frequency tf in doc_id"""
+        pass
+
+    @abstractmethod
+    def term_scores(self, weight: float, tfs: "numpy.ndarray", doc_positions: "numpy.ndarray") -> "numpy.ndarray":
+        """:returns: array of term_score for the tfs of the documents at doc_positions in :attr:`doc_ids`"""
+        pass
+
+    @abstractmethod
+    def upper_bound(self, weight: float, max_tf: int, max_tf_norm: float) -> float:
+        """:returns: upper bound of term_score over postings with the given max tf and max tf / length"""
+        pass
+
+
+class TFIDF(Scorer):
+    """tf * log(N / num_docs) / length"""
+
+    def term_weight(self, num_docs: int) -> float:
+        return math.log(self.doc_count / num_docs)
+
+    def term_score(self, weight: float, tf: int, doc_id: int) -> float:
+        return weight * tf / max(self.lengths[doc_id], 1)
+
+    def term_scores(self, weight: float, tfs: "numpy.ndarray", doc_positions: "numpy.ndarray") -> "numpy.ndarray":
+        return weight * tfs / numpy.maximum(self._doc_arrays()[1][doc_positions], 1)
+
+    def upper_bound(self, weight: float, max_tf: int, max_tf_norm: float) -> float:
+        return weight * max_tf_norm
+
+
+class BM25(Scorer):
+    """Okapi BM25
+
+    Length normalizations are computed against a reference average length which is refreshed when the actual average
+    drifts more than tolerance from it, so adding a document is O(1) most of the time.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75, tolerance: float = 0.01):
+        super().__init__()
+        self.k1 = k1
+        self.b = b
+        self.tolerance = tolerance
+        # doc id -> k1 * (1 - b + b * length / avg_length)
+        self.norms = {}
+        self._norms_avg_length = 1.0
+
+    def _norm(self, length: int) -> float:
+        return self.k1 * (1 - self.b + self.b * length / self._norms_avg_length)
+
+    def _refresh_norms(self) -> None:
+        self._norms_avg_length = self.avg_length or 1.0
+        if isinstance(self.lengths, SortedLengths):
+            self.norms = _Norms(self.lengths, self._norm)
+        else:
+            self.norms = {doc_id: self._norm(length) for doc_id, length in self.lengths.items()}
+
+    def _drifted(self) -> bool:
+        return abs(self.avg_length - self._norms_avg_length) > self.tolerance * self._norms_avg_length
+
+    def load(self, lengths: typing.Iterable[typing.Tuple[int, int]]) -> None:
+        super().load(lengths)
+        self._refresh_norms()
+
+    def unload(self) -> None:
+        super().unload()
+        self.norms = {}
+
+    def add(self, doc_id: int, length: int) -> None:
+        super().add(doc_id, length)
+        if self._drifted():
+            self._refresh_norms()
+        else:
+            self.norms[doc_id] = self._norm(length)
+
+    def remove(self, doc_id: int) -> None:
+        super().remove(doc_id)
+        del self.norms[doc_id]
+        if self.doc_count and self._drifted():
+            self._refresh_norms()
+
+    def term_weight(self, num_docs: int) -> float:
+        idf = math.log(1 + (self.doc_count - num_docs + 0.5) / (num_docs + 0.5))
+        return idf * (self.k1 + 1)
+
+    def term_score(self, weight: float, tf: int, doc_id: int) -> float:
+        return weight * tf / (tf + self.norms[doc_id])
+
+    def _doc_values(self) -> dict:
+        return self.norms
+
+    def _doc_values_array(self, lengths: "numpy.ndarray") -> "numpy.ndarray":
+        # Same operations as _norm
+        return self.k1 * (1 - self.b + self.b * lengths / self._norms_avg_length)
+
+    def term_scores(self, weight: float, tfs: "numpy.ndarray", doc_positions: "numpy.ndarray") -> "numpy.ndarray":
+        return weight * tfs / (tfs + self._doc_arrays()[1][doc_positions])
+
+    def upper_bound(self, weight: float, max_tf: int, max_tf_norm: float) -> float:
+        # norms are at least k1 * (1 - b)
+        return weight * max_tf / (max_tf + self.k1 * (1 - self.b))
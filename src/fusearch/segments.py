@@ -0,0 +1,102 @@
+"""Index segments
+
+Indexing a document, updating the postings of all its tokens, is the bottleneck of a single writer. Instead, several
+processes each build segments, small index databases with a batch of documents, and a single merger moves them to the
+main index with :meth:`fusearch.index.Index.merge_segment`, which appends the postings of a segment without decoding
+them.
+
+Segments are written with a temporary name and renamed when complete, :func:`list_segments` only returns complete ones,
+in the order they were written. Until they are merged, :func:`live_index` can query them together with the main index.
+"""
+
+import itertools
+import logging
+import os
+import time
+import typing
+
+from .index import Index
+from .model import Document
+from .multi_index import MultiIndex
+from .tokenizer import Tokenizer
+
+SEGMENT_SUFFIX = ".segment"
+TMP_SUFFIX = ".tmp"
+
+# Segments written by this process, the time alone could repeat in segment names
+_written = itertools.count()
+
+
+def segments_dir(index_file: str) -> str:
+    """:returns: directory for the segments of the given index database file"""
+    return index_file + ".segments"
+
+
+def open_segment(path: str, tokenizer: Tokenizer, create: bool = False) -> Index:
+    # Segments are short lived, caching query results is not worth it
+    return Index({"provider": "sqlite", "filename": path, "create_db": create}, tokenizer, cache_entries=0)
+
+
+def write_segment(directory: str, documents: typing.List[Document], tokenizer: Tokenizer) -> typing.Optional[str]:
+    """Write documents to a new segment
+    :returns: path of the segment or None if there are no documents
+    """
+    if not documents:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    name = "{:020d}-{}-{}".format(int(time.time() * 1e9), os.getpid(), next(_written))
+    tmp = os.path.join(directory, name + TMP_SUFFIX)
+    segment = open_segment(tmp, tokenizer, create=True)
+    try:
+        segment.add_documents(documents, batch_size=len(documents))
+    finally:
+        segment.db.disconnect()
+    path = os.path.join(directory, name + SEGMENT_SUFFIX)
+    os.rename(tmp, path)
+    return path
+
+
+def list_segments(directory: str) -> typing.List[str]:
+    """:returns: paths of the complete segments in directory, oldest first"""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, x) for x in sorted(names) if x.endswith(SEGMENT_SUFFIX)]
+
+
+def remove_incomplete(directory: str) -> None:
+    """Remove segments left behind by writers which didn't finish, only call it when no writers are running"""
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if name.endswith(TMP_SUFFIX):
+            logging.info("Removing incomplete segment %s", name)
+            os.remove(os.path.join(directory, name))
+
+
+def merge_segments(index: Index, directory: str) -> int:
+    """Merge the complete segments in directory into index and remove them
+    :returns: number of documents merged
+    """
+    merged = 0
+    for path in list_segments(directory):
+        merged += index.merge_segment(path)
+        os.remove(path)
+    return merged
+
+
+def live_index(index: Index, directory: str, **kwargs) -> MultiIndex:
+    """:returns: an index to query the main index together with the segments in directory waiting to be merged.
+    Segments written after this call are not seen. Until a segment is merged, documents it replaces are also found in
+    the main index, and for a short while after, its documents are found twice.
+
+    :param kwargs: passed to :class:`fusearch.multi_index.MultiIndex`
+    """
+    segments = []
+    for path in list_segments(directory):
+        try:
+            segments.append(open_segment(path, index.tokenizer))
+        except Exception:
+            # Merged and removed since listed
+            if os.path.exists(path):
+                raise
+    return MultiIndex([index] + segments, **kwargs)
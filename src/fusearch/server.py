@@ -0,0 +1,134 @@
+"""Query server
+
+Opening an index and initializing the tokenizer take much longer than answering a query. fusearchd keeps them loaded,
+together with the scorer statistics and the query cache, and answers queries on a Unix domain socket from a pool of
+threads, see :mod:`fusearch.client`. Queries go to all the indexes as one, see :mod:`fusearch.multi_index`, unless
+they name an index.
+
+The protocol is a JSON object per line in each direction, several queries can be sent over one connection. A request
+is ``{"query": str, "k": int, "snippets": bool, "boolean": bool, "index": str}``, only query is required. The answer is
+``{"results": [{"url": str, "score": float, "snippet": {"text": str, "highlights": [[start, end]], "offset": int}}]}``,
+the snippet only with snippets, or ``{"error": str}``.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+import socket
+import socketserver
+import typing
+
+from .index import Index, Searcher
+from .multi_index import MultiIndex
+
+DEFAULT_K = 20
+
+
+class QueryHandler(socketserver.StreamRequestHandler):
+    def handle(self) -> None:
+        for line in self.rfile:
+            try:
+                answer = {"results": self.server.answer(json.loads(line))}
+            except (ValueError, KeyError, TypeError) as e:
+                answer = {"error": "bad request: {}".format(e)}
+            except Exception as e:
+                logging.exception("QueryHandler: exception answering %s", line)
+                answer = {"error": str(e)}
+            self.wfile.write(json.dumps(answer).encode() + b"\n")
+
+
+class QueryServer(socketserver.UnixStreamServer):
+    # Connections waiting to be accepted
+    request_queue_size = 64
+
+    def __init__(self, path: str, indexes: typing.Dict[str, Index], threads: int = 4, parallel: bool = False):
+        """
+        :param path: socket to listen on, a stale socket left by a server which is not running is replaced
+        :param indexes: dictionary of indexed directory -> index
+        :param threads: number of connections served concurrently
+        :param parallel: read the indexes concurrently in queries to all of them
+        """
+        self.indexes = indexes
+        self.federated: typing.Optional[Searcher] = None
+        if len(indexes) == 1:
+            self.federated = next(iter(indexes.values()))
+        elif indexes:
+            parts = list(indexes.values())
+            self.federated = MultiIndex(parts, collapse_duplicates=parts[0].collapse_duplicates, parallel=parallel)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="fusearch-query")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        remove_stale_socket(path)
+        super().__init__(path, QueryHandler)
+        # Queries can reveal the contents of the documents
+        os.chmod(path, 0o600)
+
+    def process_request(self, request, client_address) -> None:
+        self.executor.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address) -> None:
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def answer(self, request: dict) -> typing.List[dict]:
+        """:returns: results of a request, see the module documentation"""
+        txt = request["query"]
+        if not isinstance(txt, str):
+            raise TypeError("query must be a string")
+        k = int(request.get("k", DEFAULT_K))
+        snippets = bool(request.get("snippets", False))
+        boolean = bool(request.get("boolean", False))
+        if request.get("index"):
+            directory = os.path.abspath(request["index"])
+            if directory not in self.indexes:
+                raise ValueError("not an indexed directory: {}".format(directory))
+            searcher = self.indexes[directory]
+        elif self.federated is None:
+            raise ValueError("no indexes")
+        else:
+            searcher = self.federated
+        if boolean:
+            results = searcher.search(txt, k, snippets=snippets)
+        else:
+            results = searcher.top_k(txt, k, snippets=snippets)
+        return [result_dict(x) for x in results]
+
+    def server_close(self) -> None:
+        super().server_close()
+        self.executor.shutdown(wait=True)
+        try:
+            os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+
+
+def result_dict(result: tuple) -> dict:
+    """:returns: JSON serializable dictionary of a (url, score) or (url, score, snippet) result"""
+    answer = {"url": result[0], "score": result[1]}
+    if len(result) > 2:
+        answer["snippet"] = result[2]._asdict() if result[2] else None
+    return answer
+
+
+def remove_stale_socket(path: str) -> None:
+    """Remove the socket at path when no server is listening on it
+    :raises OSError: when a server is listening
+    """
+    if not os.path.exists(path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except (ConnectionRefusedError, FileNotFoundError):
+        logging.info("Removing stale socket %s", path)
+        os.remove(path)
+        return
+    finally:
+        sock.close()
+    raise OSError("A query server is already listening on {}".format(path))
@@ -0,0 +1,294 @@
+"""Read only snapshots of an index
+
+:func:`export_snapshot` writes the data queries need from an :class:`fusearch.index.Index` to a single flat file: the
+documents sorted by id with their lengths, urls and file shas, and the tokens sorted by their utf-8 bytes with their
+statistics, postings and positions, as written by :mod:`fusearch.postings`. :class:`Snapshot` opens it with mmap, so
+opening is constant time, queries don't go through sqlite and the pages are shared by all the processes with the
+snapshot open. Doc ids and postings are the ones of the index, rankings are the same as the ones of an index opened
+from the database. An index which added documents after loading its scorer statistics can rank differently, BM25 keeps
+the length normalizations until the average length drifts past its tolerance, see :class:`fusearch.scoring.BM25`. The
+scorer reads the document lengths from the mmap, see :class:`fusearch.scoring.SortedLengths`, with numpy it allocates an
+array of the per document normalizations on the first query. The first pattern query builds a :class:`fusearch.terms.TermDictionary` of all the
+terms, a few bytes per term.
+
+The file starts with the header, ``HEADER`` followed by the (offset, length) of each of the ``SECTIONS``. Integers are
+64 bit in the byte order of the machine which wrote the snapshot, recorded in the header. Variable length values are
+stored as a section of their concatenation and a section with the offset of each of them plus the end.
+
+Snapshots don't have the content of the documents, results have no snippets.
+"""
+
+import array
+import bisect
+import mmap
+import os
+import struct
+import sys
+import typing
+
+from pony.orm import db_session
+
+from . import postings
+from .index import Index, Searcher
+from .scoring import Scorer, SortedLengths
+from .terms import TermDictionary
+from .tokenizer import Tokenizer
+
+MAGIC = b"FUSESNAP"
+VERSION = 1
+SECTIONS = [
+    "doc_ids",
+    "lengths",
+    "url_offsets",
+    "urls",
+    "file_sha_offsets",
+    "file_shas",
+    "tok_offsets",
+    "toks",
+    "num_docs",
+    "max_tf",
+    "max_tf_norm",
+    "postings_offsets",
+    "postings",
+    "positions_offsets",
+    "positions",
+]
+# magic, version, little endian, number of documents, number of tokens
+HEADER = struct.Struct("<8sII2Q")
+SECTION = struct.Struct("<2Q")
+# Sections start at multiples of this, so that arrays can be cast in place
+ALIGNMENT = 8
+
+
+class _SnapshotWriter:
+    def __init__(self, f: typing.BinaryIO):
+        self.f = f
+        self.sections = {}
+        f.write(bytes(HEADER.size + SECTION.size * len(SECTIONS)))
+
+    def _align(self) -> None:
+        padding = -self.f.tell() % ALIGNMENT
+        self.f.write(bytes(padding))
+
+    def section(self, name: str, data: typing.Union[bytes, array.array]) -> None:
+        self._align()
+        start = self.f.tell()
+        self.f.write(data)
+        self.sections[name] = (start, self.f.tell() - start)
+
+    def values(self, name: str, offsets_name: str, values: typing.Iterable[bytes]) -> None:
+        """Write a section with the concatenation of values and one with their offsets"""
+        self._align()
+        start = self.f.tell()
+        offsets = array.array("q", [0])
+        end = 0
+        for value in values:
+            self.f.write(value)
+            end += len(value)
+            offsets.append(end)
+        self.sections[name] = (start, end)
+        self.section(offsets_name, offsets)
+
+    def finish(self, num_docs: int, num_toks: int) -> None:
+        self.f.seek(0)
+        self.f.write(HEADER.pack(MAGIC, VERSION, sys.byteorder == "little", num_docs, num_toks))
+        for name in SECTIONS:
+            self.f.write(SECTION.pack(*self.sections[name]))
+
+
+def export_snapshot(index: Index, path: str) -> None:
+    """Write a snapshot of index to path, atomically replacing it"""
+    tmp = path + ".tmp"
+    with db_session, open(tmp, "wb") as f:
+        # A single read transaction, the snapshot is consistent even if the index is being modified
+        connection = index._read_transaction()
+        writer = _SnapshotWriter(f)
+        documents = connection.execute('SELECT "id", "length", "url", "file_sha" FROM "Document" ORDER BY "id"')
+        doc_ids = array.array("q")
+        lengths = array.array("q")
+        urls = []
+        file_shas = []
+        for doc_id, length, url, file_sha in documents:
+            doc_ids.append(doc_id)
+            lengths.append(length)
+            urls.append(url.encode(errors="surrogatepass"))
+            file_shas.append(file_sha.encode() if file_sha else b"")
+        writer.section("doc_ids", doc_ids)
+        writer.section("lengths", lengths)
+        writer.values("urls", "url_offsets", urls)
+        writer.values("file_shas", "file_sha_offsets", file_shas)
+        # sqlite compares text with memcmp, the order of the utf-8 bytes
+        order = ' FROM "Token" ORDER BY "tok"'
+        toks = []
+        num_docs = array.array("q")
+        max_tf = array.array("q")
+        max_tf_norm = array.array("d")
+        for tok, tok_num_docs, tok_max_tf, tok_max_tf_norm in connection.execute(
+            'SELECT "tok", "num_docs", "max_tf", "max_tf_norm"' + order
+        ):
+            toks.append(tok.encode(errors="surrogatepass"))
+            num_docs.append(tok_num_docs)
+            max_tf.append(tok_max_tf)
+            max_tf_norm.append(tok_max_tf_norm)
+        writer.values("toks", "tok_offsets", toks)
+        writer.section("num_docs", num_docs)
+        writer.section("max_tf", max_tf)
+        writer.section("max_tf_norm", max_tf_norm)
+        # Blobs are streamed, they can be larger than memory
+        writer.values("postings", "postings_offsets", (x for x, in connection.execute('SELECT "postings"' + order)))
+        writer.values(
+            "positions", "positions_offsets", (x or b"" for x, in connection.execute('SELECT "positions"' + order))
+        )
+        writer.finish(len(doc_ids), len(toks))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, path)
+
+
+class _Values:
+    """Sequence of the variable length values of a section"""
+
+    def __init__(self, data: memoryview, offsets: memoryview):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.data[self.offsets[i] : self.offsets[i + 1]].tobytes()
+
+
+class Snapshot(Searcher):
+    """Queries over a snapshot written by :func:`export_snapshot`"""
+
+    def __init__(
+        self,
+        path: str,
+        tokenizer: Tokenizer,
+        scorer: Scorer = None,
+        cache_entries: int = 1024,
+        cache_memory: int = 64 * 1024 * 1024,
+        collapse_duplicates: bool = False,
+    ):
+        """
+        :param path: snapshot file
+        :param tokenizer: the tokenizer of the index, a class implementing :class:`tokenizer.Tokenizer`
+        :param scorer: A class implementing :class:`scoring.Scorer`, defaults to :class:`scoring.BM25`
+        :param cache_entries: maximum number of cached query results, 0 disables the cache
+        :param cache_memory: approximate maximum memory in bytes used by cached query results
+        :param collapse_duplicates: only return the best ranked of the documents with the same file contents
+        """
+        super().__init__(tokenizer, scorer, cache_entries, cache_memory, collapse_duplicates)
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, little_endian, self.doc_count, num_toks = HEADER.unpack_from(self._mmap)
+        error = None
+        if magic != MAGIC or version != VERSION:
+            error = "{} is not a version {} fusearch snapshot".format(path, VERSION)
+        elif bool(little_endian) != (sys.byteorder == "little"):
+            error = "{} was written on a machine with a different byte order".format(path)
+        if error:
+            self._mmap.close()
+            raise ValueError(error)
+        # Views of the mmap, they have to be released before closing it
+        self._views = [memoryview(self._mmap)]
+        sections = {}
+        for i, name in enumerate(SECTIONS):
+            sections[name] = SECTION.unpack_from(self._mmap, HEADER.size + i * SECTION.size)
+
+        def section(name: str, format: str = None) -> memoryview:
+            start, length = sections[name]
+            self._views.append(self._views[0][start : start + length])
+            if format:
+                self._views.append(self._views[-1].cast(format))
+            return self._views[-1]
+
+        self._doc_ids = section("doc_ids", "q")
+        self._lengths = section("lengths", "q")
+        self._urls_by_position = _Values(section("urls"), section("url_offsets", "q"))
+        self._file_shas_by_position = _Values(section("file_shas"), section("file_sha_offsets", "q"))
+        self._toks = _Values(section("toks"), section("tok_offsets", "q"))
+        self._num_docs = section("num_docs", "q")
+        self._max_tf = section("max_tf", "q")
+        self._max_tf_norm = section("max_tf_norm", "d")
+        self._postings = _Values(section("postings"), section("postings_offsets", "q"))
+        self._positions = _Values(section("positions"), section("positions_offsets", "q"))
+        assert len(self._doc_ids) == self.doc_count and len(self._toks) == num_toks
+        # Terms for pattern queries, built on first use
+        self._terms = None
+
+    def close(self) -> None:
+        # The scorer has arrays of the views
+        self.scorer.unload()
+        for view in reversed(self._views):
+            view.release()
+        self._mmap.close()
+
+    def _tok_position(self, tok: str) -> typing.Optional[int]:
+        key = tok.encode(errors="surrogatepass")
+        i = bisect.bisect_left(self._toks, key)
+        if i < len(self._toks) and self._toks[i] == key:
+            return i
+        return None
+
+    def _doc_position(self, doc_id: int) -> int:
+        return bisect.bisect_left(self._doc_ids, doc_id)
+
+    def _check_external_changes(self) -> None:
+        """Snapshots don't change"""
+        pass
+
+    def _load_scorer(self) -> None:
+        if not self.scorer.loaded:
+            # Lengths are read from the mmap, scorers don't copy them
+            self.scorer.load(SortedLengths(self._doc_ids, self._lengths))
+
+    def _term_postings(self, toks: typing.List[str], arrays: bool = False) -> typing.List[tuple]:
+        """:returns: list of (tok, num_docs, max_tf, max_tf_norm, doc ids, tfs) for the toks present
+        :param arrays: doc ids and tfs as numpy arrays instead of lists
+        """
+        decode = postings.decode_arrays if arrays else postings.decode
+        result = []
+        # Sorted by their utf-8 bytes, like the toks of the snapshot and the ones returned by the index
+        for tok in sorted(set(toks), key=lambda x: x.encode(errors="surrogatepass")):
+            i = self._tok_position(tok)
+            if i is not None:
+                result.append(
+                    (tok, self._num_docs[i], self._max_tf[i], self._max_tf_norm[i]) + decode(self._postings[i])
+                )
+        return result
+
+    def _term_positions(self, toks: typing.List[str]) -> dict:
+        """:returns: dictionary of tok -> positions aligned with the postings, for the toks with positions"""
+        result = {}
+        for tok in toks:
+            i = self._tok_position(tok)
+            if i is not None:
+                blob = self._positions[i]
+                if blob:
+                    result[tok] = postings.decode_positions(blob)
+        return result
+
+    def _match_terms(self, pattern, limit: int) -> typing.List[typing.Tuple[str, int]]:
+        """:returns: up to limit (term, edit distance) of the terms matching a :mod:`fusearch.terms` pattern, sorted by
+        distance then term"""
+        if self._terms is None:
+            self._terms = TermDictionary(self._toks[i].decode(errors="surrogatepass") for i in range(len(self._toks)))
+        return self._terms.expand(pattern, limit)
+
+    def _urls(self, doc_ids: typing.Iterable[int]) -> dict:
+        """:returns: dictionary of doc id -> url"""
+        return {
+            doc_id: self._urls_by_position[self._doc_position(doc_id)].decode(errors="surrogatepass")
+            for doc_id in doc_ids
+        }
+
+    def _file_shas(self, doc_ids: list) -> dict:
+        """:returns: dictionary of doc id -> file sha of the documents"""
+        return {doc_id: self._file_shas_by_position[self._doc_position(doc_id)].decode() or None for doc_id in doc_ids}
+
+    def _stored_contents(self, urls: typing.List[str]) -> dict:
+        """Snapshots don't have the contents
+        :returns: an empty dictionary"""
+        return {}
@@ -0,0 +1,171 @@
+"""Snippets of the documents matching a query, with the query terms highlighted
+
+At ingest the character offsets of the first occurrences of every token are recorded, see :func:`token_offsets`. They
+are stored sorted by token, the offsets of the query terms are found with a binary search without decoding the others,
+see :func:`encode_offsets`. A snippet is the window of the content with the most distinct query terms according to
+them: the content is stored in independently compressed blocks, see :func:`fusearch.util.compress_text`, only the
+blocks with the window are decompressed and only the window is tokenized to find the terms to highlight. Documents
+without recorded offsets get a snippet of their beginning.
+
+Only the best ranked ``MAX_SNIPPETS`` results of a query get one.
+"""
+
+import bisect
+from collections import defaultdict
+from itertools import accumulate
+import re
+import struct
+import typing
+
+from .model import Snippet
+from .postings import decode_varints, encode_varints
+from .tokenizer import Tokenizer
+from .util import decompress_text
+
+#: Occurrences of each token with a recorded offset
+MAX_OFFSETS = 8
+#: Results of a query with a snippet, the others get None
+MAX_SNIPPETS = 100
+#: Approximate length of a snippet in characters
+SNIPPET_CHARS = 240
+# Snippet boundaries are moved up to this many characters to not cut words
+_WORD_SLACK = 20
+_SPACE = re.compile(r"\s")
+
+
+def token_offsets(
+    spans: typing.Iterable[typing.Tuple[str, int, int]], max_offsets: int = MAX_OFFSETS
+) -> typing.Tuple[dict, dict]:
+    """:param spans: (token, start, end) as returned by :meth:`fusearch.tokenizer.Tokenizer.spans`
+    :returns: (tokfreq, offsets) dictionaries of token -> number of occurrences and token -> start offsets of its first
+    max_offsets occurrences
+    """
+    freq = defaultdict(int)
+    offsets = defaultdict(list)
+    for tok, start, _ in spans:
+        n = freq[tok]
+        freq[tok] = n + 1
+        if n < max_offsets:
+            offsets[tok].append(start)
+    return freq, offsets
+
+
+def encode_offsets(offsets: dict) -> bytes:
+    """:param offsets: dictionary of token -> sorted offsets, as returned by :func:`token_offsets`
+    :returns: the number of tokens followed, for each token in the order of their utf-8 bytes, by the end of the token
+    and the end of its offsets, little endian 32 bit integers, then the tokens and the delta encoded offsets of each
+    of them as varints, see :func:`fusearch.postings.encode_varints`
+    """
+    toks = sorted((tok.encode(errors="surrogatepass"), xs) for tok, xs in offsets.items() if xs)
+    ends = []
+    data = bytearray()
+    for _, xs in toks:
+        encode_varints((b - a for a, b in zip((0,) + tuple(xs), xs)), data)
+        ends.append(len(data))
+    tok_ends = accumulate(len(tok) for tok, _ in toks)
+    index = [x for pair in zip(tok_ends, ends) for x in pair]
+    return struct.pack("<I{}I".format(len(index)), len(toks), *index) + b"".join(tok for tok, _ in toks) + data
+
+
+class _EncodedOffsets:
+    """Sequence of the tokens of offsets encoded by :func:`encode_offsets`, sorted by their utf-8 bytes"""
+
+    def __init__(self, blob: bytes):
+        self.blob = blob
+        (self.count,) = struct.unpack_from("<I", blob)
+        self.toks_start = 4 + 8 * self.count
+        self.offsets_start = self.toks_start + self._ends(self.count - 1)[0]
+
+    def _ends(self, i: int) -> typing.Tuple[int, int]:
+        """:returns: end of the token i and of its offsets"""
+        return struct.unpack_from("<2I", self.blob, 4 + 8 * i) if i >= 0 else (0, 0)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def __getitem__(self, i: int) -> bytes:
+        return self.blob[self.toks_start + self._ends(i - 1)[0] : self.toks_start + self._ends(i)[0]]
+
+    def offsets(self, i: int) -> typing.List[int]:
+        start = self.offsets_start + self._ends(i - 1)[1]
+        return list(accumulate(decode_varints(self.blob[start : self.offsets_start + self._ends(i)[1]])))
+
+
+def decode_offsets(blob: bytes, toks: typing.Iterable[str] = None) -> dict:
+    """:param blob: offsets encoded by :func:`encode_offsets`
+    :param toks: only decode the offsets of these tokens, looked up without decoding the others. By default all of
+    them
+    :returns: dictionary of token -> offsets
+    """
+    encoded = _EncodedOffsets(blob)
+    if toks is None:
+        return {encoded[i].decode(errors="surrogatepass"): encoded.offsets(i) for i in range(len(encoded))}
+    offsets = {}
+    for tok in set(toks):
+        key = tok.encode(errors="surrogatepass")
+        i = bisect.bisect_left(encoded, key)
+        if i < len(encoded) and encoded[i] == key:
+            offsets[tok] = encoded.offsets(i)
+    return offsets
+
+
+def best_window(offsets: dict, toks: typing.Iterable[str], width: int = SNIPPET_CHARS) -> typing.Optional[int]:
+    """:returns: start of the window of width characters with the most distinct toks, then the most occurrences, or
+    None when none of the toks has offsets"""
+    occurrences = sorted((offset, tok) for tok in set(toks) for offset in offsets.get(tok, ()))
+    if not occurrences:
+        return None
+    best = None
+    counts = defaultdict(int)
+    j = 0
+    for i, (start, _) in enumerate(occurrences):
+        while j < len(occurrences) and occurrences[j][0] < start + width:
+            counts[occurrences[j][1]] += 1
+            j += 1
+        key = (len(counts), j - i)
+        if best is None or key > best[0]:
+            best = (key, start, occurrences[j - 1][0])
+        counts[occurrences[i][1]] -= 1
+        if not counts[occurrences[i][1]]:
+            del counts[occurrences[i][1]]
+    _, first, last = best
+    # Center the occurrences in the window
+    return max(0, first - (width - (last - first)) // 2)
+
+
+def make_snippet(
+    blob: bytes, offsets: typing.Optional[dict], toks: typing.Iterable[str], tokenizer: Tokenizer, width=SNIPPET_CHARS
+) -> Snippet:
+    """:param blob: content compressed with :func:`fusearch.util.compress_text`
+    :param offsets: token offsets of the content, see :func:`token_offsets`
+    :param toks: query tokens to highlight
+    """
+    toks = set(toks)
+    start = best_window(offsets, toks, width) if offsets else None
+    if start is None:
+        start = 0
+    text = decompress_text(blob, start, start + width + _WORD_SLACK)
+    begin = 0
+    end = min(len(text), width)
+    # Don't cut words
+    if start > 0:
+        space = _SPACE.search(text, 0, _WORD_SLACK)
+        begin = space.end() if space else 0
+    if end < len(text):
+        space = _SPACE.search(text, end, end + _WORD_SLACK)
+        end = space.start() if space else end
+    window = text[begin:end]
+    # Words with several tokens are highlighted once
+    highlights = sorted(set((a, b) for tok, a, b in tokenizer.spans(window) if tok in toks))
+    return Snippet(text=window, highlights=highlights, offset=start + begin)
+
+
+def highlight(snippet: Snippet, before: str = "**", after: str = "**") -> str:
+    """:returns: the text of the snippet with the highlights between before and after"""
+    parts = []
+    last = 0
+    for start, end in snippet.highlights:
+        parts.extend((snippet.text[last:start], before, snippet.text[start:end], after))
+        last = end
+    parts.append(snippet.text[last:])
+    return "".join(parts)
@@ -0,0 +1,52 @@
+"""Passing large objects between processes without pushing them through pipes
+
+A :class:`multiprocessing.Queue` pickles every object into a pipe: the data is copied by the sender's feeder thread, by
+the kernel and again by the receiver before unpickling, and the whole object sits in the receiver's memory twice. With a
+:class:`Spool` the sender pickles large objects into a file in a spool directory, in shared memory when available, and
+only the small handle goes through the queue. The receiver unpickles straight from a memory map of the file.
+"""
+
+import mmap
+import os
+import pickle
+import shutil
+import tempfile
+import typing
+
+SHM_DIR = "/dev/shm"
+
+
+class Spool:
+    def __init__(self, directory: str = None, threshold: int = 64 * 1024):
+        """
+        :param directory: where to create the spool directory, defaults to shared memory if available
+        :param threshold: objects whose pickle is smaller than this are passed inline in the handle
+        """
+        if directory is None and os.access(SHM_DIR, os.W_OK):
+            directory = SHM_DIR
+        self.directory = tempfile.mkdtemp(prefix="fusearch-spool-", dir=directory)
+        self.threshold = threshold
+
+    def put(self, obj) -> typing.Union[bytes, str]:
+        """:returns: a handle to put in a queue instead of obj, it can only be passed to :meth:`get` once"""
+        data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) < self.threshold:
+            return data
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        return path
+
+    def get(self, handle: typing.Union[bytes, str]):
+        """:returns: the object of a handle from :meth:`put`"""
+        if isinstance(handle, bytes):
+            return pickle.loads(handle)
+        try:
+            with open(handle, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                return pickle.loads(data)
+        finally:
+            os.unlink(handle)
+
+    def close(self) -> None:
+        """Remove the spool directory with the objects which were not received"""
+        shutil.rmtree(self.directory, ignore_errors=True)
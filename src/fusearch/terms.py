@@ -0,0 +1,386 @@
+"""In memory dictionary of the terms of an index, for prefix, wildcard and fuzzy queries
+
+Terms are sorted and stored in blocks of ``BLOCK_SIZE`` terms joined by newlines, tokens don't contain whitespace, with
+the first term of every block for binary search. That takes a few bytes per term instead of a Python string object
+each: millions of terms fit in tens of megabytes.
+
+The terms with a prefix are a contiguous range, so a prefix query is a binary search and a scan of its range. Wildcard
+patterns are matched with a regular expression over the blocks in the range of their literal prefix. Fuzzy queries
+walk the implicit trie of the sorted terms, the children of a prefix are found by binary search, stepping a
+:class:`LevenshteinAutomaton` which prunes the prefixes that can't be completed within the edit distance.
+
+Terms added later go to a small second dictionary, removed ones are filtered out, both are merged into the blocks when
+they grow.
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+import heapq
+import itertools
+import re
+import typing
+
+#: Query word ending in ``*``, the terms starting with prefix
+Prefix = namedtuple("Prefix", ["prefix"])
+#: Query word with ``*`` anywhere but at the end only, matching any sequence of characters
+Wildcard = namedtuple("Wildcard", ["pattern"])
+#: Query word ending in ``~`` or ``~N``, the terms within max_edits insertions, deletions or substitutions of term
+Fuzzy = namedtuple("Fuzzy", ["term", "max_edits"])
+
+BLOCK_SIZE = 128
+SEPARATOR = "\n"
+MAX_CHAR = chr(0x10FFFF)
+# Number of blocks kept split into their terms, lookups read a few blocks many times
+SPLIT_BLOCKS = 64
+# Maximum edit distance of fuzzy queries, the number of matching prefixes explodes past it
+MAX_EDITS = 2
+# Maximum number of terms a pattern of a query is expanded to
+MAX_EXPANSIONS = 64
+# Characters at the start of fuzzy query words which have to match exactly, like spell checkers do. Typos are seldom
+# in the first letter and it makes the lookup several times faster
+FUZZY_PREFIX_LENGTH = 1
+# Fuzzy matching checks every term of the ranges of the trie walk with at most this many terms instead of splitting them
+SCAN_TERMS = 16
+# The children of prefixes with more than this many terms are memoized, fuzzy queries try all the children of the
+# short prefixes
+CHILDREN_MIN_TERMS = 1024
+# Added and removed terms are merged into the blocks when there are more than this or a fraction of the terms
+COMPACT_MIN = 4096
+COMPACT_RATIO = 16
+
+
+def auto_max_edits(term: str) -> int:
+    """:returns: edit distance of a fuzzy query without explicit distance, none for very short terms, where any edit
+    matches unrelated words, and 1 for short ones"""
+    if len(term) <= 2:
+        return 0
+    if len(term) <= 5:
+        return 1
+    return MAX_EDITS
+
+
+class LevenshteinAutomaton:
+    """Automaton accepting the strings within max_edits insertions, deletions and substitutions of term. A state is the
+    row of the edit distance matrix for the characters read so far, sparse: the positions in term with distance at
+    most max_edits and their distances. Transitions are memoized, it's a DFA built lazily."""
+
+    def __init__(self, term: str, max_edits: int):
+        self.term = term
+        self.max_edits = max_edits
+        self._chars = set(term)
+        # (state, character or "" for the ones not in term) -> state
+        self._transitions = {}
+
+    def start(self) -> typing.Tuple[tuple, tuple]:
+        positions = tuple(range(min(self.max_edits, len(self.term)) + 1))
+        return positions, positions
+
+    def step(self, state: typing.Tuple[tuple, tuple], c: str) -> typing.Tuple[tuple, tuple]:
+        # Characters which aren't in term have the same transitions
+        key = (state, c if c in self._chars else "")
+        next_state = self._transitions.get(key)
+        if next_state is None:
+            next_state = self._transitions[key] = self._step(state, key[1])
+        return next_state
+
+    def _step(self, state: typing.Tuple[tuple, tuple], c: str) -> typing.Tuple[tuple, tuple]:
+        term = self.term
+        max_edits = self.max_edits
+        positions, distances = state
+        new_positions = []
+        new_distances = []
+        if positions and positions[0] == 0 and distances[0] < max_edits:
+            new_positions.append(0)
+            new_distances.append(distances[0] + 1)
+        for j, i in enumerate(positions):
+            if i == len(term):
+                break
+            distance = distances[j] + (term[i] != c)
+            if new_positions and new_positions[-1] == i:
+                distance = min(distance, new_distances[-1] + 1)
+            if j + 1 < len(positions) and positions[j + 1] == i + 1:
+                distance = min(distance, distances[j + 1] + 1)
+            if distance <= max_edits:
+                new_positions.append(i + 1)
+                new_distances.append(distance)
+        return tuple(new_positions), tuple(new_distances)
+
+    @staticmethod
+    def can_match(state: typing.Tuple[tuple, tuple]) -> bool:
+        """:returns: whether some continuation of the characters read so far is accepted"""
+        return bool(state[0])
+
+    def next_chars(self, state: typing.Tuple[tuple, tuple]) -> typing.Optional[typing.List[str]]:
+        """:returns: the sorted characters with a transition to a state that can match, None when any can"""
+        if self.step(state, "")[0]:
+            return None
+        term = self.term
+        return sorted(set(term[i] for i in state[0] if i < len(term) and self.step(state, term[i])[0]))
+
+    def distance(self, state: typing.Tuple[tuple, tuple]) -> typing.Optional[int]:
+        """:returns: edit distance between term and the characters read so far, None when it's more than max_edits"""
+        positions, distances = state
+        if positions and positions[-1] == len(self.term):
+            return distances[-1]
+        return None
+
+    def match(self, s: str, state: typing.Tuple[tuple, tuple] = None) -> typing.Optional[int]:
+        """:returns: edit distance between term and s, None when it's more than max_edits
+        :param state: state after reading a prefix of s, s is the rest"""
+        state = state or self.start()
+        for c in s:
+            state = self.step(state, c)
+            if not state[0]:
+                return None
+        return self.distance(state)
+
+
+def _after_prefix(prefix: str) -> typing.Optional[str]:
+    """:returns: the first string after all the ones starting with prefix, None if there's none"""
+    prefix = prefix.rstrip(MAX_CHAR)
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class _SortedTerms:
+    """Immutable sorted sequence of unique terms stored in blocks"""
+
+    def __init__(self, terms: typing.List[str]):
+        """:param terms: sorted and unique"""
+        self._blocks = [SEPARATOR.join(terms[i : i + BLOCK_SIZE]) for i in range(0, len(terms), BLOCK_SIZE)]
+        self._firsts = terms[::BLOCK_SIZE]
+        self._length = len(terms)
+        # block number -> terms of the blocks read recently
+        self._split_blocks = {}
+        # prefix -> list of (character, lo, hi) of the terms starting with prefix + character, for large ranges
+        self._children = {}
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _block(self, b: int) -> typing.List[str]:
+        terms = self._split_blocks.get(b)
+        if terms is None:
+            if len(self._split_blocks) >= SPLIT_BLOCKS:
+                self._split_blocks.clear()
+            terms = self._split_blocks[b] = self._blocks[b].split(SEPARATOR)
+        return terms
+
+    def __getitem__(self, i: int) -> str:
+        return self._block(i // BLOCK_SIZE)[i % BLOCK_SIZE]
+
+    def __iter__(self) -> typing.Iterator[str]:
+        for block in self._blocks:
+            yield from block.split(SEPARATOR)
+
+    def __contains__(self, term: str) -> bool:
+        i = self.bisect_left(term)
+        return i < self._length and self[i] == term
+
+    def bisect_left(self, term: str, lo: int = 0, hi: int = None) -> int:
+        """:returns: position of the first term >= term, between lo and hi"""
+        hi = self._length if hi is None else hi
+        if lo >= hi:
+            return lo
+        b = lo // BLOCK_SIZE
+        start = b * BLOCK_SIZE
+        if hi - start <= BLOCK_SIZE:
+            # Within a block, the common case of the small ranges of the trie walk
+            return start + bisect_left(self._block(b), term, lo - start, hi - start)
+        b = bisect_right(self._firsts, term, b, (hi + BLOCK_SIZE - 1) // BLOCK_SIZE) - 1
+        i = 0 if b < 0 else b * BLOCK_SIZE + bisect_left(self._block(b), term)
+        return max(lo, min(i, hi))
+
+    def _prefix_end(self, prefix: str, lo: int = 0, hi: int = None) -> int:
+        """:returns: position after the last term starting with prefix, between lo and hi"""
+        end = _after_prefix(prefix)
+        if end is None:
+            return self._length if hi is None else hi
+        return self.bisect_left(end, lo, hi)
+
+    def prefix_range(self, prefix: str) -> typing.Tuple[int, int]:
+        """:returns: (lo, hi) positions of the terms starting with prefix"""
+        lo = self.bisect_left(prefix)
+        return lo, self._prefix_end(prefix, lo)
+
+    def range(self, lo: int, hi: int) -> typing.Iterator[str]:
+        """:returns: iterator over the terms from position lo to hi"""
+        for b in range(lo // BLOCK_SIZE, (hi + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            start = b * BLOCK_SIZE
+            yield from self._block(b)[max(lo - start, 0) : hi - start]
+
+    def search(self, regex: typing.Pattern, lo: int, hi: int) -> typing.List[str]:
+        """:returns: the terms matched by regex in the blocks of the terms from lo to hi, regex has to match whole lines
+        and only the terms in that range"""
+        result = []
+        for b in range(lo // BLOCK_SIZE, (hi + BLOCK_SIZE - 1) // BLOCK_SIZE):
+            result.extend(regex.findall(self._blocks[b]))
+        return result
+
+    def children(self, prefix: str, lo: int, hi: int) -> typing.List[typing.Tuple[str, int, int]]:
+        """:returns: list of (character, lo, hi) of the characters following prefix, in order, and the positions of the
+        terms starting with prefix + character, given lo, hi the positions of the terms starting with prefix and the
+        prefix itself not included"""
+        children = self._children.get(prefix)
+        if children is not None:
+            return children
+        children = []
+        depth = len(prefix)
+        size = hi - lo
+        while lo < hi:
+            c = self[lo][depth]
+            end = self._prefix_end(prefix + c, lo, hi)
+            children.append((c, lo, end))
+            lo = end
+        if size > CHILDREN_MIN_TERMS:
+            self._children[prefix] = children
+        return children
+
+    def fuzzy(self, automaton: LevenshteinAutomaton, prefix: str = "") -> typing.List[typing.Tuple[str, int]]:
+        """:returns: list of (term, distance) for the terms starting with prefix accepted by automaton, sorted by
+        term"""
+        result = []
+        state = automaton.start()
+        for c in prefix:
+            state = automaton.step(state, c)
+        if not state[0]:
+            return result
+        # Depth first walk of the trie in order, so that blocks are read one after the other. The terms with a prefix
+        # are the range lo, hi
+        stack = [self.prefix_range(prefix) + (prefix, state)]
+        while stack:
+            lo, hi, prefix, state = stack.pop()
+            depth = len(prefix)
+            if hi - lo <= SCAN_TERMS:
+                for term in self.range(lo, hi):
+                    distance = automaton.match(term[depth:], state)
+                    if distance is not None:
+                        result.append((term, distance))
+                continue
+            if len(self[lo]) == depth:
+                # The prefix itself sorts first
+                distance = automaton.distance(state)
+                if distance is not None:
+                    result.append((prefix, distance))
+                lo += 1
+            children = []
+            next_chars = automaton.next_chars(state)
+            if next_chars is None:
+                # Any character can follow, try every child
+                for c, child_lo, child_hi in self.children(prefix, lo, hi):
+                    child_state = automaton.step(state, c)
+                    if child_state[0]:
+                        children.append((child_lo, child_hi, prefix + c, child_state))
+            else:
+                # Only a few characters can follow, seek their ranges
+                for c in next_chars:
+                    lo = self.bisect_left(prefix + c, lo, hi)
+                    end = self._prefix_end(prefix + c, lo, hi)
+                    if lo < end:
+                        children.append((lo, end, prefix + c, automaton.step(state, c)))
+                    lo = end
+            stack.extend(reversed(children))
+        return result
+
+
+def wildcard_regex(pattern: str) -> typing.Pattern:
+    """:returns: regular expression matching the whole lines matched by the ``*`` wildcard pattern"""
+    body = "[^{}]*".format(re.escape(SEPARATOR)).join(re.escape(x) for x in pattern.split("*"))
+    return re.compile("^{}$".format(body), re.MULTILINE)
+
+
+class TermDictionary:
+    """Sorted set of terms with prefix, wildcard and fuzzy lookups, see the module documentation"""
+
+    def __init__(self, terms: typing.Iterable[str] = ()):
+        # (sorted terms, sorted terms added since, removed terms of the first ones), replaced as a whole when modified
+        self._state = (_SortedTerms(sorted(set(terms))), _SortedTerms([]), frozenset())
+        # Dictionary of the reversed terms for wildcards with a literal suffix longer than their literal prefix, like
+        # *ing, built on first use
+        self._reversed = None
+
+    def __len__(self) -> int:
+        terms, added, removed = self._state
+        return len(terms) + len(added) - len(removed)
+
+    def __contains__(self, term: str) -> bool:
+        terms, added, removed = self._state
+        return term in added or (term in terms and term not in removed)
+
+    def __iter__(self) -> typing.Iterator[str]:
+        terms, added, removed = self._state
+        return heapq.merge((x for x in terms if x not in removed), added)
+
+    def add(self, terms: typing.Iterable[str]) -> None:
+        old_terms, added, removed = self._state
+        terms = set(terms)
+        if self._reversed is not None:
+            self._reversed.add(x[::-1] for x in terms)
+        restored = terms & removed
+        new = [x for x in terms - restored if x not in old_terms and x not in added]
+        if new or restored:
+            self._update(old_terms, sorted(new + list(added)), removed - restored)
+
+    def remove(self, terms: typing.Iterable[str]) -> None:
+        old_terms, added, removed = self._state
+        terms = set(terms)
+        if self._reversed is not None:
+            self._reversed.remove(x[::-1] for x in terms)
+        in_old_terms = [x for x in terms if x in old_terms]
+        if any(x in added for x in terms) or not removed.issuperset(in_old_terms):
+            self._update(old_terms, [x for x in added if x not in terms], removed.union(in_old_terms))
+
+    def _update(self, terms: _SortedTerms, added: typing.List[str], removed: frozenset) -> None:
+        if len(added) + len(removed) > max(COMPACT_MIN, len(terms) // COMPACT_RATIO):
+            terms = _SortedTerms(list(heapq.merge((x for x in terms if x not in removed), added)))
+            added = []
+            removed = frozenset()
+        self._state = (terms, _SortedTerms(added), removed)
+
+    def prefix(self, prefix: str, limit: int = None) -> typing.List[str]:
+        """:returns: the first limit terms starting with prefix"""
+        result = []
+        terms, added, removed = self._state
+        for part in (terms, added):
+            matches = (x for x in part.range(*part.prefix_range(prefix)) if x not in removed)
+            result.extend(itertools.islice(matches, limit))
+        return sorted(result)[:limit]
+
+    def wildcard(self, pattern: str, limit: int = None) -> typing.List[str]:
+        """:returns: the first limit terms matching pattern, where ``*`` matches any sequence of characters"""
+        literals = pattern.split("*")
+        if len(literals[-1]) > len(literals[0]):
+            if self._reversed is None:
+                self._reversed = TermDictionary(x[::-1] for x in self)
+            return sorted(x[::-1] for x in self._reversed.wildcard(pattern[::-1]))[:limit]
+        regex = wildcard_regex(pattern)
+        literal_prefix = literals[0]
+        result = []
+        terms, added, removed = self._state
+        for part in (terms, added):
+            result.extend(x for x in part.search(regex, *part.prefix_range(literal_prefix)) if x not in removed)
+        return sorted(result)[:limit]
+
+    def fuzzy(
+        self, term: str, max_edits: int, limit: int = None, prefix_length: int = 0
+    ) -> typing.List[typing.Tuple[str, int]]:
+        """:returns: the limit closest (term, distance) within max_edits of term, sorted by distance then term
+        :param prefix_length: number of characters at the start of term which have to match exactly. Typos are seldom
+        in the first letters and each of them takes the walk down a single branch of the trie"""
+        automaton = LevenshteinAutomaton(term, max_edits)
+        result = []
+        terms, added, removed = self._state
+        for part in (terms, added):
+            result.extend(x for x in part.fuzzy(automaton, term[:prefix_length]) if x[0] not in removed)
+        return sorted(result, key=lambda x: (x[1], x[0]))[:limit]
+
+    def expand(self, pattern, limit: int = None) -> typing.List[typing.Tuple[str, int]]:
+        """:param pattern: a :class:`Prefix`, :class:`Wildcard` or :class:`Fuzzy`
+        :returns: up to limit (term, edit distance) matching pattern, sorted by distance then term. The distance is 0
+        for prefixes and wildcards, fuzzy terms start with the first FUZZY_PREFIX_LENGTH characters of the term"""
+        if isinstance(pattern, Prefix):
+            return [(x, 0) for x in self.prefix(pattern.prefix, limit)]
+        if isinstance(pattern, Wildcard):
+            return [(x, 0) for x in self.wildcard(pattern.pattern, limit)]
+        return self.fuzzy(pattern.term, pattern.max_edits, limit, FUZZY_PREFIX_LENGTH)
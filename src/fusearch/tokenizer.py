@@ -1,12 +1,21 @@
 from abc import ABC, abstractmethod
 from fusearch.config import Config
 from collections import defaultdict
+import re
+import typing
+
+# Built once, shared by the indexes of the process and inherited by forked worker processes
+_tokenizer = None
 
 
 def get_tokenizer(config: Config):
-    from fusearch.nltk_tokenizer import NLTKTokenizer
+    """:returns: the tokenizer, built on the first call, later calls and forked processes get the same one"""
+    global _tokenizer
+    if _tokenizer is None:
+        from fusearch.nltk_tokenizer import NLTKTokenizer
 
-    return NLTKTokenizer()
+        _tokenizer = NLTKTokenizer()
+    return _tokenizer
 
 
 def tokfreq(tokens: list) -> dict:
@@ -16,6 +25,14 @@ def tokfreq(tokens: list) -> dict:
     return tokfreq
 
 
+def positions(tokens: list) -> dict:
+    """:returns: dictionary of token -> list of positions in tokens"""
+    positions = defaultdict(list)
+    for i, tok in enumerate(tokens):
+        positions[tok].append(i)
+    return positions
+
+
 class Tokenizer(ABC):
     def __init__(self):
         pass
@@ -26,3 +43,18 @@ class Tokenizer(ABC):
     @abstractmethod
     def tokenize(self, x):
         pass
+
+    def tokenize_many(self, xs) -> list:
+        """:returns: list with the list of tokens of each text in xs"""
+        return [list(self.tokenize(x)) for x in xs]
+
+    def tokfreq(self, x) -> dict:
+        """:returns: dictionary of token -> number of occurrences in x"""
+        return tokfreq(self.tokenize(x))
+
+    def spans(self, x) -> typing.Iterable[typing.Tuple[str, int, int]]:
+        """:returns: (token, start, end) of the tokens of x in order, start and end delimit the word the token comes
+        from"""
+        for match in re.finditer(r"\S+", x):
+            for tok in self.tokenize(match.group()):
+                yield tok, match.start(), match.end()
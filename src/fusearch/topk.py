@@ -0,0 +1,144 @@
+"""Top-k retrieval with MaxScore dynamic pruning
+
+Scores are sums of per term contributions. Terms are ordered by the upper bound of their contribution, once the
+top k heap is full the terms whose accumulated upper bounds can't beat the k-th score become non essential: they are
+only used to complete the score of documents found in the essential terms, and are skipped over with binary search.
+
+For queries with many postings, :func:`dense_top_k` scores all of them with numpy instead, accumulating the scores of
+all the documents in a dense array and selecting the top k with a partial sort.
+"""
+
+from bisect import bisect_left
+from collections import namedtuple
+from itertools import accumulate
+import heapq
+import typing
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: weight and upper_bound are for the scoring function, doc_ids are sorted and tfs are the term frequencies
+TermPostings = namedtuple("TermPostings", ["weight", "upper_bound", "doc_ids", "tfs"])
+
+
+def max_score(
+    terms: typing.List[TermPostings], k: int, term_score: typing.Callable[[float, int, int], float]
+) -> typing.List[typing.Tuple[int, float]]:
+    """
+    :param terms: postings of the query terms
+    :param k: number of results
+    :param term_score: contribution of a term to the score of a document given (weight, tf, doc_id), must not exceed
+        the term upper_bound
+    :returns: list of (doc_id, score) sorted by descending score, ties by ascending doc id. Scores are summed in the
+        order of terms, like :func:`dense_scores`
+    """
+    if k <= 0:
+        return []
+    # Positions of the terms in the query, scores are summed in this order
+    order = sorted(range(len(terms)), key=lambda i: terms[i].upper_bound)
+    terms = [terms[i] for i in order]
+    n = len(terms)
+    # Upper bound of the score from terms[0..i]
+    cum_bound = list(accumulate(x.upper_bound for x in terms))
+    pos = [0] * n
+    lens = [len(x.doc_ids) for x in terms]
+    # Min heap of (score, -doc_id), the root is the k-th best result
+    heap = []
+    threshold = float("-inf")
+    # terms[first_essential:] are essential
+    first_essential = 0
+    while True:
+        doc_id = None
+        for i in range(first_essential, n):
+            if pos[i] < lens[i]:
+                candidate = terms[i].doc_ids[pos[i]]
+                if doc_id is None or candidate < doc_id:
+                    doc_id = candidate
+        if doc_id is None:
+            break
+        score = 0.0
+        # (position in the query, contribution) of the terms in the document
+        contributions = []
+        for i in range(first_essential, n):
+            p = pos[i]
+            term = terms[i]
+            if p < lens[i] and term.doc_ids[p] == doc_id:
+                contribution = term_score(term.weight, term.tfs[p], doc_id)
+                contributions.append((order[i], contribution))
+                score += contribution
+                pos[i] = p + 1
+        for i in range(first_essential - 1, -1, -1):
+            if score + cum_bound[i] <= threshold:
+                break
+            term = terms[i]
+            p = bisect_left(term.doc_ids, doc_id, pos[i])
+            pos[i] = p
+            if p < lens[i] and term.doc_ids[p] == doc_id:
+                contribution = term_score(term.weight, term.tfs[p], doc_id)
+                contributions.append((order[i], contribution))
+                score += contribution
+        else:
+            # Not pruned, the score summed in the order of the query terms. Floating point addition isn't associative,
+            # and sum() compensates rounding errors on recent Python versions
+            contributions.sort()
+            score = 0.0
+            for _, contribution in contributions:
+                score += contribution
+        if len(heap) < k:
+            heapq.heappush(heap, (score, -doc_id))
+        elif score > threshold:
+            heapq.heapreplace(heap, (score, -doc_id))
+        if len(heap) == k:
+            threshold = heap[0][0]
+            while first_essential < n and cum_bound[first_essential] <= threshold:
+                first_essential += 1
+    return [(-neg_doc_id, score) for score, neg_doc_id in sorted(heap, key=lambda x: (-x[0], -x[1]))]
+
+
+def dense_scores(
+    terms: typing.List[TermPostings],
+    doc_ids: "numpy.ndarray",
+    term_scores: typing.Callable[[float, "numpy.ndarray", "numpy.ndarray"], "numpy.ndarray"],
+) -> typing.Tuple["numpy.ndarray", "numpy.ndarray"]:
+    """Scores of all the documents in the postings, the terms are added in order. Needs numpy
+
+    :param terms: postings of the query terms with numpy arrays of doc ids and tfs, upper_bound is not used
+    :param doc_ids: sorted array of all the doc ids
+    :param term_scores: contributions of a term given (weight, tfs, positions of the documents in doc_ids)
+    :returns: arrays of the positions in doc_ids of the documents in any of the postings and their scores, sorted by
+        position
+    """
+    scores = numpy.zeros(len(doc_ids))
+    # Scores can be 0, with TFIDF
+    in_postings = numpy.zeros(len(doc_ids), dtype=bool)
+    for term in terms:
+        positions = numpy.searchsorted(doc_ids, term.doc_ids)
+        # Positions are unique within the postings of a term
+        scores[positions] += term_scores(term.weight, term.tfs, positions)
+        in_postings[positions] = True
+    matched = numpy.flatnonzero(in_postings)
+    return matched, scores[matched]
+
+
+def dense_top_k(
+    terms: typing.List[TermPostings],
+    k: int,
+    doc_ids: "numpy.ndarray",
+    term_scores: typing.Callable[[float, "numpy.ndarray", "numpy.ndarray"], "numpy.ndarray"],
+) -> typing.List[typing.Tuple[int, float]]:
+    """Same as :func:`max_score` without pruning, see :func:`dense_scores` for the parameters. Needs numpy
+
+    :returns: list of (doc_id, score) sorted by descending score, ties by ascending doc id
+    """
+    if k <= 0:
+        return []
+    positions, scores = dense_scores(terms, doc_ids, term_scores)
+    if len(scores) > k:
+        # The top k and the documents tied with the k-th, ties are resolved by doc id below
+        kth = scores[numpy.argpartition(-scores, k - 1)[:k]].min()
+        selected = numpy.flatnonzero(scores >= kth)
+        positions, scores = positions[selected], scores[selected]
+    order = numpy.lexsort((positions, -scores))[:k]
+    return list(zip(doc_ids[positions[order]].tolist(), scores[order].tolist()))
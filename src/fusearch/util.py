@@ -1,11 +1,22 @@
 import logging
-from typing import Any, Generator, List
+from typing import Any, Generator, List, Optional, Tuple
 import collections.abc
 import os
 import filetype
 import functools
+import hashlib
 import io
+import itertools
+import mimetypes
 import pickle
+import stat
+import struct
+import zlib
+
+#: Characters in each independently compressed block of :func:`compress_text`
+TEXT_BLOCK_CHARS = 8192
+# Block size in characters and number of blocks
+_TEXT_HEADER = struct.Struct("<2I")
 
 
 def uniq(xs: List[Any]) -> List[Any]:
@@ -18,17 +29,44 @@ def uniq(xs: List[Any]) -> List[Any]:
     return result
 
 
+def chunks(xs: collections.abc.Iterable, size: int) -> Generator[List[Any], None, None]:
+    """Split an iterable in lists of at most size elements"""
+    assert size > 0
+    it = iter(xs)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
 def file_extension(filepath) -> str:
     _, ext_ = os.path.splitext(filepath)
     ext = ext_.lower()
     return ext
 
 
+@functools.lru_cache(maxsize=1)
+def known_extensions() -> frozenset:
+    """:returns: extensions (without dot) with a known file type, files with these don't need content sniffing"""
+    mimetypes.init()
+    extensions = set(x.lstrip(".").lower() for x in mimetypes.types_map)
+    extensions.update(x.extension for x in filetype.types)
+    return frozenset(extensions)
+
+
+def normalize_extensions(extensions: collections.abc.Iterable) -> set:
+    """:returns: set of lowercase extensions without leading dot"""
+    return set(x.lstrip(".").lower() for x in extensions)
+
+
 def filetype_admissible(include_extensions: set, file):
-    ext = file_extension(file)
+    """:param include_extensions: extensions without leading dot, see :func:`normalize_extensions`"""
+    ext = file_extension(file).lstrip(".")
     if ext in include_extensions:
         return True
-    else:
+    elif not ext or ext not in known_extensions():
+        # Only sniff the content of files with no or unknown extension
         guess = filetype.guess(file)
         if guess and guess.extension in include_extensions:
             return True
@@ -48,11 +86,113 @@ def file_generator(path: str) -> collections.abc.Iterable:
 
 
 def file_generator_ext(path: str, extensions: list):
-    desired_filetype = functools.partial(filetype_admissible, set(extensions))
+    desired_filetype = functools.partial(filetype_admissible, normalize_extensions(extensions))
     files = filter(desired_filetype, file_generator(path))
     return files
 
 
+def scan_files(path: str) -> Generator[Tuple[str, os.stat_result], None, None]:
+    """Walk path with os.scandir
+    :returns: a generator of (absolute file path, stat) for every file under path, the stat is cached in the directory
+    entry so it's not repeated
+    """
+    stack = [os.path.abspath(path)]
+    while stack:
+        dirpath = stack.pop()
+        try:
+            with os.scandir(dirpath) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            yield entry.path, entry.stat()
+                    except OSError:
+                        logging.warning("scan_files: can't stat '%s'", entry.path)
+        except OSError:
+            logging.warning("scan_files: can't list '%s'", dirpath)
+
+
+def stat_files(paths: collections.abc.Iterable) -> Generator[Tuple[str, os.stat_result], None, None]:
+    """Like :func:`scan_files` for a list of files and directories, the ones which don't exist are skipped"""
+    for path in paths:
+        try:
+            stat_result = os.stat(path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(stat_result.st_mode):
+            yield from scan_files(path)
+        elif stat.S_ISREG(stat_result.st_mode):
+            yield os.path.abspath(path), stat_result
+
+
+def path_under(path: str, dirs: collections.abc.Container) -> bool:
+    """:returns: True if path or one of its parent directories is in dirs"""
+    while True:
+        if path in dirs:
+            return True
+        parent = os.path.dirname(path)
+        if parent == path:
+            return False
+        path = parent
+
+
+def file_state(stat_result: os.stat_result) -> Tuple[int, int]:
+    """:returns: (mtime, size) used to detect changed files"""
+    return int(stat_result.st_mtime), stat_result.st_size
+
+
+def file_unchanged(known: Tuple[int, Optional[int]], stat_result: os.stat_result) -> bool:
+    """:param known: (mtime, size) recorded in the index, size can be unknown"""
+    mtime, size = file_state(stat_result)
+    return known[0] == mtime and (known[1] is None or known[1] == size)
+
+
+def sha1_file(path: str, block_size: int = 1024 * 1024) -> str:
+    """:returns: hex sha1 of the contents of a file"""
+    ctx = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            ctx.update(block)
+    return ctx.hexdigest()
+
+
+def compress_text(text: str, level: int = 6, block_chars: int = TEXT_BLOCK_CHARS) -> bytes:
+    """:returns: text in blocks of block_chars characters, each one zlib compressed utf-8 on its own so that a part of
+    the text is decompressed without the rest, see :func:`decompress_text`. Lone surrogates from undecodable file
+    names are kept. The blob starts with block_chars, the number of blocks and the end of each compressed block, as
+    little endian 32 bit integers, followed by the blocks
+    """
+    blocks = [
+        zlib.compress(text[i : i + block_chars].encode(errors="surrogatepass"), level)
+        for i in range(0, len(text), block_chars)
+    ]
+    ends = list(itertools.accumulate(len(x) for x in blocks))
+    header = _TEXT_HEADER.pack(block_chars, len(blocks)) + struct.pack("<{}I".format(len(ends)), *ends)
+    return header + b"".join(blocks)
+
+
+def decompress_text(blob: bytes, start: int = 0, end: Optional[int] = None) -> str:
+    """:returns: the characters from start to end of a text compressed with :func:`compress_text`, only the blocks
+    with them are decompressed"""
+    block_chars, count = _TEXT_HEADER.unpack_from(blob)
+    first = start // block_chars
+    last = count if end is None else min(count, -(-end // block_chars))
+    if first >= last:
+        return ""
+    # Ends of the compressed blocks from first, the previous one ends where first begins
+    ends = struct.unpack_from("<{}I".format(last - first), blob, _TEXT_HEADER.size + 4 * first)
+    data = _TEXT_HEADER.size + 4 * count
+    begin = struct.unpack_from("<I", blob, _TEXT_HEADER.size + 4 * (first - 1))[0] if first else 0
+    parts = []
+    for block_end in ends:
+        parts.append(zlib.decompress(blob[data + begin : data + block_end]).decode(errors="surrogatepass"))
+        begin = block_end
+    text = "".join(parts)
+    offset = first * block_chars
+    return text[start - offset :] if end is None else text[start - offset : end - offset]
+
+
 def bytes_to_str(text):
     import chardet
 
@@ -0,0 +1,240 @@
+"""Filesystem change notifications for keeping an index fresh
+
+:class:`InotifyWatcher` uses Linux inotify through libc, :class:`PollingWatcher` periodically lists the directories and
+compares (mtime, size) snapshots. Both report the paths of changed and deleted files, and of directories which appeared
+and whose files need to be listed. :meth:`Watcher.changes` blocks until there are changes and waits for bursts of writes
+to settle before returning them.
+"""
+
+from abc import ABC, abstractmethod
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+import typing
+
+from .util import file_state, scan_files
+
+#: changed: new or modified files and new directories, deleted: removed files and directories, rescan: the events
+#: were lost and the watched paths need to be scanned
+Changes = namedtuple("Changes", ["changed", "deleted", "rescan"])
+
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR
+
+# struct inotify_event without the name: wd, mask, cookie, len
+_EVENT = struct.Struct("iIII")
+
+
+class Watcher(ABC):
+    def __init__(self, paths: typing.List[str]):
+        self.paths = [os.path.abspath(x) for x in paths]
+
+    @abstractmethod
+    def poll(self, timeout: typing.Optional[float]) -> typing.Optional[typing.List[typing.Tuple[str, bool]]]:
+        """Wait for events up to timeout seconds, forever if None
+        :returns: list of (path, deleted) in the order they happened, or None when events were lost
+        """
+        pass
+
+    def close(self) -> None:
+        pass
+
+    def changes(self, debounce: float = 2.0, max_delay: float = 30.0) -> Changes:
+        """Block until there are changes and return them once no more events arrive for debounce seconds, or max_delay
+        seconds after the first one"""
+        events = self.poll(None)
+        while events == []:
+            events = self.poll(None)
+        rescan = events is None
+        events = events or []
+        deadline = time.monotonic() + max_delay
+        while True:
+            timeout = min(debounce, deadline - time.monotonic())
+            if timeout <= 0:
+                break
+            more = self.poll(timeout)
+            if more is None:
+                rescan = True
+            elif not more:
+                break
+            else:
+                events.extend(more)
+        changed = set()
+        deleted = set()
+        # The last event of a path wins
+        for path, is_deleted in events:
+            if is_deleted:
+                deleted.add(path)
+                changed.discard(path)
+            else:
+                changed.add(path)
+                deleted.discard(path)
+        return Changes(changed, deleted, rescan)
+
+
+class PollingWatcher(Watcher):
+    """Lists the watched paths every interval seconds"""
+
+    def __init__(self, paths: typing.List[str], interval: float = 30.0):
+        super().__init__(paths)
+        self.interval = interval
+        self._snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self) -> typing.Dict[str, typing.Tuple[int, int]]:
+        return {file: file_state(stat_result) for path in self.paths for file, stat_result in scan_files(path)}
+
+    def poll(self, timeout: typing.Optional[float]) -> typing.Optional[typing.List[typing.Tuple[str, bool]]]:
+        wait = self._next_scan - time.monotonic()
+        if timeout is not None and timeout < wait:
+            time.sleep(max(timeout, 0))
+            return []
+        time.sleep(max(wait, 0))
+        self._next_scan = time.monotonic() + self.interval
+        snapshot = self._scan()
+        events = [(file, False) for file, state in snapshot.items() if self._snapshot.get(file) != state]
+        events.extend((file, True) for file in self._snapshot if file not in snapshot)
+        self._snapshot = snapshot
+        return events
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    # Raises AttributeError when not available
+    libc.inotify_init1.argtypes = [ctypes.c_int]
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    return libc
+
+
+class InotifyWatcher(Watcher):
+    """Watches every directory under the watched paths with inotify, waiting for events doesn't use CPU
+
+    Raises OSError when inotify is not available or there are not enough watches, see
+    /proc/sys/fs/inotify/max_user_watches
+    """
+
+    def __init__(self, paths: typing.List[str]):
+        super().__init__(paths)
+        self._lib = _libc()
+        self.fd = self._lib.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise self._error("inotify_init1")
+        # watch descriptor -> directory
+        self.dirs = {}
+        self._poll = select.poll()
+        self._poll.register(self.fd, select.POLLIN)
+        try:
+            for path in self.paths:
+                self._watch_tree(path)
+        except OSError:
+            self.close()
+            raise
+
+    @staticmethod
+    def _error(what: str, path: str = None) -> OSError:
+        err = ctypes.get_errno()
+        return OSError(err, "{}: {}".format(what, os.strerror(err)), path)
+
+    def _watch_tree(self, path: str) -> None:
+        for dirpath, _, _ in os.walk(path):
+            wd = self._lib.inotify_add_watch(self.fd, os.fsencode(dirpath), WATCH_MASK)
+            if wd < 0:
+                if ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                    # Removed while walking
+                    continue
+                raise self._error("inotify_add_watch", dirpath)
+            self.dirs[wd] = dirpath
+
+    def _unwatch_tree(self, path: str) -> None:
+        prefix = path + os.sep
+        for wd, dirpath in list(self.dirs.items()):
+            if dirpath == path or dirpath.startswith(prefix):
+                self._lib.inotify_rm_watch(self.fd, wd)
+                del self.dirs[wd]
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def _read(self) -> bytes:
+        chunks = []
+        while True:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                break
+            if not data:
+                break
+            chunks.append(data)
+        return b"".join(chunks)
+
+    def poll(self, timeout: typing.Optional[float]) -> typing.Optional[typing.List[typing.Tuple[str, bool]]]:
+        if not self._poll.poll(None if timeout is None else int(timeout * 1000)):
+            return []
+        data = self._read()
+        events = []
+        overflow = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.dirs.pop(wd, None)
+                continue
+            dirpath = self.dirs.get(wd)
+            if dirpath is None or not name:
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    # Files created before the watch is in place are found listing the directory
+                    try:
+                        self._watch_tree(path)
+                    except OSError:
+                        logging.exception("InotifyWatcher: can't watch '%s'", path)
+                    events.append((path, False))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    self._unwatch_tree(path)
+                    events.append((path, True))
+            elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO | IN_ATTRIB):
+                events.append((path, False))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                events.append((path, True))
+        if overflow:
+            logging.warning("InotifyWatcher: event queue overflow")
+            return None
+        return events
+
+
+def get_watcher(paths: typing.List[str], poll_interval: float = 30.0) -> Watcher:
+    """:returns: an inotify watcher for paths, or a polling one when inotify is not available"""
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError) as e:
+        logging.warning("inotify not available (%s), polling every %s seconds", e, poll_interval)
+        return PollingWatcher(paths, poll_interval)
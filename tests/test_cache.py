@@ -0,0 +1,109 @@
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+import os
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from fusearch.cache import LRUCache
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.tokenizer import Tokenizer, tokfreq
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.split()
+
+
+def document(url, content):
+    return Document(url, url, content, tokfreq(content.split()), 0)
+
+
+def test_lru_cache():
+    cache = LRUCache(max_entries=2, max_size=10)
+    cache.put("a", 1, 4)
+    cache.put("b", 2, 4)
+    eq_(cache.get("a"), 1)
+    cache.put("c", 3, 4)
+    # b was the least recently used, and the size limit holds two entries
+    ok_("b" not in cache)
+    eq_(cache.get("b"), None)
+    cache.put("d", 4, 8)
+    eq_(len(cache), 1)
+    eq_(cache.size, 8)
+    cache.put("e", 5, 11)
+    ok_("e" not in cache)
+    info = cache.info()
+    eq_((info.hits, info.misses), (1, 1))
+
+
+def test_index_query_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        bindargs = {"provider": "sqlite", "filename": os.path.join(tmp, "index.db"), "create_db": True}
+        index = Index(bindargs, NaiveTokenizer())
+        index.add_documents([document("/a", "x y"), document("/b", "y z")])
+        # Scores are summed in the order of the terms, not of the query, the key is the sorted terms
+        eq_(index.ranked("y x"), index.ranked("x y"))
+        eq_((index.cache_info().hits, index.cache_info().misses), (1, 1))
+        eq_(index.top_k("z", 1), [("/b", index.top_k("z", 1)[0][1])])
+
+        # Writes through the index invalidate
+        index.add_document(document("/c", "x"))
+        eq_(set(x[0] for x in index.ranked("x y")), {"/a", "/b", "/c"})
+
+        # Writes through other connections invalidate too
+        other = Index(bindargs, NaiveTokenizer())
+        other.add_document(document("/d", "x"))
+        eq_(set(x[0] for x in index.ranked("x y")), {"/a", "/b", "/c", "/d"})
+        eq_([x[0] for x in index.search("x NOT y")], ["/c", "/d"])
+
+        disabled = Index(bindargs, NaiveTokenizer(), cache_entries=0)
+        disabled.ranked("x")
+        disabled.ranked("x")
+        eq_(disabled.cache_info().entries, 0)
+
+
+def add_external(bindargs, url, content):
+    Index(bindargs, NaiveTokenizer()).add_document(document(url, content))
+
+
+def test_external_changes_threads():
+    """The connections of the query threads see external commits independently"""
+    with tempfile.TemporaryDirectory() as tmp:
+        bindargs = {"provider": "sqlite", "filename": os.path.join(tmp, "index.db"), "create_db": True}
+        index = Index(bindargs, NaiveTokenizer())
+        index.add_documents([document("/a", "x y"), document("/b", "x z")])
+        threads = [ThreadPoolExecutor(1) for _ in range(3)]
+        try:
+
+            def ranked(thread):
+                return set(x[0] for x in threads[thread].submit(index.ranked, "x").result())
+
+            expected = {"/a", "/b"}
+            eq_(ranked(0), expected)
+            eq_(ranked(2), expected)
+            # The first query after each commit comes from a different thread, the others have to notice it too
+            for url, first in (("/c", 1), ("/d", 0), ("/e", 2)):
+                writer = multiprocessing.Process(target=add_external, args=(bindargs, url, "x"))
+                writer.start()
+                writer.join()
+                eq_(writer.exitcode, 0)
+                expected.add(url)
+                eq_(ranked(first), expected)
+                for thread in range(3):
+                    eq_(ranked(thread), expected)
+            # Without external changes the cache and the scorer statistics are kept
+            hits = index.cache_info().hits
+            for thread in range(3):
+                ranked(thread)
+            eq_(index.cache_info().hits, hits + 3)
+        finally:
+            for thread in threads:
+                thread.shutdown()
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,44 @@
+import os
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from fusearch.extraction_cache import ExtractionCache
+
+
+def test_extraction_cache():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "cache", "extraction.db")
+        cache = ExtractionCache(path, version="1")
+        eq_(cache.get("a"), None)
+        cache.put("a", "some text ñ")
+        eq_(cache.get("a"), "some text ñ")
+        eq_((cache.hits, cache.misses), (1, 1))
+        cache.put("a", "other text")
+        eq_(cache.get("a"), "other text")
+        eq_(len(cache), 1)
+        # Shared by another process, other extractor versions don't see the entries
+        eq_(ExtractionCache(path, version="1").get("a"), "other text")
+        eq_(ExtractionCache(path, version="2").get("a"), None)
+
+
+def test_extraction_cache_eviction():
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ExtractionCache(os.path.join(tmp, "extraction.db"), max_size=10000, compress_level=0)
+        texts = {str(i): str(i) * 1000 for i in range(10)}
+        for key in ["0", "1", "2", "3", "4"]:
+            cache.put(key, texts[key])
+        # 0 is the most recently used
+        cache.get("0")
+        for key in ["5", "6", "7", "8", "9"]:
+            cache.put(key, texts[key])
+            ok_(cache.size <= 10000)
+        eq_(cache.get("0"), texts["0"])
+        eq_(cache.get("9"), texts["9"])
+        eq_(cache.get("1"), None)
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
@@ -1,3 +1,14 @@
+from unittest import SkipTest
+import multiprocessing
+import os
+import random
+import signal
+import sqlite3
+import tempfile
+import threading
+import time
+
+import fusearch.index
 from fusearch.index import Index
 from fusearch.tokenizer import Tokenizer, tokfreq
 from pony.orm import *
@@ -30,6 +41,260 @@ def test_query():
     eq_(set([x[0] for x in index.ranked("document")]), set(["/path/doc2.pdf", "/path/doc.pdf"]))
 
 
+def test_add_documents():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    contents = ["alpha beta", "beta gamma", "gamma delta"]
+    docs = (Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+    eq_(index.add_documents(docs, batch_size=2), 3)
+    eq_(index.doc_count, 3)
+    eq_(set([x[0] for x in index.ranked("gamma")]), set(["/path/1.txt", "/path/2.txt"]))
+    # Adding an existing url replaces the document
+    index.add_document(Document("/path/0.txt", "0", "omega", tk("omega"), 1))
+    eq_(index.doc_count, 3)
+    eq_([x[0] for x in index.ranked("alpha")], [])
+    eq_([x[0] for x in index.ranked("omega")], ["/path/0.txt"])
+    eq_(index.mtime("/path/0.txt"), 1)
+    eq_(index.content("/path/0.txt"), "omega")
+    eq_(index.content("/path/nada.txt"), None)
+
+
+def test_add_documents_bad_last():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    docs = [Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(["alpha", "beta"])]
+    # The tokfreq can't be summed, the bad document is alone in the last batch
+    docs.append(Document("/path/bad.txt", "bad", "gamma", {"gamma": "x"}, 0))
+    eq_(index.add_documents(docs, batch_size=2), 2)
+    eq_(index.doc_count, 2)
+    eq_([x[0] for x in index.ranked("beta")], ["/path/1.txt"])
+    eq_(index.content("/path/bad.txt"), None)
+    with assert_raises(TypeError):
+        index.add_document(docs[-1])
+    eq_(index.doc_count, 2)
+    eq_(index.content("/path/bad.txt"), None)
+
+
+def test_top_k():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    contents = ["a b c", "a a b", "c d e f", "b b b e", "e f g a", "g g a", "d"]
+    index.add_documents(Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+    for query in ["a", "b e", "g d f", "a b c d e f g", "nada"]:
+        ranked = index.ranked(query)
+        for k in [1, 2, 3, 10]:
+            top = index.top_k(query, k)
+            eq_(top, ranked[:k])
+    # Ties by doc id in both
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    index.add_documents([Document("/d0", "d0", "b", {"b": 1}, 0), Document("/d1", "d1", "a", {"a": 1}, 0)])
+    ranked = index.ranked("a b")
+    eq_([x[0] for x in ranked], ["/d0", "/d1"])
+    eq_(index.top_k("a b", 1), ranked[:1])
+
+
+def test_top_k_ranked():
+    rnd = random.Random(0)
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    # Few distinct lengths and frequencies, many ties
+    contents = [" ".join(rnd.choice("abcdefgh") for _ in range(rnd.randint(1, 4))) for _ in range(300)]
+    index.add_documents(Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+    queries = [" ".join(rnd.sample("abcdefgh", rnd.randint(1, 4))) for _ in range(30)]
+    dense_min_postings = fusearch.index.DENSE_MIN_POSTINGS
+    numpy = fusearch.index.numpy
+    try:
+        results = []
+        # Without numpy, and with numpy pruning or scoring all the postings of top k queries
+        for numpy_module, min_postings in ((None, dense_min_postings), (numpy, dense_min_postings), (numpy, 0)):
+            fusearch.index.numpy = numpy_module
+            fusearch.index.DENSE_MIN_POSTINGS = min_postings
+            index.query_cache.clear()
+            results.append([index.ranked(query) for query in queries])
+            for query, ranked in zip(queries, results[-1]):
+                for k in [1, 5, 20]:
+                    eq_(index.top_k(query, k), ranked[:k])
+        eq_(results[1], results[0])
+    finally:
+        fusearch.index.numpy = numpy
+        fusearch.index.DENSE_MIN_POSTINGS = dense_min_postings
+
+
+def test_dense_scores():
+    if fusearch.index.numpy is None:
+        raise SkipTest("needs numpy")
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    contents = ["a b c", "a a b", "c d e f", "b b b e", "e f g a", "g g a", "d", "a b", "b a"]
+    index.add_documents(Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+    index.remove_documents(["/path/2.txt"])
+    dense_min_postings = fusearch.index.DENSE_MIN_POSTINGS
+    fusearch.index.DENSE_MIN_POSTINGS = 0
+    try:
+        index.query_cache.clear()
+        for query in ["a", "b e", "g d f", "a b c d e f g", "nada"]:
+            ranked = index.ranked(query)
+            # Same scores as ranking the query results one by one
+            eq_(sorted(ranked), sorted(index.rank(index.query(query))))
+            for k in [1, 2, 3, 10]:
+                top = index.top_k(query, k)
+                # Terms are added in the same order, scores are identical
+                eq_([x[1] for x in top], [x[1] for x in ranked[:k]])
+    finally:
+        fusearch.index.DENSE_MIN_POSTINGS = dense_min_postings
+
+
+def test_many_terms():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    contents = [" ".join("t{}".format(j) for j in range(i, 1200, 7)) for i in range(7)]
+    index.add_documents(Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+    with db_session:
+        connection = index.db.get_connection()
+        if hasattr(connection, "setlimit"):
+            # The default of sqlite before 3.32
+            connection.setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    query = " ".join("t{}".format(j) for j in range(1200))
+    eq_(len(index.ranked(query)), 7)
+    eq_(len(index.top_k("t*", 10)), 7)
+    eq_(len(index.search(query.replace(" ", " OR "))), 7)
+
+
+def test_concurrent_queries():
+    with tempfile.TemporaryDirectory() as tmp:
+        # A file database, pony serializes the threads using an in memory one
+        bindargs = {"provider": "sqlite", "filename": os.path.join(tmp, "index.db"), "create_db": True}
+        index = Index(bindargs, NaiveTokenizer())
+        tk = compose(tokfreq, index.tokenizer.tokenize)
+        contents = ["a b", "b c", "c a a"]
+        index.add_documents(Document("/path/{}.txt".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+        expected = index.ranked("a")
+        index.query_cache.clear()
+        reading = threading.Event()
+        release = threading.Event()
+        term_postings = index._term_postings
+
+        def blocking_term_postings(toks, arrays=False):
+            if "a" in toks:
+                reading.set()
+                ok_(release.wait(30))
+            return term_postings(toks, arrays)
+
+        index._term_postings = blocking_term_postings
+        results = []
+        thread = threading.Thread(target=lambda: results.append(index.ranked("a")), daemon=True)
+        thread.start()
+        ok_(reading.wait(30))
+        # Other queries don't wait for the one in progress, reloading the statistics doesn't unload its scorer
+        eq_([x[0] for x in index.top_k("b", 1)], ["/path/0.txt"])
+        index.update()
+        eq_(len(index.query("c")), 2)
+        release.set()
+        thread.join(30)
+        ok_(not thread.is_alive())
+        eq_(results, [expected])
+
+
+def test_duplicates():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer(), collapse_duplicates=True)
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    contents = [("a a b", "x"), ("a a b", "x"), ("a b", "y"), ("b c", None), ("b c", None)]
+    index.add_documents(
+        Document("/path/{}.txt".format(i), str(i), x, tk(x), 0, file_sha=sha) for i, (x, sha) in enumerate(contents)
+    )
+    eq_(index.file_sizes(), {None})
+    ok_(index.has_file_sha("x"))
+    ok_(not index.has_file_sha("z"))
+    eq_(sorted(index.documents_by_file_sha(["x", "y", "z"])), ["x", "y"])
+    eq_(index.documents_by_file_sha(["y"])["y"].tokfreq, {"a": 1, "b": 1})
+    eq_(index.documents_by_file_sha(["y"])["y"].content, "a b")
+    # Copies collapse into the best ranked one, documents without file sha are never collapsed
+    eq_([x[0] for x in index.top_k("a", 1)], ["/path/0.txt"])
+    eq_([x[0] for x in index.top_k("a b", 10)], ["/path/0.txt", "/path/2.txt", "/path/3.txt", "/path/4.txt"])
+    eq_([x[0] for x in index.search("b", 10)], [x[0] for x in index.ranked("b")])
+    eq_(len(index.ranked("b")), 4)
+    eq_(index.remove_documents(["/path/0.txt", "/path/nada.txt"]), 1)
+    eq_(index.doc_count, 4)
+    eq_([x[0] for x in index.top_k("a", 1)], ["/path/1.txt"])
+    with db_session:
+        eq_(index.Content.select().count(), 4)
+
+
+def wal_writer(path):
+    """Add batches of documents to the index at path until killed"""
+    index = Index({"provider": "sqlite", "filename": path, "create_db": True}, NaiveTokenizer(), wal=True)
+    for i in range(10**6):
+        index.add_documents(
+            (
+                Document("/{}/{}.txt".format(i, j), "x", "x y{}".format(j), {"x": 1, "y" + str(j): 1}, 0)
+                for j in range(8)
+            ),
+            batch_size=8,
+        )
+
+
+def test_wal_snapshot():
+    with tempfile.TemporaryDirectory() as tmp:
+        bindargs = {"provider": "sqlite", "filename": os.path.join(tmp, "index.db"), "create_db": True}
+        writer = Index(bindargs, NaiveTokenizer(), wal=True)
+        reader = Index(bindargs, NaiveTokenizer(), wal=True)
+        writer.add_document(Document("/a", "a", "x y", {"x": 1, "y": 1}, 0))
+        with db_session:
+            reader._check_external_changes()
+            # Commits while the read transaction is open don't wait for it and aren't seen by it
+            thread = threading.Thread(
+                target=writer.add_document, args=(Document("/b", "b", "x", {"x": 1}, 0),), daemon=True
+            )
+            thread.start()
+            thread.join(30)
+            ok_(not thread.is_alive())
+            eq_(reader.Document.select().count(), 1)
+        eq_(set(x[0] for x in reader.ranked("x")), {"/a", "/b"})
+
+        # Queries don't wait for an uncommitted write either
+        connection = sqlite3.connect(bindargs["filename"], isolation_level=None)
+        connection.execute("BEGIN IMMEDIATE")
+        connection.execute('DELETE FROM "Document"')
+        start = time.monotonic()
+        eq_([x[0] for x in reader.top_k("y", 1)], ["/a"])
+        ok_(time.monotonic() - start < 5)
+        connection.execute("ROLLBACK")
+
+        writer.checkpoint()
+        eq_(os.path.getsize(bindargs["filename"] + "-wal"), 0)
+        # Without wal the database is left in WAL mode
+        other = Index(bindargs, NaiveTokenizer())
+        eq_(other.doc_count, 2)
+        eq_(connection.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        connection.close()
+
+
+def test_wal_kill():
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "index.db")
+        # Daemon, a failing test doesn't leave it writing
+        process = multiprocessing.Process(target=wal_writer, args=(path,), daemon=True)
+        process.start()
+        try:
+            deadline = time.monotonic() + 60
+            while not os.path.exists(path + "-wal") or os.path.getsize(path) + os.path.getsize(path + "-wal") < 2**20:
+                ok_(time.monotonic() < deadline and process.is_alive())
+                time.sleep(0.01)
+        finally:
+            # Process.kill needs Python 3.7
+            os.kill(process.pid, signal.SIGKILL)
+            process.join()
+        connection = sqlite3.connect(path)
+        eq_(connection.execute("PRAGMA integrity_check").fetchone()[0], "ok")
+        connection.close()
+        index = Index({"provider": "sqlite", "filename": path}, NaiveTokenizer(), wal=True)
+        # Whole batches
+        ok_(index.doc_count > 0)
+        eq_(index.doc_count % 8, 0)
+        eq_(len(index.ranked("x")), index.doc_count)
+        eq_(len(index.ranked("y3")), index.doc_count // 8)
+
+
 if __name__ == "__main__":
     import nose
 
@@ -0,0 +1,101 @@
+import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import urllib.request
+
+from nose.tools import eq_, ok_
+
+from fusearch.metrics import Histogram, MetricsServer, Registry, StatsWriter, merge_from
+
+
+def worker(queue, n):
+    from fusearch.metrics import REGISTRY, start_worker
+
+    start_worker(queue, interval=0)
+    for i in range(n):
+        REGISTRY.inc("docs_total", extension="txt")
+        REGISTRY.observe("extract_seconds", 0.002, extension="txt")
+    REGISTRY.send()
+
+
+def test_histogram():
+    histogram = Histogram()
+    eq_(histogram.quantile(0.5), 0.0)
+    for x in [0.0002] * 90 + [0.003] * 9 + [200]:
+        histogram.observe(x)
+    eq_(histogram.count, 100)
+    eq_(histogram.quantile(0.5), 0.00025)
+    eq_(histogram.quantile(0.95), 0.005)
+    eq_(histogram.quantile(1), float("inf"))
+
+
+def test_registry():
+    registry = Registry()
+    registry.inc("files_total", 3)
+    registry.inc("files_total")
+    with registry.timer("stage_seconds", stage='a "b"'):
+        pass
+    depth = [5]
+    registry.gauge_function("queue_depth", lambda: depth[0], queue="file")
+    registry.sample()
+    depth[0] = 2
+    stats = registry.as_dict()
+    eq_(stats["counters"], {"files_total": 4})
+    eq_(stats["gauges"], {'queue_depth{queue="file"}': 2, 'queue_depth_max{queue="file"}': 5})
+    eq_(stats["histograms"]['stage_seconds{stage="a \\"b\\""}']["count"], 1)
+    text = registry.prometheus_text()
+    ok_("# TYPE files_total counter\nfiles_total 4\n" in text)
+    ok_('stage_seconds_bucket{stage="a \\"b\\"",le="+Inf"} 1\n' in text)
+    ok_('stage_seconds_count{stage="a \\"b\\""} 1\n' in text)
+
+    other = Registry()
+    other.merge(registry.take())
+    other.merge({"counters": {("files_total", ()): 1}, "histograms": {}, "gauges": {}})
+    eq_(other.as_dict()["counters"], {"files_total": 5})
+    eq_(registry.as_dict()["counters"], {})
+
+
+def test_merge_from_workers():
+    registry = Registry()
+    queue = multiprocessing.Queue()
+    merger = merge_from(queue, registry, interval=0.1)
+    workers = [multiprocessing.Process(target=worker, args=(queue, n)) for n in (3, 4)]
+    for p in workers:
+        p.start()
+    for p in workers:
+        p.join()
+    queue.put(None)
+    merger.join()
+    stats = registry.as_dict()
+    eq_(stats["counters"], {'docs_total{extension="txt"}': 7})
+    eq_(stats["histograms"]['extract_seconds{extension="txt"}']["count"], 7)
+
+
+def test_stats_and_server():
+    registry = Registry()
+    registry.inc("files_total", 2)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "stats", "stats.json")
+        stats = StatsWriter(path, interval=60, registry=registry)
+        stats.close()
+        with open(path) as f:
+            eq_(json.load(f)["counters"], {"files_total": 2})
+
+    server = MetricsServer(("127.0.0.1", 0), registry)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        with urllib.request.urlopen(url) as response:
+            ok_(response.headers["Content-Type"].startswith("text/plain"))
+            eq_(response.read().decode(), registry.prometheus_text())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
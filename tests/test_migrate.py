@@ -0,0 +1,154 @@
+import array
+import json
+import os
+import sqlite3
+import tempfile
+import zlib
+
+from nose.tools import eq_, ok_
+
+from fusearch import migrate
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.snippets import decode_offsets, token_offsets
+from fusearch.tokenizer import Tokenizer, tokfreq
+from fusearch.util import decompress_text
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.split()
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE "Document" (
+  "url_sha" TEXT NOT NULL PRIMARY KEY,
+  "url" TEXT UNIQUE NOT NULL,
+  "filename" TEXT NOT NULL,
+  "mtime" INTEGER NOT NULL,
+  "content" TEXT NOT NULL,
+  "content_sha" TEXT NOT NULL,
+  "tokfreq" BLOB NOT NULL
+);
+CREATE TABLE "Token" (
+  "id" INTEGER PRIMARY KEY AUTOINCREMENT,
+  "tok" TEXT UNIQUE NOT NULL,
+  "doc_freq" INTEGER NOT NULL
+);
+CREATE TABLE "Document_Token" (
+  "document" TEXT NOT NULL REFERENCES "Document" ("url_sha") ON DELETE CASCADE,
+  "token" INTEGER NOT NULL REFERENCES "Token" ("id") ON DELETE CASCADE,
+  PRIMARY KEY ("document", "token")
+);
+CREATE INDEX "idx_document_token" ON "Document_Token" ("token");
+"""
+
+
+def test_migrate_legacy():
+    with tempfile.TemporaryDirectory() as tmp:
+        index_db = os.path.join(tmp, ".fusearch.db")
+        conn = sqlite3.connect(index_db)
+        conn.executescript(LEGACY_SCHEMA)
+        contents = {"/path/doc.pdf": "this is an example document example", "/path/doc2.pdf": "another document"}
+        for url, content in contents.items():
+            tokfreq = {}
+            for tok in content.split():
+                tokfreq[tok] = tokfreq.get(tok, 0) + 1
+            conn.execute(
+                "INSERT INTO Document VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, url, url, 0, content, "", json.dumps(tokfreq).encode()),
+            )
+        conn.commit()
+        conn.close()
+
+        index = Index({"provider": "sqlite", "filename": index_db}, NaiveTokenizer())
+        eq_(index.doc_count, 2)
+        eq_([x[0] for x in index.ranked("another")], ["/path/doc2.pdf"])
+        eq_(index.document_from_url("/path/doc.pdf")["length"], 6)
+
+        conn = sqlite3.connect(index_db)
+        eq_(conn.execute("PRAGMA user_version").fetchone()[0], migrate.SCHEMA_VERSION)
+        tables = set(x[0] for x in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+        eq_(tables & set(migrate.LEGACY_TABLES), {"Document", "Token"})
+        eq_(tables & set(x + migrate.LEGACY_SUFFIX for x in migrate.LEGACY_TABLES), set())
+        conn.close()
+
+
+def test_migrate_content_store():
+    with tempfile.TemporaryDirectory() as tmp:
+        index_db = os.path.join(tmp, ".fusearch.db")
+        index = Index({"provider": "sqlite", "filename": index_db, "create_db": True}, NaiveTokenizer())
+        contents = ["this is an example document example", "another document", "removed document"]
+        index.add_documents(
+            Document("/path/{}.pdf".format(i), str(i), x, tokfreq(x.split()), 0) for i, x in enumerate(contents)
+        )
+        index.remove_documents(["/path/2.pdf"])
+        index.db.disconnect()
+        # Back to the previous version, with the text in the Document table
+        conn = sqlite3.connect(index_db)
+        conn.execute('ALTER TABLE "Document" ADD COLUMN "content" TEXT NOT NULL DEFAULT \'\'')
+        for doc_id, text in conn.execute('SELECT "id", "text" FROM "Content"').fetchall():
+            conn.execute('UPDATE "Document" SET "content" = ? WHERE "id" = ?', (decompress_text(text), doc_id))
+        conn.execute('DROP TABLE "Content"')
+        conn.execute("PRAGMA user_version = {}".format(migrate.FILE_SHA))
+        conn.commit()
+        conn.close()
+
+        index = Index({"provider": "sqlite", "filename": index_db}, NaiveTokenizer())
+        eq_(index.content("/path/1.pdf"), "another document")
+        eq_([x[0] for x in index.ranked("another")], ["/path/1.pdf"])
+        conn = sqlite3.connect(index_db)
+        eq_(conn.execute("PRAGMA user_version").fetchone()[0], migrate.SCHEMA_VERSION)
+        ok_("content" not in set(x[1] for x in conn.execute('PRAGMA table_info("Document")')))
+        ok_("idx_document__file_sha" in set(x[1] for x in conn.execute('PRAGMA index_list("Document")')))
+        conn.close()
+        # Ids of removed documents are not reused
+        index.add_document(Document("/path/3.pdf", "3", "yet another", tokfreq(["yet", "another"]), 0))
+        eq_(index.document_from_url("/path/3.pdf")["id"], 4)
+
+
+def test_migrate_content_blocks():
+    with tempfile.TemporaryDirectory() as tmp:
+        index_db = os.path.join(tmp, ".fusearch.db")
+        index = Index({"provider": "sqlite", "filename": index_db, "create_db": True}, NaiveTokenizer())
+        contents = ["filler " * 100 + "cats and dogs", "dogs"]
+        for i, x in enumerate(contents):
+            freq, offsets = token_offsets(index.tokenizer.spans(x))
+            index.add_document(Document("/path/{}.pdf".format(i), str(i), x, freq, 0, offsets=offsets))
+        top = index.top_k("cats", 1, snippets=True)
+        index.db.disconnect()
+        # Back to the previous version, with the text compressed as a whole and offsets in the order of tokfreq
+        conn = sqlite3.connect(index_db)
+        rows = conn.execute(
+            'SELECT c."id", c."text", c."offsets", d."tokfreq" FROM "Content" c, "Document" d WHERE c."id" = d."id"'
+        ).fetchall()
+        for doc_id, text, offsets, freq in rows:
+            offsets = decode_offsets(offsets)
+            counts = bytearray()
+            deltas = array.array("I")
+            for tok in json.loads(freq):
+                xs = offsets.get(tok, [])
+                counts.append(len(xs))
+                deltas.extend(b - a for a, b in zip([0] + xs, xs))
+            conn.execute(
+                'UPDATE "Content" SET "text" = ?, "offsets" = ? WHERE "id" = ?',
+                (
+                    zlib.compress(decompress_text(text).encode()),
+                    zlib.compress(bytes(counts) + deltas.tobytes()),
+                    doc_id,
+                ),
+            )
+        conn.execute("PRAGMA user_version = {}".format(migrate.TOKEN_OFFSETS))
+        conn.commit()
+        conn.close()
+
+        index = Index({"provider": "sqlite", "filename": index_db}, NaiveTokenizer())
+        eq_(index.content("/path/0.pdf"), contents[0])
+        eq_(index.top_k("cats", 1, snippets=True), top)
+        ok_(top[0][2].offset > 0)
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,41 @@
+from unittest import SkipTest
+
+from nose.tools import eq_
+
+from fusearch import postings
+
+
+def test_varints():
+    xs = [0, 1, 127, 128, 300, 2**35]
+    eq_(postings.decode_varints(postings.encode_varints(xs, bytearray())), xs)
+
+
+def test_encode_append_remove():
+    blob = postings.encode([1, 5, 200], [3, 1, 1000])
+    eq_(postings.decode(blob), ([1, 5, 200], [3, 1, 1000]))
+    blob += postings.encode([201, 1000], [2, 7], base=200)
+    eq_(postings.decode(blob), ([1, 5, 200, 201, 1000], [3, 1, 1000, 2, 7]))
+    blob, num_docs, last_doc = postings.remove(blob, {5, 1000})
+    eq_((num_docs, last_doc), (3, 201))
+    eq_(postings.decode(blob), ([1, 200, 201], [3, 1000, 2]))
+
+
+def test_rebase():
+    blob = postings.encode([3, 200, 201], [1, 2, 3])
+    eq_(postings.decode(postings.rebase(blob, 0, 0)), ([3, 200, 201], [1, 2, 3]))
+    merged = postings.encode([1, 10], [5, 6]) + postings.rebase(blob, 1000, 10)
+    eq_(postings.decode(merged), ([1, 10, 1003, 1200, 1201], [5, 6, 1, 2, 3]))
+
+
+def test_decode_arrays():
+    if postings.numpy is None:
+        raise SkipTest("needs numpy")
+    for ids, tfs in [([], []), ([1, 5, 200], [3, 1, 1000]), ([1, 2**35, 2**35 + 1], [1, 2**20, 127])]:
+        doc_ids, arr_tfs = postings.decode_arrays(postings.encode(ids, tfs))
+        eq_((doc_ids.tolist(), arr_tfs.tolist()), (ids, tfs))
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
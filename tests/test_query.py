@@ -0,0 +1,138 @@
+from nose.tools import eq_, raises
+
+from fusearch import query
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.query import And, Not, Or, Phrase, Term
+from fusearch.terms import Fuzzy, Prefix, Wildcard
+from fusearch.tokenizer import Tokenizer, positions, tokfreq
+
+STOPWORDS = {"the", "of", "and"}
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return [tok for tok in x.lower().replace("-", " ").split() if tok not in STOPWORDS]
+
+
+def test_parse():
+    tokenize = NaiveTokenizer().tokenize
+    eq_(query.parse("gradient descent", tokenize), And((Term("gradient"), Term("descent"))))
+    eq_(query.parse('"gradient descent"', tokenize), Phrase(("gradient", "descent")))
+    eq_(
+        query.parse("a OR b AND NOT (c OR d)", tokenize),
+        Or((Term("a"), And((Term("b"), Not(Or((Term("c"), Term("d")))))))),
+    )
+    eq_(query.parse("the state-of-the-art", tokenize), Phrase(("state", "art")))
+    eq_(query.parse("the", tokenize), None)
+    eq_(query.parse("", tokenize), None)
+
+
+def test_patterns():
+    tokenize = NaiveTokenizer().tokenize
+    eq_(query.patterns("Grad*", tokenize), [Prefix("grad")])
+    eq_(query.patterns("g*nt", tokenize), [Wildcard("g*nt")])
+    eq_(query.patterns("*ent", tokenize), [Wildcard("*ent")])
+    eq_(query.patterns("Gradeint~", tokenize), [Fuzzy("gradeint", 2)])
+    eq_(query.patterns("dscent~1", tokenize), [Fuzzy("dscent", 1)])
+    eq_(query.patterns("the~", tokenize), [])
+    eq_(query.patterns("gradient", tokenize), None)
+    eq_(query.patterns("*", tokenize), None)
+    eq_(
+        query.split_patterns("stochastic grad* descnt~", tokenize),
+        ("stochastic    ", [Prefix("grad"), Fuzzy("descnt", 2)]),
+    )
+
+    def expand(patterns):
+        return {"grad": ["gradient", "grade"], "descnt": ["descent"], "x": []}[patterns[0][0]]
+
+    eq_(query.parse("grad* descnt~", tokenize, expand), And((Or((Term("gradient"), Term("grade"))), Term("descent"))))
+    eq_(query.parse("grad* OR x*", tokenize, expand), Or((Or((Term("gradient"), Term("grade"))), Or(()))))
+    eq_(query.parse("grad*", tokenize), Term("grad*"))
+
+
+@raises(query.QuerySyntaxError)
+def test_parse_error():
+    query.parse("(a OR b", NaiveTokenizer().tokenize)
+
+
+def test_set_operations():
+    a = [1, 3, 5, 7, 9, 100, 200]
+    b = list(range(0, 300, 2)) + [9, 199]
+    b.sort()
+    eq_(query.intersect(a, b), [9, 100, 200])
+    eq_(query.difference(a, b), [1, 3, 5, 7])
+    eq_(query.union([a, b[:5]]), [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 100, 200])
+    for i, x in enumerate(b):
+        eq_(query.gallop(b, x), i)
+
+
+def test_search():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    contents = [
+        "gradient descent of the loss",
+        "descent gradient",
+        "the gradient of a slope and its descent",
+        "stochastic gradient descent",
+        "nothing here",
+    ]
+    docs = []
+    for i, content in enumerate(contents):
+        tokens = index.tokenizer.tokenize(content)
+        docs.append(Document("/doc/{}".format(i), str(i), content, tokfreq(tokens), 0, positions(tokens)))
+    index.add_documents(docs[:3])
+    # Documents without positions in between
+    index.add_document(docs[3]._replace(positions=None))
+    index.add_document(docs[4])
+
+    def urls(txt):
+        return sorted(x[0] for x in index.search(txt))
+
+    eq_(urls("gradient descent"), ["/doc/0", "/doc/1", "/doc/2", "/doc/3"])
+    eq_(urls('"gradient descent"'), ["/doc/0"])
+    eq_(urls('"descent of the loss"'), ["/doc/0"])
+    eq_(urls("gradient NOT slope"), ["/doc/0", "/doc/1", "/doc/3"])
+    eq_(urls("NOT gradient"), ["/doc/4"])
+    eq_(urls("stochastic OR nothing"), ["/doc/3", "/doc/4"])
+    eq_(urls("(stochastic OR slope) AND descent"), ["/doc/2", "/doc/3"])
+    eq_(urls("gradient AND missing"), [])
+    eq_(len(index.search("gradient", k=2)), 2)
+
+    # Removing a document keeps the positions aligned
+    index.add_document(Document("/doc/0", "0", "other", {"other": 1}, 0, {"other": [0]}))
+    eq_(urls('"gradient descent"'), [])
+    eq_(urls('"descent gradient"'), ["/doc/1"])
+
+
+def test_search_patterns():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    contents = ["gradient descent", "graded exam", "stochastic gradients", "nothing here"]
+    for i, content in enumerate(contents):
+        index.add_document(Document("/doc/{}".format(i), str(i), content, tokfreq(content.split()), 0))
+
+    def urls(txt):
+        return sorted(x[0] for x in index.search(txt))
+
+    eq_(urls("grad*"), ["/doc/0", "/doc/1", "/doc/2"])
+    eq_(urls("Grad* AND NOT stochastic"), ["/doc/0", "/doc/1"])
+    eq_(urls("gra*nt"), ["/doc/0"])
+    eq_(urls("*ients"), ["/doc/2"])
+    eq_(urls("gradient~1"), ["/doc/0", "/doc/2"])
+    eq_(urls("gradeint~"), ["/doc/0"])
+    eq_(urls("gradeint~1"), [])
+    eq_(urls("rgadient~"), [])
+    eq_(urls("descent AND missing*"), [])
+    eq_(sorted(x[0] for x in index.top_k("stochastc~1 nothing")), ["/doc/2", "/doc/3"])
+    eq_(sorted(x[0] for x in index.ranked("exa*")), ["/doc/1"])
+    # The term dictionary follows the changes of the index
+    index.add_document(Document("/doc/4", "4", "gradual", {"gradual": 1}, 0))
+    index.remove_documents(["/doc/1"])
+    eq_(urls("grad*"), ["/doc/0", "/doc/2", "/doc/4"])
+    eq_(urls("exa*"), [])
+    eq_(sorted(index._expand([Prefix("")])), sorted(set(" ".join(contents[:1] + contents[2:] + ["gradual"]).split())))
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,78 @@
+import array
+import math
+from unittest import SkipTest
+
+from nose.tools import eq_, ok_
+
+import fusearch.scoring
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.scoring import BM25, TFIDF, SortedLengths
+from fusearch.tokenizer import Tokenizer, tokfreq
+from fusearch.util import compose
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.split()
+
+
+def test_bm25_incremental():
+    incremental = BM25(tolerance=0)
+    incremental.load([])
+    lengths = [(1, 10), (2, 3), (3, 40), (4, 7)]
+    for doc_id, length in lengths:
+        incremental.add(doc_id, length)
+    incremental.remove(3)
+    full = BM25()
+    full.load(x for x in lengths if x[0] != 3)
+    eq_(incremental.doc_count, 3)
+    eq_(incremental.avg_length, full.avg_length)
+    for doc_id in [1, 2, 4]:
+        ok_(math.isclose(incremental.norms[doc_id], full.norms[doc_id]))
+    ok_(math.isclose(incremental.weight(1), full.weight(1)))
+    # Scores never exceed the upper bound
+    weight = full.weight(2)
+    bound = full.upper_bound(weight, 5, 0.0)
+    ok_(all(full.term_score(weight, tf, doc_id) <= bound for tf in range(1, 6) for doc_id in [1, 2, 4]))
+
+
+def test_tfidf_scorer():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer(), scorer=TFIDF())
+    tk = compose(tokfreq, index.tokenizer.tokenize)
+    contents = ["this is an example document example", "this is an another document days go by"]
+    index.add_documents(Document("/path/{}.pdf".format(i), str(i), x, tk(x), 0) for i, x in enumerate(contents))
+    ranked = index.ranked("example another")
+    eq_([x[0] for x in ranked], ["/path/0.pdf", "/path/1.pdf"])
+    ok_(math.isclose(ranked[0][1], 2 * math.log(2) / 6))
+    eq_(index.top_k("example another", 1), ranked[:1])
+
+
+def test_sorted_lengths():
+    lengths = [(1, 10), (2, 3), (5, 40), (9, 7)]
+    for scorer_class in (BM25, TFIDF):
+        loaded = scorer_class()
+        loaded.load(lengths)
+        mapped = scorer_class()
+        mapped.load(
+            SortedLengths(memoryview(array.array("q", [1, 2, 5, 9])), memoryview(array.array("q", [10, 3, 40, 7])))
+        )
+        eq_((mapped.doc_count, mapped.avg_length), (loaded.doc_count, loaded.avg_length))
+        eq_(dict(mapped.lengths), dict(loaded.lengths))
+        weight = loaded.weight(2)
+        eq_(
+            [mapped.term_score(weight, 3, x) for x, _ in lengths], [loaded.term_score(weight, 3, x) for x, _ in lengths]
+        )
+        if fusearch.scoring.numpy is None:
+            raise SkipTest("needs numpy")
+        numpy = fusearch.scoring.numpy
+        eq_(mapped.doc_ids.tolist(), loaded.doc_ids.tolist())
+        tfs = numpy.array([1, 2, 3, 4])
+        positions = numpy.arange(4)
+        eq_(mapped.term_scores(weight, tfs, positions).tolist(), loaded.term_scores(weight, tfs, positions).tolist())
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
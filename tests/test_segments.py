@@ -0,0 +1,151 @@
+import os
+import tempfile
+import threading
+
+from nose.tools import eq_, ok_
+
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.multi_index import MultiIndex
+from fusearch.segments import list_segments, live_index, merge_segments, write_segment
+from fusearch.tokenizer import Tokenizer, positions, tokfreq
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.split()
+
+
+CONTENTS = ["a b c", "a a b", "c d e f", "b b b e", "e f g a", "g g a", "d", "a b d d", "f e"]
+QUERIES = ["a", "b e", "g d f", "a b c d e f g", "nada", "*", "ab~1", "na* g"]
+
+
+def documents(contents, positional=False):
+    docs = []
+    for i, content in enumerate(contents):
+        tokens = content.split()
+        docs.append(
+            Document(
+                "/path/{}.txt".format(i), str(i), content, tokfreq(tokens), 0, positions(tokens) if positional else None
+            )
+        )
+    return docs
+
+
+def memory_index():
+    return Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+
+
+def rounded(results):
+    return [(url, round(score, 9)) for url, score in results]
+
+
+def test_merge_segment():
+    docs = documents(CONTENTS, positional=True)
+    expected = memory_index()
+    expected.add_documents(docs[:4])
+    # Replaces the first version of doc 2
+    expected.add_documents(docs[4:] + [docs[2]._replace(content="a f", tokfreq={"a": 1, "f": 1}, positions=None)])
+    with tempfile.TemporaryDirectory() as directory:
+        index = memory_index()
+        index.add_documents(docs[:4])
+        # Doc ids in the segments start at 1 too
+        write_segment(directory, docs[4:7], NaiveTokenizer())
+        write_segment(directory, docs[7:], NaiveTokenizer())
+        write_segment(
+            directory, [docs[2]._replace(content="a f", tokfreq={"a": 1, "f": 1}, positions=None)], NaiveTokenizer()
+        )
+        eq_(len(list_segments(directory)), 3)
+        eq_(merge_segments(index, directory), 6)
+        eq_(list_segments(directory), [])
+    eq_(index.doc_count, len(CONTENTS))
+    eq_(
+        [x[2].text for x in index.top_k("f", 1, snippets=True)],
+        [x[2].text for x in expected.top_k("f", 1, snippets=True)],
+    )
+    for query in QUERIES + ["a AND f", '"e f"', '"a b" OR d']:
+        eq_(sorted(rounded(index.search(query))), sorted(rounded(expected.search(query))))
+    for query in QUERIES:
+        eq_(rounded(index.top_k(query, 3)), rounded(expected.top_k(query, 3)))
+        eq_(sorted(rounded(index.ranked(query))), sorted(rounded(expected.ranked(query))))
+
+
+def test_multi_index():
+    docs = documents(CONTENTS, positional=True)
+    single = memory_index()
+    single.add_documents(docs)
+    parts = [memory_index() for _ in range(3)]
+    parts[0].add_documents(docs[:4])
+    parts[1].add_documents(docs[4:5])
+    # Without positions
+    parts[2].add_documents(x._replace(positions=None) for x in docs[5:])
+    multi = MultiIndex(parts)
+    for query in QUERIES:
+        for k in (1, 3, 20):
+            eq_(rounded(multi.top_k(query, k)), rounded(single.top_k(query, k)))
+        eq_(sorted(rounded(multi.ranked(query))), sorted(rounded(single.ranked(query))))
+        eq_(sorted(rounded(multi.search(query))), sorted(rounded(single.search(query))))
+    # Phrases only match in the parts with positions
+    eq_(sorted(x[0] for x in multi.search('"e f"')), ["/path/2.txt", "/path/4.txt"])
+    eq_(sorted(rounded(multi.search("a AND NOT b"))), sorted(rounded(single.search("a AND NOT b"))))
+    # Changes to the parts are seen
+    parts[1].add_document(Document("/path/new.txt", "new", "nada", {"nada": 1}, 0))
+    eq_([x[0] for x in multi.top_k("nada")], ["/path/new.txt"])
+
+
+def test_multi_index_parallel():
+    docs = documents(CONTENTS)
+    # A copy of doc 0 in another part
+    docs[0] = docs[0]._replace(file_sha="0")
+    copy = docs[0]._replace(url="/copy/0.txt")
+    single = memory_index()
+    single.add_documents(docs + [copy])
+    with tempfile.TemporaryDirectory() as directory:
+        parts = []
+        for i, part_docs in enumerate([docs[:4], docs[4:5], docs[5:] + [copy]]):
+            bindargs = {"provider": "sqlite", "filename": os.path.join(directory, str(i)), "create_db": True}
+            parts.append(Index(bindargs, NaiveTokenizer(), wal=True))
+            parts[-1].add_documents(part_docs)
+        multi = MultiIndex(parts, parallel=True)
+        ok_(multi._executors is not None)
+        for query in QUERIES:
+            for k in (1, 3, 20):
+                eq_(rounded(multi.top_k(query, k)), rounded(single.top_k(query, k)))
+        collapsed = MultiIndex(parts, collapse_duplicates=True, parallel=True)
+        single.collapse_duplicates = True
+        single.query_cache.clear()
+        for query in QUERIES:
+            eq_(rounded(collapsed.top_k(query, 3)), rounded(single.top_k(query, 3)))
+        ok_("/copy/0.txt" in [x[0] for x in multi.top_k("a b c", 20)])
+        ok_("/copy/0.txt" not in [x[0] for x in collapsed.top_k("a b c", 20)])
+
+        # The part threads read the snapshot of the query, with WAL writers don't wait for it
+        count = lambda index: index.Document.select().count()
+        writer = Index({"provider": "sqlite", "filename": os.path.join(directory, "1")}, NaiveTokenizer(), wal=True)
+        with multi._session():
+            multi._check_external_changes()
+            before = multi._map_parts(count)
+            thread = threading.Thread(target=writer.add_documents, args=(documents(["z"]),))
+            thread.start()
+            thread.join()
+            eq_(multi._map_parts(count), before)
+        eq_(multi._map_parts(count), [before[0], before[1] + 1, before[2]])
+
+
+def test_live_index():
+    docs = documents(CONTENTS)
+    with tempfile.TemporaryDirectory() as directory:
+        index = memory_index()
+        index.add_documents(docs[:4])
+        write_segment(directory, docs[4:], NaiveTokenizer())
+        live = live_index(index, directory)
+        ok_("/path/8.txt" in [x[0] for x in live.ranked("f")])
+        eq_(merge_segments(index, directory), 5)
+        eq_(sorted(x[0] for x in index.ranked("f")), sorted(x[0] for x in live_index(index, directory).ranked("f")))
+        eq_(os.listdir(directory), [])
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
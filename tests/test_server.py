@@ -0,0 +1,104 @@
+import os
+import tempfile
+import threading
+
+from nose.tools import eq_, ok_, assert_raises
+
+from fusearch.client import Client, QueryError, highlight
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.multi_index import MultiIndex
+from fusearch.server import QueryServer
+from fusearch.tokenizer import Tokenizer, tokfreq
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.split()
+
+
+CONTENTS = ["a b c", "a a b", "c d e f", "b b b e", "e f g a"]
+
+
+def make_index(path, contents=CONTENTS, directory="/docs"):
+    index = Index({"provider": "sqlite", "filename": path, "create_db": True}, NaiveTokenizer())
+    index.add_documents(
+        Document("{}/{}.txt".format(directory, i), str(i), content, tokfreq(content.split()), 0)
+        for i, content in enumerate(contents)
+    )
+    return index
+
+
+def test_query_server():
+    with tempfile.TemporaryDirectory() as tmp:
+        index = make_index(os.path.join(tmp, "index.db"))
+        socket_path = os.path.join(tmp, "query.sock")
+        server = QueryServer(socket_path, {"/docs": index}, threads=2)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with Client(socket_path) as client:
+                results = client.query("a b", k=3)
+                eq_([(x["url"], x["score"]) for x in results], index.top_k("a b", 3))
+                # Same connection
+                results = client.query("b AND NOT a", boolean=True, snippets=True)
+                eq_([x["url"] for x in results], ["/docs/3.txt"])
+                eq_(highlight(results[0]["snippet"]), "**b** **b** **b** e")
+                eq_(client.query("a", index="/docs/"), client.query("a"))
+                with assert_raises(QueryError):
+                    client.query("a", index="/elsewhere")
+                with assert_raises(QueryError):
+                    client.request({"k": 1})
+
+            # Concurrent clients
+            answers = {}
+
+            def query(q):
+                with Client(socket_path) as client:
+                    answers[q] = client.query(q)
+
+            queries = ["a", "b", "c", "e f", "g", "nada"] * 4
+            threads = [threading.Thread(target=query, args=(q,)) for q in queries]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for q in queries:
+                eq_([(x["url"], x["score"]) for x in answers[q]], index.top_k(q))
+
+            # Only one server per socket
+            with assert_raises(OSError):
+                QueryServer(socket_path, {"/docs": index})
+        finally:
+            server.shutdown()
+            server.server_close()
+        ok_(not os.path.exists(socket_path))
+        # A stale socket is replaced
+        open(socket_path, "w").close()
+        QueryServer(socket_path, {"/docs": index}).server_close()
+
+
+def test_query_server_federated():
+    with tempfile.TemporaryDirectory() as tmp:
+        indexes = {
+            "/docs": make_index(os.path.join(tmp, "docs.db")),
+            "/more": make_index(os.path.join(tmp, "more.db"), ["a z", "z z b", "c"], "/more"),
+        }
+        socket_path = os.path.join(tmp, "query.sock")
+        server = QueryServer(socket_path, indexes)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            with Client(socket_path) as client:
+                # Scored with the statistics of both indexes
+                expected = MultiIndex(list(indexes.values())).top_k("a b z", 5)
+                eq_([(x["url"], x["score"]) for x in client.query("a b z", k=5)], expected)
+                eq_([x["url"] for x in client.query("z")], ["/more/1.txt", "/more/0.txt"])
+                eq_([x["url"] for x in client.query("c", index="/more")], ["/more/2.txt"])
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
@@ -0,0 +1,140 @@
+import os
+import tempfile
+
+from nose.tools import eq_, ok_, assert_raises
+from pony.orm import db_session
+
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.multi_index import MultiIndex
+from fusearch.snapshot import Snapshot, export_snapshot
+from fusearch.tokenizer import Tokenizer, positions, tokfreq
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.split()
+
+
+CONTENTS = ["a b c", "a a b", "c d e f", "b b b e", "e f g a", "g g a", "d", "a b d d", "f e", "ñ b"]
+QUERIES = [
+    "a",
+    "b e",
+    "g d f",
+    "a b c d e f g",
+    "ñ",
+    "nada",
+    '"e f"',
+    "a AND NOT b",
+    "(d OR g) AND NOT e",
+    "ñ*",
+    "ab~1 AND NOT e",
+]
+
+
+def test_snapshot():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    docs = []
+    for i, content in enumerate(CONTENTS):
+        tokens = content.split()
+        # Every other document with positions and a copy of another one
+        docs.append(
+            Document(
+                "/path/{}.txt".format(i),
+                str(i),
+                content,
+                tokfreq(tokens),
+                0,
+                positions(tokens) if i % 2 else None,
+                file_sha=str(i % 3),
+            )
+        )
+    index.add_documents(docs)
+    # Doc ids with gaps
+    index.remove_documents(["/path/1.txt", "/path/4.txt"])
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index.snapshot")
+        export_snapshot(index, path)
+        snapshot = Snapshot(path, NaiveTokenizer())
+        try:
+            eq_(snapshot.doc_count, index.doc_count)
+            for query in QUERIES:
+                eq_(snapshot.search(query), index.search(query))
+                for k in (1, 3, 20):
+                    eq_(snapshot.top_k(query, k), index.top_k(query, k))
+                    eq_(snapshot.search(query, k), index.search(query, k))
+                eq_(snapshot.ranked(query), index.ranked(query))
+            eq_(snapshot.top_k("a", snippets=True), [x + (None,) for x in index.top_k("a")])
+            index.collapse_duplicates = snapshot.collapse_duplicates = True
+            index.query_cache.clear()
+            snapshot.query_cache.clear()
+            for query in QUERIES:
+                eq_(snapshot.top_k(query, 3), index.top_k(query, 3))
+                eq_(snapshot.ranked(query), index.ranked(query))
+            ok_(len(snapshot.ranked("a b c d e f g")) < index.doc_count)
+        finally:
+            snapshot.close()
+        with open(path, "r+b") as f:
+            f.write(b"NOTASNAP")
+        with assert_raises(ValueError):
+            Snapshot(path, NaiveTokenizer())
+
+
+def test_snapshot_incremental():
+    with tempfile.TemporaryDirectory() as directory:
+        bindargs = {"provider": "sqlite", "filename": os.path.join(directory, "index.db"), "create_db": True}
+        index = Index(bindargs, NaiveTokenizer())
+        contents = CONTENTS * 10
+        index.add_documents(
+            Document("/path/{}.txt".format(i), str(i), x, tokfreq(x.split()), 0) for i, x in enumerate(contents)
+        )
+        # Loads the scorer statistics. The adds below move the average length less than the BM25 tolerance, the index
+        # keeps the normalizations of the documents it had
+        index.ranked("a")
+        for content in ["a h h h h", "b h"]:
+            contents.append(content)
+            i = len(contents) - 1
+            index.add_document(Document("/path/{}.txt".format(i), str(i), content, tokfreq(content.split()), 0))
+        path = os.path.join(directory, "index.snapshot")
+        export_snapshot(index, path)
+        snapshot = Snapshot(path, NaiveTokenizer())
+        try:
+            ok_(snapshot.ranked("a") != index.ranked("a"))
+            # Same rankings as an index opened from the database, and as this one once it reloads its statistics
+            opened = Index(bindargs, NaiveTokenizer())
+            index.update()
+            for query in QUERIES + ["h", "a h"]:
+                eq_(snapshot.ranked(query), opened.ranked(query))
+                eq_(snapshot.ranked(query), index.ranked(query))
+                eq_(snapshot.top_k(query, 3), index.top_k(query, 3))
+        finally:
+            snapshot.close()
+
+
+def test_term_postings_order():
+    # Tokens stored out of order, and some of them only in the second part
+    first = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    second = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    for index, contents in ((first, ["z y", "ñ"]), (second, ["b ñ", "a z"])):
+        index.add_documents(
+            Document("/path/{}.txt".format(i), str(i), content, tokfreq(content.split()), 0)
+            for i, content in enumerate(contents)
+        )
+    toks = ["z", "ñ", "a", "y", "b", "nada"]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "index.snapshot")
+        export_snapshot(first, path)
+        snapshot = Snapshot(path, NaiveTokenizer())
+        try:
+            with db_session:
+                eq_([x[0] for x in first._term_postings(toks)], ["y", "z", "ñ"])
+                eq_([x[0] for x in MultiIndex([first, second])._term_postings(toks)], ["a", "b", "y", "z", "ñ"])
+            eq_([x[0] for x in snapshot._term_postings(toks)], ["y", "z", "ñ"])
+        finally:
+            snapshot.close()
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
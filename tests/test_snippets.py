@@ -0,0 +1,97 @@
+from nose.tools import eq_, ok_
+
+from fusearch.index import Index
+from fusearch.model import Document
+from fusearch.snippets import (
+    MAX_SNIPPETS,
+    best_window,
+    decode_offsets,
+    encode_offsets,
+    highlight,
+    make_snippet,
+    token_offsets,
+)
+from fusearch.tokenizer import Tokenizer
+from fusearch.util import compress_text
+
+
+class NaiveTokenizer(Tokenizer):
+    def tokenize(self, x):
+        return x.lower().strip(".,").split()
+
+
+FILLER = " ".join("filler{}".format(i) for i in range(200))
+TEXT = "Intro about cats. " + FILLER + " Dogs chase cats, cats run from dogs. " + FILLER + " The end about dogs."
+
+
+def document(url, text, offsets=True):
+    freq, offsets_ = token_offsets(NaiveTokenizer().spans(text))
+    return Document(url, url, text, freq, 0, offsets=offsets_ if offsets else None)
+
+
+def test_token_offsets():
+    freq, offsets = token_offsets(NaiveTokenizer().spans("a b a c a"), max_offsets=2)
+    eq_(freq, {"a": 3, "b": 1, "c": 1})
+    eq_(offsets, {"a": [0, 4], "b": [2], "c": [6]})
+    blob = encode_offsets(offsets)
+    eq_(decode_offsets(blob), offsets)
+    eq_(decode_offsets(blob, ["c", "x", "a"]), {"a": [0, 4], "c": [6]})
+    eq_(decode_offsets(encode_offsets({})), {})
+
+
+def test_best_window():
+    offsets = {"cat": [0, 500, 520], "dog": [510, 900]}
+    start = best_window(offsets, ["cat", "dog"], width=100)
+    ok_(start <= 500 and start + 100 > 520)
+    eq_(best_window(offsets, ["bird"]), None)
+    eq_(best_window(offsets, ["dog"], width=100), 460)
+
+
+def test_make_snippet():
+    tokenizer = NaiveTokenizer()
+    _, offsets = token_offsets(tokenizer.spans(TEXT))
+    snippet = make_snippet(compress_text(TEXT), offsets, ["dogs", "cats"], tokenizer, width=60)
+    snippet_text = snippet.text
+    eq_(TEXT[snippet.offset : snippet.offset + len(snippet.text)], snippet.text)
+    ok_("Dogs chase cats, cats run from dogs." in snippet.text)
+    eq_(len(snippet.highlights), 4)
+    ok_("**Dogs** chase **cats,** **cats** run from **dogs.**" in highlight(snippet))
+    # Without offsets the snippet is the beginning
+    snippet = make_snippet(compress_text(TEXT), None, ["cats"], tokenizer, width=60)
+    eq_(snippet.offset, 0)
+    eq_(highlight(snippet, "[", "]")[:25], "Intro about [cats.] fille")
+    # Windows across blocks
+    for block_chars in (50, 100):
+        blob = compress_text(TEXT, block_chars=block_chars)
+        eq_(make_snippet(blob, offsets, ["dogs", "cats"], tokenizer, width=60).text, snippet_text)
+
+
+def test_index_snippets():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    index.add_documents([document("/a.txt", TEXT), document("/b.txt", "dogs only", offsets=False)])
+    top = index.top_k("dogs cats", 2, snippets=True)
+    eq_([x[0] for x in top], [x[0] for x in index.top_k("dogs cats", 2)])
+    eq_(top[0][2].text if top[0][0] == "/b.txt" else top[1][2].text, "dogs only")
+    snippet = dict((url, snippet) for url, _, snippet in top)["/a.txt"]
+    ok_("Dogs chase cats" in snippet.text)
+    ranked = index.ranked("dogs", snippets=1)
+    eq_(len(ranked), 2)
+    ok_(ranked[0][2] is not None)
+    eq_(ranked[1][2], None)
+    results = index.search("cats AND NOT birds", snippets=True)
+    eq_([(x[0], [x[2].text[a:b] for a, b in x[2].highlights][:1]) for x in results], [("/a.txt", ["cats,"])])
+
+
+def test_max_snippets():
+    index = Index({"provider": "sqlite", "filename": ":memory:"}, NaiveTokenizer())
+    index.add_documents([document("/{}.txt".format(i), "cats " * (i + 1)) for i in range(MAX_SNIPPETS + 2)])
+    for results in (index.top_k("cats", MAX_SNIPPETS + 2, snippets=True), index.search("cats", snippets=True)):
+        eq_(len(results), MAX_SNIPPETS + 2)
+        ok_(all(x[2] is not None for x in results[:MAX_SNIPPETS]))
+        eq_([x[2] for x in results[MAX_SNIPPETS:]], [None, None])
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
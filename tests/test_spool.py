@@ -0,0 +1,30 @@
+import os
+
+from nose.tools import eq_, ok_
+
+from fusearch.model import Document
+from fusearch.spool import Spool
+
+
+def test_spool():
+    spool = Spool(threshold=1024)
+    try:
+        small = Document("/path/a.txt", "a", "short", {"short": 1}, 0)
+        large = Document("/path/b.txt", "b", "long " * 1000, {"long": 1000}, 0)
+        small_handle = spool.put(small)
+        large_handle = spool.put(large)
+        ok_(isinstance(small_handle, bytes))
+        ok_(os.path.isfile(large_handle))
+        eq_(spool.get(small_handle), small)
+        eq_(spool.get(large_handle), large)
+        # Received objects don't take space
+        eq_(os.listdir(spool.directory), [])
+    finally:
+        spool.close()
+    ok_(not os.path.exists(spool.directory))
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
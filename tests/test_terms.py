@@ -0,0 +1,79 @@
+import fnmatch
+import random
+
+from nose.tools import eq_, ok_
+
+from fusearch import terms
+from fusearch.terms import LevenshteinAutomaton, TermDictionary
+
+
+def edit_distance(a, b):
+    row = list(range(len(b) + 1))
+    for i, x in enumerate(a, 1):
+        previous, row[0] = row[0], i
+        for j, y in enumerate(b, 1):
+            previous, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, previous + (x != y))
+    return row[-1]
+
+
+def words(n, seed=0):
+    rnd = random.Random(seed)
+    return sorted(set("".join(rnd.choices("abcde", k=rnd.randint(1, 7))) for _ in range(n)))
+
+
+def test_levenshtein_automaton():
+    candidates = words(300, seed=1) + [""]
+    for term in ["", "a", "abc", "baabed", "eeeeeee"]:
+        for max_edits in range(3):
+            automaton = LevenshteinAutomaton(term, max_edits)
+            for candidate in candidates:
+                distance = edit_distance(term, candidate)
+                eq_(automaton.match(candidate), distance if distance <= max_edits else None)
+
+
+def test_term_dictionary():
+    vocabulary = words(3000)
+    dictionary = TermDictionary(vocabulary[:2000])
+    dictionary.add(vocabulary[1900:2500])
+    dictionary.remove(vocabulary[100:150] + vocabulary[2100:2110] + ["missing"])
+    # Removed and added back
+    dictionary.add(vocabulary[100:110])
+    expected = sorted(set(vocabulary[:2500]) - set(vocabulary[110:150] + vocabulary[2100:2110]))
+    eq_(list(dictionary), expected)
+    eq_(len(dictionary), len(expected))
+    ok_(vocabulary[105] in dictionary and vocabulary[120] not in dictionary)
+    for prefix in ["", "a", "cab", "eeeeeee", "f"]:
+        eq_(dictionary.prefix(prefix), [x for x in expected if x.startswith(prefix)])
+    eq_(dictionary.prefix("b", 3), [x for x in expected if x.startswith("b")][:3])
+    for pattern in ["a*e", "*cd", "*c*d", "b*a*", "*", "ab*de*"]:
+        eq_(dictionary.wildcard(pattern), [x for x in expected if fnmatch.fnmatchcase(x, pattern)])
+    dictionary.add(["abcabcd"])
+    eq_(dictionary.wildcard("*cabcd"), ["abcabcd"])
+    for term in ["abcde", "e", "ddddddd", "aeaea"]:
+        for max_edits in range(3):
+            matches = [(x, edit_distance(term, x)) for x in dictionary if edit_distance(term, x) <= max_edits]
+            matches.sort(key=lambda x: (x[1], x[0]))
+            eq_(dictionary.fuzzy(term, max_edits), matches)
+            eq_(dictionary.fuzzy(term, max_edits, 5), matches[:5])
+            eq_(dictionary.fuzzy(term, max_edits, prefix_length=2), [x for x in matches if x[0].startswith(term[:2])])
+
+
+def test_compaction():
+    vocabulary = words(3000)
+    old_min = terms.COMPACT_MIN
+    terms.COMPACT_MIN = 10
+    try:
+        dictionary = TermDictionary(vocabulary[::2])
+        dictionary.add(vocabulary[1::2])
+        dictionary.remove(vocabulary[:100])
+        eq_(len(dictionary._state[1]), 0)
+        eq_(list(dictionary), vocabulary[100:])
+        eq_(dictionary.expand(terms.Prefix("ab")), [(x, 0) for x in vocabulary[100:] if x.startswith("ab")])
+    finally:
+        terms.COMPACT_MIN = old_min
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
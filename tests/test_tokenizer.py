@@ -1,7 +1,11 @@
+import subprocess
+import sys
+
 import nose
-from nose.tools import eq_
+from nose.tools import eq_, ok_
 
 from fusearch.nltk_tokenizer import NLTKTokenizer
+from fusearch.tokenizer import get_tokenizer, tokfreq
 
 
 def test_tokenizer():
@@ -10,6 +14,25 @@ def test_tokenizer():
     eq_(toks, ["direct", "movi", "long", "time", "complain", "omg"])
 
 
+def test_tokenizer_fast_path():
+    tok = NLTKTokenizer()
+    text = "'Quoted' __init__ x__y_ don't DON'T Running runs ''' _'_ mañana İstanbul \n the THE ﬁle"
+    expected = list(tok.tokenize_slow(text))
+    eq_(tok.tokenize(text), expected)
+    eq_(tok.tokenize_many([text, "", text]), [expected, [], expected])
+    eq_(dict(tok.tokfreq(text)), dict(tokfreq(expected)))
+
+
+def test_lazy_imports():
+    # nltk is only imported when a tokenizer is built, and nothing is downloaded
+    code = "import sys, fusearch.nltk_tokenizer, fusearch.index; print('nltk' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], stdout=subprocess.PIPE, universal_newlines=True, check=True)
+    eq_(out.stdout, "False\n")
+    tok = get_tokenizer(None)
+    ok_(tok is get_tokenizer(None))
+    ok_("the" in tok.stopWords and "don't" in tok.stopWords)
+
+
 if __name__ == "__main__":
     import nose
 
@@ -0,0 +1,62 @@
+from unittest import SkipTest
+
+from nose.tools import eq_
+
+from fusearch.topk import TermPostings, dense_top_k, max_score
+
+
+def term_score(weight, tf, doc_id):
+    return weight * tf
+
+
+def test_max_score():
+    terms = [
+        TermPostings(weight=1.0, upper_bound=3.0, doc_ids=[1, 2, 3, 4, 5, 6], tfs=[1, 3, 1, 2, 1, 1]),
+        TermPostings(weight=5.0, upper_bound=10.0, doc_ids=[4, 6], tfs=[1, 2]),
+        TermPostings(weight=2.0, upper_bound=2.0, doc_ids=[2, 5], tfs=[1, 1]),
+    ]
+    eq_(max_score(terms, 2, term_score), [(6, 11.0), (4, 7.0)])
+    eq_(max_score(terms, 3, term_score), [(6, 11.0), (4, 7.0), (2, 5.0)])
+    # ties are broken by doc id
+    eq_(max_score(terms, 5, term_score), [(6, 11.0), (4, 7.0), (2, 5.0), (5, 3.0), (1, 1.0)])
+    eq_(max_score(terms, 0, term_score), [])
+    eq_(max_score([], 3, term_score), [])
+
+
+def test_max_score_summation_order():
+    # Floating point addition isn't associative, scores are summed in the order of the terms, not of the upper bounds
+    terms = [
+        TermPostings(weight=0.1, upper_bound=0.1, doc_ids=[1, 2], tfs=[1, 1]),
+        TermPostings(weight=0.2, upper_bound=0.2, doc_ids=[1], tfs=[1]),
+        TermPostings(weight=0.3, upper_bound=0.3, doc_ids=[1], tfs=[1]),
+    ]
+    eq_(max_score(terms, 1, term_score), [(1, 0.0 + 0.1 + 0.2 + 0.3)])
+    eq_(max_score(terms[::-1], 1, term_score), [(1, 0.0 + 0.3 + 0.2 + 0.1)])
+
+
+def test_dense_top_k():
+    try:
+        import numpy
+    except ImportError:
+        raise SkipTest("needs numpy")
+    terms = [
+        TermPostings(weight=1.0, upper_bound=3.0, doc_ids=[1, 2, 3, 4, 5, 6], tfs=[1, 3, 1, 2, 1, 1]),
+        TermPostings(weight=5.0, upper_bound=10.0, doc_ids=[4, 6], tfs=[1, 2]),
+        TermPostings(weight=2.0, upper_bound=2.0, doc_ids=[2, 5], tfs=[1, 1]),
+    ]
+    array_terms = [x._replace(doc_ids=numpy.array(x.doc_ids), tfs=numpy.array(x.tfs)) for x in terms]
+    # Doc ids with gaps, positions are their index in the array
+    doc_ids = numpy.array([1, 2, 3, 4, 5, 6, 9])
+
+    def term_scores(weight, tfs, positions):
+        return weight * tfs
+
+    for k in range(8):
+        eq_(dense_top_k(array_terms, k, doc_ids, term_scores), max_score(terms, k, term_score))
+    eq_(dense_top_k([], 3, doc_ids, term_scores), [])
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
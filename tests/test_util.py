@@ -0,0 +1,53 @@
+import os
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from fusearch.util import (
+    compress_text,
+    decompress_text,
+    file_state,
+    file_unchanged,
+    filetype_admissible,
+    normalize_extensions,
+    scan_files,
+)
+
+
+def test_scan_files():
+    with tempfile.TemporaryDirectory() as tmp:
+        expected = set()
+        for path in ["a.txt", "b/c.pdf", "b/d/e", "f/g.jpg"]:
+            path = os.path.join(tmp, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "w") as f:
+                f.write("text")
+            expected.add(path)
+        files = dict(scan_files(tmp))
+        eq_(set(files), expected)
+        for path, stat_result in files.items():
+            eq_(file_state(stat_result), file_state(os.stat(path)))
+            ok_(file_unchanged(file_state(stat_result), stat_result))
+            ok_(file_unchanged((file_state(stat_result)[0], None), stat_result))
+            ok_(not file_unchanged((file_state(stat_result)[0], 1), stat_result))
+
+        extensions = normalize_extensions([".PDF", "txt"])
+        eq_(extensions, {"pdf", "txt"})
+        admissible = sorted(os.path.relpath(x, tmp) for x in files if filetype_admissible(extensions, x))
+        eq_(admissible, ["a.txt", "b/c.pdf"])
+
+
+def test_compress_text():
+    text = "ñandú " * 1000
+    blob = compress_text(text, block_chars=100)
+    eq_(decompress_text(blob), text)
+    eq_(decompress_text(blob, 10), text[10:])
+    for start, end in [(0, 10), (95, 105), (100, 200), (5990, 10**9), (10**9, 10**9 + 1)]:
+        eq_(decompress_text(blob, start, end), text[start:end])
+    eq_(decompress_text(compress_text("")), "")
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)
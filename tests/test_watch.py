@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+from nose.tools import eq_, ok_
+
+from fusearch.watch import InotifyWatcher, PollingWatcher
+
+
+def write(path, txt):
+    with open(path, "w") as f:
+        f.write(txt)
+
+
+def check_watcher(make_watcher):
+    with tempfile.TemporaryDirectory() as tmp:
+        os.mkdir(os.path.join(tmp, "a"))
+        write(os.path.join(tmp, "a", "old.txt"), "old")
+        write(os.path.join(tmp, "gone.txt"), "gone")
+        watcher = make_watcher(tmp)
+        try:
+            write(os.path.join(tmp, "a", "old.txt"), "changed")
+            write(os.path.join(tmp, "new.txt"), "new")
+            write(os.path.join(tmp, "tmp.txt"), "tmp")
+            os.remove(os.path.join(tmp, "tmp.txt"))
+            os.remove(os.path.join(tmp, "gone.txt"))
+            os.mkdir(os.path.join(tmp, "b"))
+            write(os.path.join(tmp, "b", "c.txt"), "c")
+            changes = watcher.changes(debounce=0.1, max_delay=1)
+        finally:
+            watcher.close()
+        ok_(not changes.rescan)
+        ok_(os.path.join(tmp, "a", "old.txt") in changes.changed)
+        ok_(os.path.join(tmp, "new.txt") in changes.changed)
+        # Either the directory or the file in it
+        ok_(changes.changed & {os.path.join(tmp, "b"), os.path.join(tmp, "b", "c.txt")})
+        ok_(os.path.join(tmp, "gone.txt") in changes.deleted)
+        ok_(os.path.join(tmp, "tmp.txt") not in changes.changed)
+        eq_(changes.changed & changes.deleted, set())
+
+
+def test_polling_watcher():
+    check_watcher(lambda path: PollingWatcher([path], interval=0.05))
+
+
+def test_inotify_watcher():
+    check_watcher(lambda path: InotifyWatcher([path]))
+
+
+def test_inotify_watcher_moves():
+    with tempfile.TemporaryDirectory() as tmp:
+        os.makedirs(os.path.join(tmp, "a", "b"))
+        write(os.path.join(tmp, "a", "b", "c.txt"), "c")
+        watcher = InotifyWatcher([tmp])
+        try:
+            shutil.move(os.path.join(tmp, "a"), os.path.join(tmp, "d"))
+            changes = watcher.changes(debounce=0.1, max_delay=1)
+            eq_(changes.changed, {os.path.join(tmp, "d")})
+            eq_(changes.deleted, {os.path.join(tmp, "a")})
+            # The moved directories are watched in their new place
+            write(os.path.join(tmp, "d", "b", "e.txt"), "e")
+            changes = watcher.changes(debounce=0.1, max_delay=1)
+            eq_(changes.changed, {os.path.join(tmp, "d", "b", "e.txt")})
+        finally:
+            watcher.close()
+
+
+if __name__ == "__main__":
+    import nose
+
+    nose.run(defaultTest=__name__)